@@ -0,0 +1,202 @@
+"""Teste de carga da API de consulta (`ldch.api`) sobre um MongoDB local.
+
+Preenche um banco descartável com linhas sintéticas do TCM e do TCE,
+calcula os resumos, sobe a API num processo separado e dispara consultas
+de vários clientes simultâneos: páginas de `/tcm` e `/tce` por
+competência, seguindo os cursores, e resumos por município. Mostra a
+vazão, os percentis de latência por endpoint e a fração de respostas
+vindas do cache:
+
+    $ python benchmarks/api.py --rows 1000000 --clients 32 --duration 30
+    $ python benchmarks/api.py --cache-ttl 0    # sem cache
+
+Com `--invalidate-every`, uma competência é marcada como alterada em
+`Coverage` periodicamente, descartando o cache. Use `--mongomock` para
+rodar sem MongoDB (o banco fica na memória do processo da API).
+"""
+import argparse
+import collections
+import datetime
+import http.client
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import pymongo
+
+from ldch import planner, settings
+from ldch.aggregates import SummaryUpdater
+from ldch.spiders.tce import TceRemuneracaoSpider
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+COMPETENCIAS = ['%d-%02d' % (ano, mes) for ano in (2016, 2017) for mes in range(1, 13)]
+
+
+def municipio(i):
+    return 'Município %d' % i
+
+
+def populate(db, rows, municipios):
+    for collection in ('TcmRemuneracao', 'TceRemuneracao', 'Summaries', planner.COLLECTION):
+        db[collection].drop()
+
+    batch = []
+    for i in range(rows):
+        batch.append({
+            'Município': municipio(i % municipios),
+            'Entidade': 'Prefeitura %d' % (i % municipios),
+            'Competência': COMPETENCIAS[(i // municipios) % len(COMPETENCIAS)],
+            'Nome': 'Servidor %d' % i,
+            'Matrícula': str(i),
+            'Tipo Servidor': 'Efetivo',
+            'Cargo': 'Cargo %d' % (i % 40),
+            'Salário Base': float(1000 + (i * 7919) % 45000),
+            'Salário Vantagens': 0.0,
+            'Salário Gratificação': None
+        })
+        if len(batch) == 10000:
+            db['TcmRemuneracao'].insert_many(batch)
+            batch = []
+    if batch:
+        db['TcmRemuneracao'].insert_many(batch)
+
+    tce = []
+    for i in range(max(rows // 20, 1)):
+        competencia = COMPETENCIAS[i % len(COMPETENCIAS)]
+        tce.append({
+            'Matrícula': i, 'Nome': 'Servidor %d' % i, 'Cargo': 'Cargo %d' % (i % 40),
+            'Competência': '%s-%s' % (competencia[5:], competencia[:4]),
+            'Total da remuneração': float(1000 + (i * 7919) % 45000), 'Teto constitucional': 0.0
+        })
+    db['TceRemuneracao'].insert_many(tce)
+
+    for klass in (TcmRemuneracaoSpider, TceRemuneracaoSpider):
+        SummaryUpdater.from_spider(db, klass(), settings.AGGREGATES_TETO).rebuild()
+
+
+def serve(options, ready):
+    if options.mongomock:
+        import mongomock
+        pymongo.MongoClient = mongomock.MongoClient
+    from ldch.api import Api
+    from twisted.internet import reactor
+
+    api = Api(options.mongo_uri, options.database, pool_size=options.pool_size,
+              cache_ttl=options.cache_ttl, invalidation_interval=1)
+    populate(api.db, options.rows, options.municipios)
+    port = api.start(0).getHost().port
+    if options.invalidate_every:
+        def touch():
+            api.db[planner.COLLECTION].update_one(
+                {'_id': 'bench'}, {'$set': {'spider': 'TcmRemuneracao', 'changed': datetime.datetime.now()}},
+                upsert=True)
+        from twisted.internet import task
+        task.LoopingCall(touch).start(options.invalidate_every, now=False)
+    ready.put(port)
+    reactor.run()
+
+
+class Client(threading.Thread):
+    "Cliente que repete consultas até `deadline`."
+
+    def __init__(self, port, options, deadline, results):
+        super().__init__()
+        self.daemon = True
+        self.port = port
+        self.options = options
+        self.deadline = deadline
+        self.results = results
+        self.random = random.Random()
+
+    def get(self, connection, endpoint, params):
+        path = '/%s?%s' % (endpoint, urlencode(params))
+        start = time.time()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+        elapsed = time.time() - start
+        self.results.append((endpoint, elapsed, response.getheader('X-Cache'), response.status))
+        return json.loads(body.decode('utf-8')) if response.status == 200 else {}
+
+    def run(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        while time.time() < self.deadline:
+            choice = self.random.random()
+            competencia = self.random.choice(COMPETENCIAS)
+            if choice < 0.6:
+                params = {'Competência': competencia, 'limit': self.options.page_size}
+                for _ in range(self.options.pages):
+                    page = self.get(connection, 'tcm', params)
+                    if not page.get('next'):
+                        break
+                    params['after'] = page['next']
+            elif choice < 0.8:
+                params = {'Competência': '%s-%s' % (competencia[5:], competencia[:4]),
+                          'limit': self.options.page_size}
+                self.get(connection, 'tce', params)
+            else:
+                params = {'spider': 'TcmRemuneracao',
+                          'Município': municipio(self.random.randrange(self.options.municipios))}
+                self.get(connection, 'summaries', params)
+        connection.close()
+
+
+def percentiles(values):
+    values = sorted(values)
+    return {'p%d' % p: values[min(len(values) - 1, int(len(values) * p / 100.0))] for p in (50, 90, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help='linhas do TCM; o TCE recebe 1/20')
+    parser.add_argument('--municipios', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20, help='duração da carga, em segundos')
+    parser.add_argument('--pages', type=int, default=5, help='páginas seguidas por consulta ao TCM')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--pool-size', type=int, default=settings.API_MONGO_POOL_SIZE)
+    parser.add_argument('--cache-ttl', type=float, default=settings.API_CACHE_TTL)
+    parser.add_argument('--invalidate-every', type=float, default=0,
+                        help='marca uma competência como alterada a cada X segundos')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost/ldch_bench')
+    parser.add_argument('--database', default='ldch_bench')
+    parser.add_argument('--mongomock', action='store_true', help='usa um MongoDB em memória')
+    options = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    api = multiprocessing.Process(target=serve, args=(options, ready))
+    api.daemon = True
+    api.start()
+    try:
+        port = ready.get(timeout=3600)
+        results = []
+        deadline = time.time() + options.duration
+        clients = [Client(port, options, deadline, results) for _ in range(options.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        api.terminate()
+
+    print('%d requisições em %.1f s, %.0f req/s' % (len(results), elapsed, len(results) / elapsed))
+    by_endpoint = collections.defaultdict(list)
+    for endpoint, latency, cache, status in results:
+        by_endpoint[endpoint].append((latency, cache, status))
+    for endpoint, values in sorted(by_endpoint.items()):
+        latencies = percentiles([latency for latency, _, _ in values])
+        hits = sum(1 for _, cache, _ in values if cache == 'HIT')
+        errors = sum(1 for _, _, status in values if status != 200)
+        print('  %-10s %6d req  p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  cache %.0f%%  erros %d' % (
+            endpoint, len(values), latencies['p50'] * 1000, latencies['p90'] * 1000,
+            latencies['p99'] * 1000, 100.0 * hits / len(values), errors))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Micro-benchmarks de `parse_int`, `parse_float` e da conversão de linhas.
+
+Compara a conversão anterior, célula a célula, com o `RowConverter`
+compilado e verifica que os resultados são idênticos.
+
+    $ python benchmarks/converters.py --rows 20000
+"""
+import argparse
+import csv
+import random
+import timeit
+
+import fixtures
+from ldch.converters import RowConverter, parse_float, parse_int
+from ldch.spiders.tce import TceRemuneracaoSpider
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+
+def list_to_item_antigo(fields, args):
+    if fields is not None and len(args) != len(fields):
+        raise ValueError("Quantidade de elementos diferente da de campos.")
+
+    result = {}
+    for (name, parser), value in zip(fields, args):
+        value = value.strip()
+        if value in ['', '-']:
+            value = None
+        result[name] = parser(value)
+    return result
+
+
+def dict_to_item_antigo(fields, dict):
+    if len(dict) != len(fields):
+        raise ValueError("Length of dictionary is different from fields")
+    for name, converter in fields:
+        dict[name] = converter(dict[name])
+    return dict
+
+
+def report(name, seconds, count):
+    print('  %-32s %10.3f ms %12.0f /s' % (name, seconds * 1000, count / seconds))
+
+
+def best(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    values = [fixtures.money(rnd) for _ in range(args.rows)] + ['12,5%', 'R$ 1.234,00']
+    ints = ['%d.%03d' % (rnd.randint(1, 999), rnd.randint(0, 999)) for _ in range(args.rows)]
+
+    print('valores')
+    report('parse_int', best(lambda: [parse_int(v) for v in ints], args.repeat), len(ints))
+    report('parse_float', best(lambda: [parse_float(v) for v in values], args.repeat), len(values))
+
+    fields = TceRemuneracaoSpider.fields
+    rows = [fixtures.tce_row(rnd, 1000 + i) for i in range(args.rows)]
+    expected = [list_to_item_antigo(fields, row) for row in rows]
+    assert [RowConverter(fields).list_to_item(row) for row in rows] == expected
+    assert RowConverter(fields).convert_table(rows) == expected
+
+    converter = RowConverter(fields)
+    print('linhas do TCE (%d campos)' % len(fields))
+    report('list_to_item antigo', best(
+        lambda: [list_to_item_antigo(fields, row) for row in rows], args.repeat), len(rows))
+    report('RowConverter.list_to_item', best(
+        lambda: [converter.list_to_item(row) for row in rows], args.repeat), len(rows))
+    report('RowConverter.convert_table', best(
+        lambda: converter.convert_table(rows), args.repeat), len(rows))
+
+    fields = TcmRemuneracaoSpider.fields
+    lines = fixtures.tcm_export(args.rows).decode().split('\r\n')[2:-2]
+    header = next(csv.reader(lines[:1]))
+    rows = list(csv.reader(lines[1:]))
+
+    def dict_to_item_all():
+        items = []
+        for d in csv.DictReader(lines):
+            del d['']
+            items.append(dict_to_item_antigo(fields, d))
+        return items
+
+    spider = TcmRemuneracaoSpider()
+    assert list(spider.records_to_items(header, rows)) == dict_to_item_all()
+
+    print('linhas do TCM (%d campos)' % len(fields))
+    report('DictReader + dict_to_item antigo', best(dict_to_item_all, args.repeat), len(rows))
+    report('csv.reader + records_to_items', best(
+        lambda: list(spider.records_to_items(header, list(csv.reader(lines[1:])))), args.repeat), len(rows))
+
+
+if __name__ == '__main__':
+    main()
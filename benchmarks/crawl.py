@@ -0,0 +1,358 @@
+"""Benchmark de ponta a ponta dos spiders, sem acesso aos portais reais.
+
+Sobe o servidor de `server.py` num processo separado, redireciona para ele
+todas as requisições dos spiders e executa-os com a mesma configuração de
+`run_spiders`, gravando num banco descartável. Ao final mostra e salva em
+JSON a vazão, os percentis de latência de download e de processamento das
+respostas, o pico de memória e a contagem de operações no MongoDB.
+
+    $ python benchmarks/crawl.py --spiders tce tcm --municipios 20 --rows 1000
+    $ python benchmarks/crawl.py --compare benchmarks/results/crawl-abc1234.json
+
+Use `--mongomock` para rodar sem MongoDB (requer o pacote `mongomock`;
+as operações no banco não são contadas nesse modo) e `--tor-proxy` para
+passar as requisições por instâncias falsas do Tor (veja `proxies.py`).
+
+A ocupação do downloader (requisições em andamento em relação a
+`CONCURRENT_REQUESTS`, amostradas a cada 100 ms) mostra quanto os
+downloads esperam pelo parse na thread do reactor; compare com
+`--parse-pool process` ou `thread` (veja `ldch.offload`). Com `--no-store`
+os itens não são gravados, isolando o download e o parse:
+
+    $ python benchmarks/crawl.py --spiders tcm --rows 5000 --latency 0.05 --no-store
+    $ python benchmarks/crawl.py --spiders tcm --rows 5000 --latency 0.05 --no-store --parse-pool process
+"""
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import pymongo
+import pymongo.monitoring
+import scrapy.signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.settings import Settings
+from twisted.internet import task
+
+import proxies
+import server
+from ldch import settings
+
+SPIDERS = {
+    'tce': 'ldch.spiders.tce.TceRemuneracaoSpider',
+    'tcm': 'ldch.spiders.tcm.TcmRemuneracaoSpider'
+}
+
+
+class LocalFixturesMiddleware:
+    "Redireciona as requisições para o servidor local de respostas."
+
+    def __init__(self, port):
+        self.port = port
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('FIXTURE_SERVER_PORT'))
+
+    def process_request(self, request, spider):
+        if request.meta.get('fixture'):
+            return
+        url = urlsplit(request.url)
+        local = 'http://127.0.0.1:%d/%s%s' % (self.port, url.netloc, url.path)
+        if url.query:
+            local += '?' + url.query
+        meta = dict(request.meta, fixture=True)
+        return request.replace(url=local, meta=meta, dont_filter=True)
+
+
+class BenchmarkStats:
+    "Mede latências de download e de processamento das respostas."
+
+    def __init__(self, crawler=None):
+        self.crawler = crawler
+        self.received = weakref.WeakKeyDictionary()
+        self.download = []
+        self.scrape = []
+        self.active = []
+        self.sampler = None
+        self.items = 0
+        self.started = None
+        self.finished = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler)
+        crawler.benchmark = ext
+        crawler.signals.connect(ext.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=scrapy.signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=scrapy.signals.response_received)
+        crawler.signals.connect(ext.item_scraped, signal=scrapy.signals.item_scraped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.started = time.time()
+        self.sampler = task.LoopingCall(self.sample)
+        self.sampler.start(0.1)
+
+    def spider_closed(self, spider):
+        self.finished = time.time()
+        if self.sampler is not None and self.sampler.running:
+            self.sampler.stop()
+
+    def sample(self):
+        self.active.append(len(self.crawler.engine.downloader.active))
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.download.append(latency)
+        self.received[response] = time.time()
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+        received = self.received.get(response)
+        if received is not None:
+            self.scrape.append(time.time() - received)
+
+    def summary(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return {
+            'items': self.items,
+            'responses': len(self.download),
+            'elapsed': elapsed,
+            'items_per_sec': self.items / elapsed if elapsed else 0,
+            'download_latency': percentiles(self.download),
+            'item_latency': percentiles(self.scrape),
+            'downloader_utilization': (sum(self.active) / float(len(self.active)) /
+                                       self.crawler.settings.getint('CONCURRENT_REQUESTS')
+                                       if self.active else None)
+        }
+
+
+class CommandCounter(pymongo.monitoring.CommandListener):
+    "Conta os comandos enviados ao MongoDB por tipo e coleção."
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if isinstance(collection, str):
+            self.counts['%s %s' % (event.command_name, collection)] += 1
+        else:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for p in (50, 90, 99):
+        result['p%d' % p] = values[min(len(values) - 1, int(len(values) * p / 100.0))]
+    result['max'] = values[-1]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def crawl(options, port, tor=()):
+    uri = options.mongo_uri
+    counter = None
+    if options.mongomock:
+        import mongomock
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        counter = CommandCounter()
+        pymongo.monitoring.register(counter)
+
+    if not options.keep_database:
+        pymongo.MongoClient(uri).drop_database(options.database)
+
+    # `Database` e o spider do TCE leem o módulo de configurações diretamente
+    settings.MONGO_URI = uri
+    settings.MONGO_DATABASE = options.database
+    settings.START_YEAR = options.start_year
+    settings.ENABLE_TOR_PROXY = False
+
+    scrapy_settings = Settings()
+    scrapy_settings.setmodule(settings)
+    scrapy_settings.set('FIXTURE_SERVER_PORT', port)
+    scrapy_settings.set('LOG_FILE', None)
+    scrapy_settings.set('LOG_LEVEL', options.log_level)
+    scrapy_settings.set('AUTOTHROTTLE_ENABLED', False)
+    scrapy_settings.set('ADAPTIVE_THROTTLE_ENABLED', options.throttle)
+    scrapy_settings.set('ADAPTIVE_THROTTLE_START_DELAY', 0)
+    scrapy_settings.set('ADAPTIVE_THROTTLE_INTERVAL', 2)
+    scrapy_settings.set('RETRY_QUEUE_BACKOFF', 1)
+    scrapy_settings.set('RETRY_QUEUE_POLL_INTERVAL', 1)
+    scrapy_settings.set('RETRY_QUEUE_IDLE_WAIT', 30)
+    scrapy_settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', options.concurrency)
+    scrapy_settings.set('CONCURRENT_REQUESTS', options.concurrency * 2)
+    scrapy_settings.set('WEB_ARCHIVE_URL', 'http://127.0.0.1:%d/web.archive.org' % port)
+    scrapy_settings.set('WEB_ARCHIVE_ENABLED', options.web_archive)
+    scrapy_settings.set('METRICS_PORT', options.metrics_port)
+    scrapy_settings.set('PARSE_POOL_ENABLED', bool(options.parse_pool))
+    if options.parse_pool:
+        scrapy_settings.set('PARSE_POOL_MODE', options.parse_pool)
+        scrapy_settings.set('PARSE_POOL_WORKERS', options.parse_workers)
+        scrapy_settings.set('PARSE_POOL_QUEUE_SIZE', options.parse_queue)
+    if options.scheduler:
+        scrapy_settings.set('SCHEDULER', 'ldch.scheduler.MongoScheduler')
+    if tor:
+        scrapy_settings.set('ENABLE_TOR_PROXY', True)
+        scrapy_settings.set('TOR_PROXIES', [instance.config() for instance in tor])
+        scrapy_settings.set('TOR_CHANGE_CIRCUIT_INTERVAL_RANGE', options.tor_interval)
+    middlewares = dict(scrapy_settings.getdict('DOWNLOADER_MIDDLEWARES'))
+    middlewares['crawl.LocalFixturesMiddleware'] = 50
+    scrapy_settings.set('DOWNLOADER_MIDDLEWARES', middlewares)
+    extensions = dict(scrapy_settings.getdict('EXTENSIONS'))
+    extensions['crawl.BenchmarkStats'] = 0
+    scrapy_settings.set('EXTENSIONS', extensions)
+
+    if options.no_store:
+        scrapy_settings.set('ITEM_PIPELINES', {})
+
+    proc = CrawlerProcess(scrapy_settings)
+    crawlers = {}
+    for name in options.spiders:
+        module, _, klass = SPIDERS[name].rpartition('.')
+        klass = getattr(__import__(module, fromlist=[klass]), klass)
+        crawlers[name] = proc.create_crawler(klass)
+        proc.crawl(crawlers[name])
+
+    start = time.time()
+    proc.start()
+    elapsed = time.time() - start
+
+    result = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'options': vars(options),
+        'elapsed': elapsed,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'mongo_ops': dict(counter.counts) if counter is not None else None,
+        'tor': [instance.summary() for instance in tor],
+        'spiders': {}
+    }
+    for name, crawler in crawlers.items():
+        summary = crawler.benchmark.summary()
+        summary['stats'] = {
+            key: value for key, value in crawler.stats.get_stats().items()
+            if key.startswith('ldch/') or key.startswith('downloader/response_status_count')
+        }
+        result['spiders'][name] = summary
+    return result
+
+
+def report(result, baseline=None):
+    for name, summary in sorted(result['spiders'].items()):
+        line = '%s: %d itens em %.1f s, %.0f itens/s' % (
+            name, summary['items'], summary['elapsed'], summary['items_per_sec'])
+        if baseline and name in baseline['spiders']:
+            before = baseline['spiders'][name]['items_per_sec']
+            if before:
+                line += ' (%+.1f%% em relação a %s)' % (
+                    (summary['items_per_sec'] / before - 1) * 100, baseline.get('commit'))
+        print(line)
+        for key in ('download_latency', 'item_latency'):
+            values = summary[key]
+            if values:
+                print('  %-17s p50 %.3f s  p90 %.3f s  p99 %.3f s' % (
+                    key, values['p50'], values['p90'], values['p99']))
+        utilization = summary.get('downloader_utilization')
+        if utilization is not None:
+            line = '  ocupação do downloader %.0f%%' % (utilization * 100)
+            before = baseline and baseline['spiders'].get(name, {}).get('downloader_utilization')
+            if before:
+                line += ' (%.0f%% em %s)' % (before * 100, baseline.get('commit'))
+            print(line)
+    for index, summary in enumerate(result.get('tor') or ()):
+        print('proxy %d: %d requisições, %d falhas do circuito, %d trocas de circuito' % (
+            index, summary['requests'], summary['errors'], summary['newnyms']))
+    print('pico de memória: %.1f MiB' % result['peak_rss_mib'])
+    if result['mongo_ops']:
+        print('operações no MongoDB:')
+        for key, count in sorted(result['mongo_ops'].items()):
+            print('  %-32s %d' % (key, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--spiders', nargs='+', choices=sorted(SPIDERS), default=sorted(SPIDERS))
+    parser.add_argument('--start-year', type=int, default=datetime.date.today().year)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost/ldch_bench')
+    parser.add_argument('--database', default='ldch_bench')
+    parser.add_argument('--mongomock', action='store_true', help='usa um MongoDB em memória')
+    parser.add_argument('--web-archive', action='store_true', help='arquiva as páginas no servidor local')
+    parser.add_argument('--scheduler', action='store_true', help='usa a fila compartilhada no MongoDB')
+    parser.add_argument('--throttle', action='store_true',
+                        help='ativa o controle adaptativo de concorrência (veja --overload)')
+    parser.add_argument('--tor-proxy', action='append', default=[], metavar='LATÊNCIA:ERROS',
+                        help='instância falsa do Tor; pode ser repetido (veja proxies.py)')
+    parser.add_argument('--tor-interval', type=int, nargs=2, default=(10, 20),
+                        help='intervalo entre as trocas de circuito com --tor-proxy, em segundos')
+    parser.add_argument('--parse-pool', choices=('thread', 'process'),
+                        help='converte as respostas no pool de parse (veja ldch.offload)')
+    parser.add_argument('--parse-workers', type=int, default=2)
+    parser.add_argument('--parse-queue', type=int, default=4)
+    parser.add_argument('--no-store', action='store_true', help='não grava os itens no banco')
+    parser.add_argument('--keep-database', action='store_true', help='não apaga o banco antes de começar')
+    parser.add_argument('--metrics-port', type=int, help='porta do endpoint de métricas durante a execução')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='arquivo JSON com os resultados')
+    parser.add_argument('--compare', help='resultado anterior para comparação')
+    server.add_arguments(parser)
+    options = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    fixture_server = multiprocessing.Process(target=server.serve, args=(options, 0, ready))
+    fixture_server.daemon = True
+    fixture_server.start()
+    tor = [proxies.FakeTor.parse(spec).start() for spec in options.tor_proxy]
+    try:
+        result = crawl(options, ready.get(timeout=30), tor)
+    finally:
+        fixture_server.terminate()
+        for instance in tor:
+            instance.stop()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    output = options.output
+    if output is None:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, 'crawl-%s.json' % (result['commit'] or 'local'))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('resultados salvos em %s' % output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Mede o tempo de inicialização e o pico de memória do LdchDupeFilter.
+
+Cria N páginas em `Meta` num banco descartável e compara o carregamento
+a partir do campo `fingerprint` com a conversão dos documentos antigos.
+Cada modo roda num processo separado para medir o pico de RSS.
+
+    $ python benchmarks/dupefilter_startup.py --pages 1000000 \\
+        --mongo-uri mongodb://localhost/ldch_bench
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import pymongo
+
+from ldch.spiders.base import LdchDupeFilter, legacy_fingerprint
+
+
+def populate(db, pages):
+    db['Meta'].drop()
+    db['Errors'].drop()
+    batch = []
+    for i in range(pages):
+        doc = {
+            'url': 'http://www.tcm.ba.gov.br/Webservice/public/index.php/exportar/pessoal?'
+                   'entidades=%d&ano=2017&mes=%d&tipo=csv' % (i // 12, i % 12 + 1),
+            'request_body': ''
+        }
+        doc['fingerprint'] = legacy_fingerprint(doc)
+        batch.append(doc)
+        if len(batch) == 10000:
+            db['Meta'].insert_many(batch)
+            batch = []
+    if batch:
+        db['Meta'].insert_many(batch)
+
+
+def load(mongo_uri, database, legacy, queue):
+    db = pymongo.MongoClient(mongo_uri)[database]
+    if legacy:
+        db = _LegacyView(db)
+    start = time.time()
+    fingerprints = set(LdchDupeFilter.find_fingerprints_to_ignore(db))
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((len(fingerprints), elapsed, rss))
+
+
+class _LegacyView:
+    "Esconde o campo `fingerprint`, simulando documentos antigos."
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return _LegacyCollection(self.db[name])
+
+
+class _LegacyCollection:
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query, fields):
+        if query.get('fingerprint') == {'$exists': True}:
+            query = dict(query, fingerprint='nenhum')
+        else:
+            query = dict(query)
+            query.pop('fingerprint', None)
+        return self.collection.find(query, fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=100000)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost/ldch_bench')
+    parser.add_argument('--database', default='ldch_bench')
+    parser.add_argument('--skip-populate', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_populate:
+        populate(pymongo.MongoClient(args.mongo_uri)[args.database], args.pages)
+
+    for name, legacy in (('fingerprint', False), ('legado', True)):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=load, args=(args.mongo_uri, args.database, legacy, queue))
+        proc.start()
+        count, elapsed, rss = queue.get()
+        proc.join()
+        print('%-12s %10d páginas %8.2f s %10.1f MiB pico RSS' % (name, count, elapsed, rss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
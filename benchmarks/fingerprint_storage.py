@@ -0,0 +1,82 @@
+"""Compara memória e custo de consulta dos armazenamentos de impressões digitais.
+
+Não precisa do MongoDB: gera N impressões digitais aleatórias, preenche cada
+armazenamento de `ldch.fingerprints` e mede a memória alocada (tracemalloc)
+e o tempo médio de consulta de elementos presentes e ausentes.
+
+    $ python benchmarks/fingerprint_storage.py --count 1000000
+"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from binascii import hexlify
+
+from ldch import fingerprints
+
+
+def random_fingerprints(count):
+    return [hexlify(os.urandom(20)).decode() for _ in range(count)]
+
+
+def build(mode, values, path):
+    if mode == 'set':
+        # cópias, para que as strings sejam contabilizadas como no dupefilter
+        return set(fp[:20] + fp[20:] for fp in values)
+    elif mode == 'sorted':
+        storage = fingerprints.SortedFingerprints()
+    elif mode == 'bloom':
+        storage = fingerprints.BloomFingerprints(capacity=len(values), error_rate=0.0001)
+    else:
+        # como as carregadas do banco pelo dupefilter, para que sejam gravadas no arquivo
+        storage = fingerprints.MmapFingerprints(path)
+        for fp in values:
+            storage.confirm(fp)
+        storage.close()
+        return fingerprints.MmapFingerprints(path)
+    storage.update(values)
+    if mode == 'sorted':
+        storage._merge()
+    return storage
+
+
+def lookup_time(storage, values):
+    start = time.perf_counter()
+    found = 0
+    for fp in values:
+        if fp in storage:
+            found += 1
+    return (time.perf_counter() - start) / len(values) * 1e6, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    values = random_fingerprints(args.count)
+    misses = random_fingerprints(args.lookups)
+    hits = values[:args.lookups]
+    path = os.path.join(tempfile.mkdtemp(), 'fingerprints.bin')
+
+    print('%-8s %12s %12s %12s %10s' % ('modo', 'memória MiB', 'presente µs', 'ausente µs', 'falsos +'))
+    for mode in ('set', 'sorted', 'bloom', 'mmap'):
+        gc.collect()
+        tracemalloc.start()
+        storage = build(mode, values, path)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        hit_us, _ = lookup_time(storage, hits)
+        miss_us, false_positives = lookup_time(storage, misses)
+        print('%-8s %12.1f %12.2f %12.2f %10d' % (
+            mode, memory / 2.0 ** 20, hit_us, miss_us, false_positives))
+        if mode == 'mmap':
+            storage.close()
+        del storage
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Gera respostas sintéticas no formato dos portais do TCE e do TCM."""
+import random
+
+NOMES = ['MARIA', 'JOSE', 'ANA', 'JOAO', 'ANTONIO', 'FRANCISCA', 'CARLOS', 'PAULO']
+SOBRENOMES = ['SILVA', 'SANTOS', 'OLIVEIRA', 'SOUZA', 'LIMA', 'PEREIRA', 'COSTA']
+CARGOS = ['PROFESSOR', 'AGENTE COMUNITARIO DE SAUDE', 'AUXILIAR ADMINISTRATIVO',
+          'MOTORISTA', 'ENFERMEIRO', 'VIGILANTE', 'MEDICO', 'SECRETARIO MUNICIPAL']
+TIPOS = ['Efetivo', 'Temporário', 'Comissionado', 'Eletivo']
+
+
+def money(rnd, maximum=40000):
+    value = '%.2f' % (rnd.random() * maximum)
+    inteiro, centavos = value.split('.')
+    grupos = []
+    while inteiro:
+        grupos.insert(0, inteiro[-3:])
+        inteiro = inteiro[:-3]
+    return '.'.join(grupos) + ',' + centavos
+
+
+def nome(rnd):
+    return '%s %s %s' % (rnd.choice(NOMES), rnd.choice(SOBRENOMES), rnd.choice(SOBRENOMES))
+
+
+def tcm_export(rows, seed=0):
+    "Corpo de uma exportação CSV de `exportar/pessoal` com `rows` linhas."
+
+    rnd = random.Random(seed)
+    lines = [
+        'Tribunal de Contas dos Municípios do Estado da Bahia',
+        'Relatório de Pessoal',
+        'Nome,Matrícula,Tipo Servidor,Cargo,Salário Base,Salário Vantagens,Salário Gratificação,'
+    ]
+    for i in range(rows):
+        lines.append('"%s",%d,%s,"%s","%s","%s","%s",' % (
+            nome(rnd), 1000 + i, rnd.choice(TIPOS), rnd.choice(CARGOS),
+            money(rnd), money(rnd, 5000), money(rnd, 3000)))
+    lines.append('Total de registros: %d' % rows)
+    lines.append('')
+    return '\r\n'.join(lines).encode()
+
+
+def tce_row(rnd, matricula):
+    "Células de uma linha da tabela de remuneração do TCE, como extraídas do HTML."
+
+    return [
+        ' %d ' % matricula, nome(rnd), rnd.choice(['-', 'DAS-2A', 'DAS-3']),
+        money(rnd, 20000), '%s%%' % money(rnd, 100), money(rnd, 3000), money(rnd, 3000),
+        rnd.choice(['0,00', money(rnd, 2000)]), rnd.choice(['0,00', money(rnd, 2000)]),
+        '0,00', money(rnd), money(rnd, 8000), money(rnd, 4000), '0,00',
+        money(rnd, 10000), money(rnd, 30000)
+    ]
+
+
+def tce_consolidado(cargos, rows, seed=0, ano=2017, mes=1):
+    "Página consolidada de remuneração do TCE com `cargos` tabelas de `rows` linhas."
+
+    rnd = random.Random(seed)
+    parts = [
+        '<html><head><title>Remuneração</title></head><body>',
+        '<p><b>Mês/Ano:</b> %02d/%d</p>' % (mes, ano),
+        '<div>Tribunal de Contas do Estado da Bahia<br>Tabela de Remuneração<br>Consolidado<br>'
+    ]
+    matricula = 1000
+    for c in range(cargos):
+        parts.append('<b>CARGO:</b> %s %d<br>' % (rnd.choice(CARGOS), c))
+    parts.append('</div>')
+    for c in range(cargos):
+        parts.append('<table class="cTable"><thead><tr><th>Matrícula</th></tr></thead><tbody>')
+        for _ in range(rows):
+            matricula += 1
+            cells = ''.join('<td>%s</td>' % cell for cell in tce_row(rnd, matricula))
+            parts.append('<tr>%s</tr>' % cells)
+        parts.append('<tr><td colspan="16">* A remuneração inclui vantagens pessoais</td></tr>')
+        parts.append('</tbody></table>')
+    parts.append('</body></html>')
+    return ''.join(parts).encode('utf-8')
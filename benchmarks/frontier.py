@@ -0,0 +1,78 @@
+"""Executa vários crawlers em processos separados sobre a mesma fila no MongoDB.
+
+Cada nó é uma execução de `crawl.py` com `--scheduler`, todas contra o
+mesmo banco (requer um MongoDB local). Ao final verifica se cada
+requisição da fila foi baixada uma única vez e mostra a divisão do
+trabalho entre os nós:
+
+    $ python benchmarks/frontier.py --nodes 4 --municipios 20 --latency 0.05
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pymongo
+
+import server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--spiders', nargs='+', default=['tcm'])
+    parser.add_argument('--mongo-uri', default='mongodb://localhost/ldch_bench')
+    parser.add_argument('--database', default='ldch_bench')
+    server.add_arguments(parser)
+    options = parser.parse_args()
+
+    client = pymongo.MongoClient(options.mongo_uri)
+    client.drop_database(options.database)
+
+    fixtures = ['--municipios', str(options.municipios), '--entidades', str(options.entidades),
+                '--cargos', str(options.cargos), '--rows', str(options.rows),
+                '--latency', str(options.latency)]
+    if options.fixtures:
+        fixtures += ['--fixtures', options.fixtures]
+
+    outputs = []
+    nodes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(options.nodes):
+            output = os.path.join(tmp, 'node-%d.json' % i)
+            outputs.append(output)
+            command = [sys.executable, os.path.join(HERE, 'crawl.py'), '--scheduler', '--keep-database',
+                       '--mongo-uri', options.mongo_uri, '--database', options.database,
+                       '--output', output, '--spiders'] + options.spiders + fixtures
+            nodes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL))
+        failed = sum(1 for node in nodes if node.wait() != 0)
+
+        results = []
+        for output in outputs:
+            if os.path.exists(output):
+                with open(output) as f:
+                    results.append(json.load(f))
+
+    acked = 0
+    for i, result in enumerate(results):
+        for name, summary in sorted(result['spiders'].items()):
+            stats = summary['stats']
+            acked += stats.get('ldch/frontier/acked', 0)
+            print('nó %d %s: %d respostas, %d itens, %d reservadas, %.1f s' % (
+                i, name, summary['responses'], summary['items'],
+                stats.get('ldch/frontier/claimed', 0), summary['elapsed']))
+
+    frontier = client[options.database]['Frontier']
+    queued = frontier.count_documents({}) if hasattr(frontier, 'count_documents') else frontier.count()
+    print('requisições na fila: %d, confirmadas: %d, duplicadas: %d' % (queued, acked, acked - queued))
+    if failed:
+        print('%d nós falharam' % failed)
+    return 1 if failed or acked != queued else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""Instâncias falsas do Tor para testar o `ldch.proxies` sem a rede Tor.
+
+Cada instância tem um proxy HTTP, que repassa as requisições ao servidor
+local de respostas com um atraso fixo, e uma porta de controle que
+entende o suficiente do protocolo do Tor para o `stem` (PROTOCOLINFO,
+AUTHENTICATE, GETCONF e SIGNAL NEWNYM). O circuito inicial de cada
+instância falha numa fração das requisições (503); o NEWNYM troca por um
+circuito sem falhas.
+
+As instâncias são descritas por `latência:taxa de erros`, como em
+`crawl.py --tor-proxy 0.01:0 --tor-proxy 0.05:0.5`.
+"""
+import random
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# sem proxies do ambiente ao repassar as requisições
+opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class FakeTor:
+    "Estado de uma instância: atraso, falhas do circuito atual e contadores."
+
+    def __init__(self, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.newnyms = 0
+        self.lock = threading.Lock()
+        self.proxy = ProxyServer(('127.0.0.1', 0), self)
+        self.control = ControlServer(('127.0.0.1', 0), self)
+
+    @classmethod
+    def parse(cls, spec):
+        latency, _, error_rate = spec.partition(':')
+        return cls(float(latency), float(error_rate or 0))
+
+    def start(self):
+        for server in (self.proxy, self.control):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        for server in (self.proxy, self.control):
+            server.shutdown()
+            server.server_close()
+
+    def config(self):
+        "Entrada de `TOR_PROXIES` para esta instância."
+
+        return {
+            'proxy': 'http://127.0.0.1:%d' % self.proxy.server_address[1],
+            'control_host': '127.0.0.1',
+            'control_port': self.control.server_address[1]
+        }
+
+    def summary(self):
+        return {'requests': self.requests, 'errors': self.errors, 'newnyms': self.newnyms}
+
+    def fails(self):
+        with self.lock:
+            self.requests += 1
+            if random.random() >= self.error_rate:
+                return False
+            self.errors += 1
+            return True
+
+    def new_circuit(self):
+        with self.lock:
+            self.newnyms += 1
+            self.error_rate = 0
+
+
+class ProxyServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tor):
+        super().__init__(address, ProxyHandler)
+        self.tor = tor
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    "Proxy HTTP que repassa as requisições com URL absoluta."
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.forward()
+
+    def do_POST(self):
+        self.forward(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def forward(self, body=None):
+        tor = self.server.tor
+        time.sleep(tor.latency)
+        if tor.fails():
+            return self.respond(503, b'circuito ruim')
+
+        headers = {key: value for key, value in self.headers.items()
+                   if key.lower() not in ('host', 'proxy-connection', 'connection', 'content-length')}
+        request = urllib.request.Request(self.path, data=body, headers=headers, method=self.command)
+        try:
+            with opener.open(request) as response:
+                self.respond(response.status, response.read(), response.headers.get('Content-Type'))
+        except urllib.error.HTTPError as e:
+            self.respond(e.code, e.read(), e.headers.get('Content-Type'))
+
+    def respond(self, status, body, content_type=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, tor):
+        super().__init__(address, ControlHandler)
+        self.tor = tor
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    "Porta de controle sem autenticação que aceita NEWNYM."
+
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip()
+            keyword = command.split(' ', 1)[0].upper()
+            if keyword == 'PROTOCOLINFO':
+                self.reply('250-PROTOCOLINFO 1', '250-AUTH METHODS=NULL',
+                           '250-VERSION Tor="0.4.8.9"', '250 OK')
+            elif keyword == 'GETCONF':
+                keys = command.split()[1:] or ['OK']
+                self.reply(*['250-%s' % key for key in keys[:-1]] + ['250 %s' % keys[-1]])
+            elif keyword == 'GETINFO' and command.endswith('version'):
+                self.reply('250-version=0.4.8.9', '250 OK')
+            elif keyword == 'SIGNAL' and command.upper().endswith('NEWNYM'):
+                self.server.tor.new_circuit()
+                self.reply('250 OK')
+            elif keyword == 'QUIT':
+                self.reply('250 closing connection')
+                return
+            else:
+                self.reply('250 OK')
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode('ascii'))
+        self.wfile.flush()
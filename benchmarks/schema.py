@@ -0,0 +1,131 @@
+"""Memória dos itens tipados e tamanho dos documentos em cada formato de `ldch.schema`.
+
+Converte linhas sintéticas do TCM e do TCE com os conversores dos
+spiders, como dicionários e como itens tipados, e mostra a memória
+alocada por item (tracemalloc) e o tamanho médio do BSON de cada formato
+de documento. Sem `--mongomock`, grava as linhas num MongoDB local
+descartável em cada formato e mostra `collStats` (dados, armazenamento e
+índices):
+
+    $ python benchmarks/schema.py --rows 200000
+    $ python benchmarks/schema.py --rows 20000 --mongomock
+"""
+import argparse
+import csv
+import gc
+import random
+import sys
+import tracemalloc
+
+import bson
+import pymongo
+import pymongo.errors
+
+import fixtures
+from ldch.converters import RowConverter
+from ldch.indexes import ensure_indexes
+from ldch.schema import Schema, collection_stats, item_class
+from ldch.spiders.tce import TceRemuneracaoSpider
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+LAYOUTS = (('nomes', False, False), ('compacto', True, False), ('compacto+centavos', True, True))
+
+
+def tcm_rows(rows):
+    lines = fixtures.tcm_export(rows).decode().split('\r\n')[2:-2]
+    header = next(csv.reader(lines[:1]))
+    return header[:-1], [row[:-1] for row in csv.reader(lines[1:])]
+
+
+def tcm_items(converter, header, rows):
+    items = converter.convert_columns(header, list(zip(*rows)))
+    for i, item in enumerate(items):
+        item['Município'] = 'MUNICIPIO %d' % (i % 50)
+        item['Entidade'] = 'PREFEITURA MUNICIPAL %d' % (i % 50)
+        item['Competência'] = '2017-%02d' % (1 + i % 12)
+    return items
+
+
+def tce_items(converter, rows):
+    items = converter.convert_table(rows)
+    for i, item in enumerate(items):
+        item['Cargo'] = fixtures.CARGOS[i % len(fixtures.CARGOS)]
+        item['Competência'] = '%02d-2017' % (1 + i % 12)
+    return items
+
+
+def measure(build):
+    "Itens criados por `build` e a memória alocada por eles, em bytes."
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return items, after - before
+
+
+def bson_size(schema, items):
+    return sum(len(bson.BSON.encode(schema.to_document(item))) for item in items) / float(len(items))
+
+
+def store(db, klass, schema, items):
+    "Grava `items` na coleção do spider no formato de `schema` e retorna `collStats`."
+
+    spider = klass()
+    name = spider.name
+    db[name].drop()
+    ensure_indexes(db, spider, schema)
+    for start in range(0, len(items), 10000):
+        db[name].insert_many([schema.to_document(item) for item in items[start:start + 10000]])
+    try:
+        db.command('compact', name)
+    except pymongo.errors.OperationFailure:
+        pass
+    return collection_stats(db, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost/ldch_bench')
+    parser.add_argument('--database', default='ldch_bench')
+    parser.add_argument('--mongomock', action='store_true', help='mede apenas a memória e o BSON')
+    options = parser.parse_args()
+
+    header, rows = tcm_rows(options.rows)
+    rnd = random.Random(0)
+    tce_table = [fixtures.tce_row(rnd, 1000 + i) for i in range(options.rows)]
+    spiders = (
+        (TcmRemuneracaoSpider, lambda converter: tcm_items(converter, header, rows)),
+        (TceRemuneracaoSpider, lambda converter: tce_items(converter, tce_table))
+    )
+
+    db = None
+    if not options.mongomock:
+        db = pymongo.MongoClient(options.mongo_uri)[options.database]
+
+    for klass, build in spiders:
+        print('%s (%d linhas)' % (klass.__name__, options.rows))
+        dicts, dict_memory = measure(lambda: build(RowConverter(klass.fields)))
+        typed, typed_memory = measure(lambda: build(RowConverter(klass.fields, item_class=item_class(klass))))
+        assert [dict(item.items()) for item in typed] == dicts
+        print('  memória por item: dict %.0f B, tipado %.0f B (%.0f%%)' % (
+            dict_memory / len(dicts), typed_memory / len(typed), 100.0 * typed_memory / dict_memory))
+        del dicts
+
+        for name, compact, cents in LAYOUTS:
+            schema = Schema(klass, compact, cents)
+            line = '  %-18s BSON %6.1f B/doc' % (name, bson_size(schema, typed))
+            if db is not None:
+                stats = store(db, klass, schema, typed)
+                line += '  dados %7.1f MiB  armazenamento %7.1f MiB  índices %7.1f MiB' % (
+                    stats['size'] / 2 ** 20, stats['storageSize'] / 2 ** 20, stats['totalIndexSize'] / 2 ** 20)
+            print(line)
+        if db is not None:
+            db[klass().name].drop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""Servidor HTTP local que imita os portais do TCE, do TCM e a web.archive.org.
+
+Os caminhos começam pelo host original, por exemplo
+`/www.tcm.ba.gov.br/portal-da-cidadania/pessoal/`. As respostas são
+sintéticas (veja `fixtures`) ou lidas de um diretório com páginas gravadas:
+
+    <diretório>/tcm_portal.html
+    <diretório>/tcm_entidades.json
+    <diretório>/tcm_pessoal.csv
+    <diretório>/tce_consolidado.html
+
+    $ python benchmarks/server.py --port 8000 --municipios 10 --rows 500
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+import zlib
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import fixtures
+
+
+class FixtureServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, FixtureHandler)
+        self.options = options
+        self.bodies = load_bodies(options)
+        # URLs que já falharam uma vez com `--fail-rate`
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def fail_once(self, path):
+        "Indica se `path` deve falhar: uma única vez, para uma fração fixa das URLs."
+
+        if zlib.crc32(path.encode()) % 1000 >= self.options.fail_rate * 1000:
+            return False
+        with self.lock:
+            if path in self.failed:
+                return False
+            self.failed.add(path)
+        return True
+
+
+def load_bodies(options):
+    recorded = {}
+    if options.fixtures:
+        for name in ('tcm_portal.html', 'tcm_entidades.json', 'tcm_pessoal.csv', 'tce_consolidado.html'):
+            path = os.path.join(options.fixtures, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    recorded[name] = f.read()
+
+    municipios = ''.join('<option value="%d">Município %d</option>' % (i, i)
+                         for i in range(1, options.municipios + 1))
+    return {
+        'tcm_portal.html': recorded.get('tcm_portal.html') or (
+            '<html><body><select id="municipios"><option value="">Selecione</option>'
+            '%s</select></body></html>' % municipios).encode('utf-8'),
+        'tcm_entidades.json': recorded.get('tcm_entidades.json'),
+        'tcm_pessoal.csv': recorded.get('tcm_pessoal.csv') or fixtures.tcm_export(options.rows),
+        'tce_consolidado.html': recorded.get('tce_consolidado.html') or
+        fixtures.tce_consolidado(options.cargos, options.rows // options.cargos or 1)
+    }
+
+
+def entidades(municipio, count):
+    # códigos únicos por município, como no portal
+    result = [{'cdEntidade': ' %s%02d ' % (municipio, i), 'dsEntidade': ' Entidade %d ' % i}
+              for i in range(1, count + 1)]
+    return json.dumps(result).encode('utf-8')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            in_flight = self.server.in_flight
+        try:
+            self.respond(in_flight)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def respond(self, in_flight):
+        options = self.server.options
+        latency = options.latency
+        if options.overload and in_flight > options.overload:
+            # servidor sobrecarregado: mais lento e, acima do dobro do limite, recusando requisições
+            if in_flight > 2 * options.overload:
+                self.send_error(503)
+                return
+            latency = max(latency, 0.1) * in_flight / options.overload
+        if latency:
+            time.sleep(latency)
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        host, _, path = url.path.lstrip('/').partition('/')
+        content_type = 'text/html; charset=utf-8'
+
+        if host == 'web.archive.org' and path.startswith('__wb/sparkline'):
+            body = json.dumps({'last_ts': time.strftime('%Y%m%d%H%M%S')}).encode()
+            content_type = 'application/json'
+        elif host == 'web.archive.org':
+            body = b''
+        elif host == 'www.tcm.ba.gov.br' and path.endswith('/entidades'):
+            body = self.server.bodies['tcm_entidades.json'] or entidades(
+                query.get('cdMunicipio', ['0'])[0], options.entidades)
+            content_type = 'application/json'
+        elif host == 'www.tcm.ba.gov.br' and path.endswith('/exportar/pessoal'):
+            if self.server.fail_once(self.path):
+                self.send_error(502)
+                return
+            body = self.server.bodies['tcm_pessoal.csv']
+            content_type = 'text/csv; charset=utf-8'
+        elif host == 'www.tcm.ba.gov.br':
+            body = self.server.bodies['tcm_portal.html']
+        elif host == 'www.tce.ba.gov.br' and 'ano' in query:
+            body = self.server.bodies['tce_consolidado.html']
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument('--fixtures', help='diretório com respostas gravadas')
+    parser.add_argument('--municipios', type=int, default=5)
+    parser.add_argument('--entidades', type=int, default=3)
+    parser.add_argument('--cargos', type=int, default=40)
+    parser.add_argument('--rows', type=int, default=500, help='linhas por CSV e por página do TCE')
+    parser.add_argument('--latency', type=float, default=0, help='atraso de cada resposta, em segundos')
+    parser.add_argument('--overload', type=int, default=0,
+                        help='requisições simultâneas acima das quais o servidor fica lento e, '
+                             'acima do dobro, responde 503')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='fração dos CSVs do TCM que respondem 502 na primeira requisição')
+
+
+def serve(options, port=0, ready=None):
+    server = FixtureServer(('127.0.0.1', port), options)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    add_arguments(parser)
+    options = parser.parse_args()
+    print('Servindo em http://127.0.0.1:%d/' % options.port)
+    serve(options, options.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compara a extração anterior, com um `Selector` por linha, e a extração compilada do TCE.
+
+Usa páginas consolidadas gravadas, passadas como argumentos, ou uma
+página sintética. Verifica que as duas extrações produzem os mesmos itens.
+
+    $ python benchmarks/tce_html.py --cargos 40 --rows 100
+    $ python benchmarks/tce_html.py paginas/consolidado-2017-01.html
+"""
+import argparse
+import time
+
+from scrapy.http import HtmlResponse, Request
+
+import fixtures
+from ldch.spiders.tce import TceRemuneracaoSpider
+
+
+def parse_tabela_antigo(spider, response):
+    cargos = response.xpath("//b[contains(text(), 'CARGO:')]/../text()").extract()[3:]
+    cargos = (p.strip() for p in cargos)
+    cargos = [p for p in cargos if p != ""]
+
+    competencia = response.xpath("//b[contains(text(), 'Mês/Ano')]/../text()").extract_first().strip()
+    mes, ano = competencia.split('/')
+
+    i = None
+    for i, table in enumerate(response.css('.cTable tbody')):
+        for remuneracao in table.css('tr'):
+            remuneracao = remuneracao.xpath('td/text()').extract()
+            if len(remuneracao) == 1:
+                assert remuneracao[0].strip().startswith("* A remuneração")
+                continue
+
+            remuneracao = spider.list_to_item(remuneracao)
+            remuneracao['Cargo'] = cargos[i].strip()
+            remuneracao['Competência'] = '%s-%s' % (mes, ano)
+            yield remuneracao
+
+    if (i or 0) + 1 != len(cargos):
+        raise Exception("Quantidade de cargos diferente da quantidade de tabelas")
+
+
+def make_response(body):
+    url = 'https://www.tce.ba.gov.br/component/cdsremuneracao/'
+    return HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+
+
+def measure(func, body, repeat):
+    best = None
+    for _ in range(repeat):
+        # uma resposta nova a cada repetição, para incluir o parsing do HTML
+        response = make_response(body)
+        start = time.perf_counter()
+        count = sum(1 for _ in func(response))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('fixtures', nargs='*')
+    parser.add_argument('--cargos', type=int, default=40)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = [open(path, 'rb').read() for path in args.fixtures]
+    bodies = bodies or [fixtures.tce_consolidado(args.cargos, args.rows)]
+    spider = TceRemuneracaoSpider()
+    for body in bodies:
+        expected = list(parse_tabela_antigo(spider, make_response(body)))
+        assert list(spider.parse_tabela(make_response(body))) == expected
+
+        print('%.1f MiB' % (len(body) / 2.0 ** 20))
+        for name, func in (('antigo', lambda r: parse_tabela_antigo(spider, r)),
+                           ('compilado', spider.parse_tabela)):
+            count, elapsed = measure(func, body, args.repeat)
+            print('  %-10s %8d itens %8.3f s %10.0f itens/s' % (name, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
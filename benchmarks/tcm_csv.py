@@ -0,0 +1,81 @@
+"""Compara a leitura antiga e a leitura em fluxo dos CSVs do TCM.
+
+Usa exportações gravadas, passadas como argumentos, ou uma exportação
+sintética de `--rows` linhas. Verifica que as duas leituras produzem os
+mesmos itens e mede tempo e pico de memória alocada.
+
+    $ python benchmarks/tcm_csv.py --rows 100000
+    $ python benchmarks/tcm_csv.py exportacoes/*.csv
+"""
+import argparse
+import csv
+import io
+import time
+import tracemalloc
+
+from scrapy.http import TextResponse, Request
+
+import fixtures
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+
+def extrair_tabela_antigo(spider, response):
+    texto = response.body.decode()
+    texto = texto.split('\r\n')[2:-2]
+    texto = '\n'.join(texto)
+
+    for linha in csv.DictReader(io.StringIO(texto)):
+        del linha['']
+        remuneracao = spider.dict_to_item(linha)
+        remuneracao['Município'] = response.meta['municipio_nome']
+        remuneracao['Entidade'] = response.meta['entidade_nome']
+        remuneracao['Competência'] = response.meta['competencia']
+        yield remuneracao
+
+
+def make_response(body):
+    meta = {'municipio_nome': 'Salvador', 'entidade_nome': 'Prefeitura', 'competencia': '2017-01'}
+    request = Request('http://www.tcm.ba.gov.br/exportar', meta=meta)
+    return TextResponse(request.url, body=body, encoding='utf-8', request=request)
+
+
+def measure(func, response, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        count = 0
+        for _ in func(response):
+            count += 1
+    elapsed = (time.perf_counter() - start) / repeat
+
+    # memória medida numa execução separada, pois o tracemalloc é lento
+    tracemalloc.start()
+    for _ in func(response):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('fixtures', nargs='*')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    bodies = [open(path, 'rb').read() for path in args.fixtures] or [fixtures.tcm_export(args.rows)]
+    spider = TcmRemuneracaoSpider()
+    for body in bodies:
+        response = make_response(body)
+        assert list(extrair_tabela_antigo(spider, response)) == list(spider.extrair_tabela(response))
+
+        print('%.1f MiB' % (len(body) / 2.0 ** 20))
+        for name, func in (('antigo', lambda r: extrair_tabela_antigo(spider, r)),
+                           ('fluxo', spider.extrair_tabela)):
+            count, elapsed, peak = measure(func, response, args.repeat)
+            print('  %-8s %8d itens %8.3f s %10.0f itens/s %8.1f MiB pico' % (
+                name, count, elapsed, count / elapsed, peak / 2.0 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Resumos da remuneração por município, entidade e competência.
+
+A coleção `Summaries` guarda, para cada spider que declara
+`summary_value` e cada combinação de `Município`, `Entidade` e
+`Competência` presente nos seus itens (os campos ausentes no spider
+ficam nulos), os valores de `summary_value`:
+
+    max         maior valor
+    sum         soma
+    count       quantidade de linhas
+    above_teto  linhas acima de `AGGREGATES_TETO`
+    teto        teto usado na contagem
+    sum_teto    soma de `summary_teto`, se o spider o declarar (o TCE
+                informa o desconto do teto constitucional de cada linha)
+
+Os painéis leem esses documentos em vez de percorrer as coleções dos
+spiders. Durante a raspagem, o `LdchMongoPipeline` marca os grupos dos
+itens gravados e das páginas substituídas, que são recalculados, pelos
+índices da coleção, a cada gravação de lotes. As agregações usam o formato
+registrado da coleção (veja `ldch.schema`), e os resumos ficam sempre com
+os nomes dos campos e os valores em reais. Para recalcular tudo (após
+mudar o teto, por exemplo):
+
+    $ ldch_summaries ldch.spiders.tcm.TcmRemuneracaoSpider ldch.spiders.tce.TceRemuneracaoSpider
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+import pymongo
+import pymongo.errors
+
+from ldch import settings
+from ldch.schema import load_schema
+from ldch.spiders.base import Database, load_spiders
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'Summaries'
+
+# campos que identificam um resumo
+SUMMARY_KEYS = ('Município', 'Entidade', 'Competência')
+
+
+def summary_id(spider, key):
+    return ':'.join([spider] + ['' if value is None else str(value) for value in key])
+
+
+def group_fields(klass):
+    "Campos de `SUMMARY_KEYS` preenchidos pelo spider."
+
+    names = set(klass.context_fields) | {name for name, _ in klass.fields or ()}
+    return tuple(field for field in SUMMARY_KEYS if field in names)
+
+
+def summary_pipeline(group, value, teto, teto_field=None, match=None):
+    "Agregação que calcula os resumos de `value` por `group` nos documentos de `match`."
+
+    stages = []
+    if match:
+        stages.append({'$match': match})
+    accumulators = {
+        '_id': {'k%d' % i: '$' + field for i, field in enumerate(group)},
+        'max': {'$max': '$' + value},
+        'sum': {'$sum': '$' + value},
+        'count': {'$sum': 1},
+        'above_teto': {'$sum': {'$cond': [{'$gt': ['$' + value, teto]}, 1, 0]}}
+    }
+    if teto_field:
+        accumulators['sum_teto'] = {'$sum': '$' + teto_field}
+    stages.append({'$group': accumulators})
+    return stages
+
+
+class SummaryUpdater:
+    "Recalcula os resumos dos grupos alterados de um spider."
+
+    def __init__(self, db, spider, group, value, teto, teto_field=None, schema=None):
+        self.db = db
+        self.spider = spider
+        self.group = group
+        self.value = value
+        self.teto = teto
+        self.teto_field = teto_field
+        self.schema = schema
+        self.dirty = set()
+
+    @classmethod
+    def from_spider(cls, db, spider, teto, schema=None):
+        "Cria o atualizador de `spider` ou retorna None se ele não tem resumos."
+
+        value = getattr(spider, 'summary_value', None)
+        if not value:
+            return None
+        return cls(db, spider.name, group_fields(type(spider)), value, teto,
+                   getattr(spider, 'summary_teto', None), schema)
+
+    def _stored(self, field):
+        return self.schema.key(field) if self.schema is not None and field else field
+
+    def _scale(self, field):
+        return self.schema.scale(field) if self.schema is not None else 1
+
+    def _pipeline(self, match=None):
+        "`summary_pipeline` com os nomes e a escala dos campos na coleção."
+
+        if match:
+            match = {self._stored(field): value for field, value in match.items()}
+        return summary_pipeline([self._stored(field) for field in self.group], self._stored(self.value),
+                                self.teto * self._scale(self.value), self._stored(self.teto_field), match)
+
+    def touch(self, items):
+        "Marca os grupos de `items` para recálculo."
+
+        for item in items:
+            self.dirty.add(tuple(item.get(field) for field in self.group))
+
+    def touch_page(self, page_id):
+        "Marca os grupos dos itens da página `page_id`, antes que eles sejam removidos."
+
+        stages = [{'$match': {'__meta': page_id}},
+                  {'$group': {'_id': {'k%d' % i: '$' + self._stored(field)
+                                      for i, field in enumerate(self.group)}}}]
+        for doc in self.db[self.spider].aggregate(stages):
+            self.dirty.add(self._key(doc['_id']))
+
+    def flush(self):
+        "Recalcula os grupos marcados."
+
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        try:
+            for key in dirty:
+                match = {field: value for field, value in zip(self.group, key)}
+                docs = list(self.db[self.spider].aggregate(self._pipeline(match)))
+                if docs:
+                    self.db[COLLECTION].replace_one({'_id': summary_id(self.spider, key)},
+                                                    self._summary(key, docs[0]), upsert=True)
+                else:
+                    self.db[COLLECTION].delete_one({'_id': summary_id(self.spider, key)})
+        except pymongo.errors.PyMongoError:
+            logger.exception("Falha ao atualizar os resumos de %s" % self.spider)
+            self.dirty |= dirty
+
+    def _key(self, group_id):
+        return tuple(group_id.get('k%d' % i) for i in range(len(self.group)))
+
+    def _summary(self, key, doc, updated=None):
+        summary = {'spider': self.spider, 'teto': self.teto,
+                   'updated': updated or datetime.datetime.now()}
+        values = dict(zip(self.group, key))
+        for field in SUMMARY_KEYS:
+            summary[field] = values.get(field)
+        for field in ('count', 'above_teto'):
+            summary[field] = doc[field]
+        # valores gravados em centavos voltam para reais
+        for field, source in (('max', self.value), ('sum', self.value), ('sum_teto', self.teto_field)):
+            if field in doc:
+                value = doc[field]
+                if value is not None and self._scale(source) != 1:
+                    value = value / float(self._scale(source))
+                summary[field] = value
+        return summary
+
+    def rebuild(self, batch_size=1000):
+        """Recalcula todos os resumos do spider e remove os de grupos que não existem mais.
+
+        Retorna a quantidade de resumos gravados.
+        """
+
+        started = datetime.datetime.now()
+        requests = []
+        total = 0
+        cursor = self.db[self.spider].aggregate(self._pipeline(), allowDiskUse=True)
+        for doc in cursor:
+            key = self._key(doc['_id'])
+            requests.append(pymongo.ReplaceOne({'_id': summary_id(self.spider, key)},
+                                               self._summary(key, doc, started), upsert=True))
+            if len(requests) >= batch_size:
+                self.db[COLLECTION].bulk_write(requests, ordered=False)
+                total += len(requests)
+                requests = []
+        if requests:
+            self.db[COLLECTION].bulk_write(requests, ordered=False)
+            total += len(requests)
+        self.db[COLLECTION].delete_many({'spider': self.spider, 'updated': {'$lt': started}})
+        return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula os resumos de remuneração dos spiders.")
+    parser.add_argument('spiders', nargs='+', metavar='spider',
+                        help="caminho completo da classe, ex. ldch.spiders.tcm.TcmRemuneracaoSpider")
+    parser.add_argument('--teto', type=float, default=settings.AGGREGATES_TETO,
+                        help="valor acima do qual uma linha é contada em `above_teto`")
+    options = parser.parse_args()
+
+    spiders = load_spiders(options.spiders)
+    if spiders is None:
+        return 1
+
+    with Database() as db:
+        for klass in spiders:
+            updater = SummaryUpdater.from_spider(db, klass(), options.teto, load_schema(db, klass))
+            if updater is None:
+                print("%s não declara `summary_value`" % klass.__name__)
+                continue
+            start = time.time()
+            total = updater.rebuild()
+            print("%s: %d resumos em %.1f s" % (klass.__name__, total, time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""API HTTP somente leitura sobre os dados raspados.
+
+    GET /tce            linhas do TCE, filtráveis por Cargo, Competência e Matrícula
+    GET /tcm            linhas do TCM, filtráveis por Município, Entidade, Competência,
+                        Matrícula e Cargo
+    GET /summaries      resumos de `ldch.aggregates`, filtráveis por spider,
+                        Município, Entidade e Competência
+
+Os filtros são parâmetros com o nome do campo (`/tcm?Competência=2017-01`).
+As respostas têm até `limit` itens (no máximo `API_MAX_PAGE_SIZE`) e, se
+houver mais, o cursor da página seguinte em `next`, a ser passado em
+`after`. A paginação segue o `_id` dos documentos, sem `skip`, e os
+índices por filtro e `_id` são criados ao iniciar a API.
+
+Filtros e respostas usam sempre os nomes dos campos e os valores em
+reais, qualquer que seja o formato da coleção (veja `ldch.schema`).
+
+As consultas rodam no pool de threads do reactor, com um único cliente do
+MongoDB de até `API_MONGO_POOL_SIZE` conexões. As respostas ficam em cache
+por `API_CACHE_TTL` segundos (cabeçalho `X-Cache`); consultas iguais
+simultâneas aguardam a mesma ida ao banco. A cada
+`API_INVALIDATION_INTERVAL` segundos, competências alteradas em `Coverage`
+descartam o cache do spider correspondente e o dos resumos, e o formato
+das coleções é relido de `Schemas`, de modo que coleções convertidas com
+`ldch_schema` ou criadas depois do início da API sejam lidas corretamente.
+
+    $ ldch_api
+"""
+import datetime
+import json
+import logging
+import sys
+import time
+
+import pymongo
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from scrapy.settings import Settings
+from scrapy.utils.log import configure_logging
+from twisted.internet import reactor, task, threads
+from twisted.web import resource, server
+
+from ldch import aggregates, planner, settings
+from ldch.export import columns
+from ldch.schema import load_schema
+from ldch.spiders.base import LRUCache, load_spiders
+
+logger = logging.getLogger(__name__)
+
+# caminho de cada spider na API
+SPIDERS = {
+    'tce': 'ldch.spiders.tce.TceRemuneracaoSpider',
+    'tcm': 'ldch.spiders.tcm.TcmRemuneracaoSpider'
+}
+
+
+class TTLCache:
+    "Cache LRU cujas entradas expiram após `ttl` segundos."
+
+    def __init__(self, size, ttl):
+        self.ttl = ttl
+        self.entries = LRUCache(size)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if time.monotonic() >= expires:
+            self.entries.discard(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        if self.ttl > 0:
+            self.entries.set(key, (time.monotonic() + self.ttl, value))
+
+    def invalidate(self, collections):
+        "Descarta as entradas das consultas a `collections`."
+
+        for key in list(self.entries.data):
+            if key[0] in collections:
+                self.entries.discard(key)
+
+
+class Endpoint:
+    "Consulta paginada a uma coleção, com filtros de igualdade em `filters`."
+
+    def __init__(self, collection, filters, object_ids=True, schema=None):
+        self.collection = collection
+        # nome do filtro -> conversor do valor recebido
+        self.filters = filters
+        self.object_ids = object_ids
+        self.schema = schema
+
+    @classmethod
+    def from_spider(cls, klass, schema=None):
+        types = dict(columns(klass))
+        names = tuple(klass.context_fields) + tuple(
+            name for name in (klass.natural_key or ()) if name not in klass.context_fields)
+        return cls(klass().name, {name: types.get(name, str) for name in names}, schema=schema)
+
+    def _stored(self, name):
+        return self.schema.key(name) if self.schema is not None else name
+
+    def ensure_indexes(self, db):
+        for name in self.filters:
+            db[self.collection].create_index([(self._stored(name), pymongo.ASCENDING),
+                                              ('_id', pymongo.ASCENDING)], background=True)
+
+    def parse(self, args, page_size=100, max_page_size=1000):
+        """Converte os parâmetros da requisição em `(filtro, after, limit)`.
+
+        Lança ValueError para parâmetros inválidos.
+        """
+
+        query = {}
+        after = None
+        limit = page_size
+        for name, values in sorted(args.items()):
+            name = name.decode('utf-8')
+            value = values[-1].decode('utf-8')
+            if name == 'limit':
+                limit = int(value)
+                if not 0 < limit <= max_page_size:
+                    raise ValueError("`limit` deve estar entre 1 e %d" % max_page_size)
+            elif name == 'after':
+                try:
+                    after = ObjectId(value) if self.object_ids else value
+                except InvalidId:
+                    raise ValueError("Cursor inválido: %s" % value)
+            elif name in self.filters:
+                query[name] = self.filters[name](value)
+            else:
+                raise ValueError("Filtro desconhecido: %s" % name)
+        return query, after, limit
+
+    def fetch(self, db, query, after, limit):
+        "Busca uma página; retorna os itens e o cursor da seguinte ou None. Bloqueante."
+
+        if self.schema is not None:
+            query = {self.schema.key(name): self.schema.store_value(name, value)
+                     for name, value in query.items()}
+        if after is not None:
+            query = dict(query, _id={'$gt': after})
+        cursor = (db[self.collection].find(query, {'__meta': 0, '__updated': 0})
+                  .sort('_id', pymongo.ASCENDING).limit(limit + 1))
+        docs = list(cursor)
+        next_cursor = str(docs[limit - 1]['_id']) if len(docs) > limit else None
+        items = []
+        for doc in docs[:limit]:
+            doc.pop('_id')
+            items.append(self.schema.from_document(doc) if self.schema is not None else doc)
+        return items, next_cursor
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class QueryResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, api, endpoint):
+        super().__init__()
+        self.api = api
+        self.endpoint = endpoint
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/json; charset=utf-8')
+        try:
+            query, after, limit = self.endpoint.parse(request.args, self.api.page_size,
+                                                      self.api.max_page_size)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return json.dumps({'error': str(e)}).encode('utf-8')
+
+        key = (self.endpoint.collection, tuple(sorted(query.items())), str(after), limit)
+        body = self.api.cache.get(key)
+        if body is not None:
+            request.setHeader(b'X-Cache', b'HIT')
+            return body
+
+        request.setHeader(b'X-Cache', b'MISS')
+        waiting = self.api.pending.get(key)
+        if waiting is None:
+            waiting = self.api.pending[key] = []
+            d = threads.deferToThread(self.endpoint.fetch, self.api.db, query, after, limit)
+            d.addCallbacks(self._fetched, self._failed, callbackArgs=(key,), errbackArgs=(key,))
+        waiting.append(request)
+        return server.NOT_DONE_YET
+
+    def _fetched(self, result, key):
+        items, next_cursor = result
+        body = json.dumps({'items': items, 'next': next_cursor}, default=_json_default,
+                          ensure_ascii=False).encode('utf-8')
+        self.api.cache.set(key, body)
+        self._respond(key, 200, body)
+
+    def _failed(self, failure, key):
+        logger.error("Falha ao consultar %s: %s" % (self.endpoint.collection, failure.getErrorMessage()))
+        self._respond(key, 500, json.dumps({'error': 'falha ao consultar o banco'}).encode('utf-8'))
+
+    def _respond(self, key, code, body):
+        for request in self.api.pending.pop(key, ()):
+            # o cliente pode ter desconectado enquanto aguardava
+            if request.finished or request._disconnected:
+                continue
+            request.setResponseCode(code)
+            request.write(body)
+            request.finish()
+
+
+class IndexResource(resource.Resource):
+
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/json; charset=utf-8')
+        endpoints = {name: sorted(endpoint.filters) for name, endpoint in self.api.endpoints.items()}
+        return json.dumps(endpoints, ensure_ascii=False).encode('utf-8')
+
+    def getChild(self, path, request):
+        if path == b'':
+            return self
+        return resource.Resource.getChild(self, path, request)
+
+
+class _QuietSite(server.Site):
+
+    def log(self, request):
+        pass
+
+
+class Api:
+    "Endpoints, cache e cliente do MongoDB da API."
+
+    def __init__(self, mongo_uri, database='ldch', pool_size=10, page_size=100, max_page_size=1000,
+                 cache_size=1000, cache_ttl=60, invalidation_interval=10):
+        self.client = pymongo.MongoClient(mongo_uri, maxPoolSize=pool_size)
+        self.db = self.client[database]
+        self.pool_size = pool_size
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.invalidation_interval = invalidation_interval
+        self.pending = {}
+        self.checked = None
+        self.checker = None
+
+        self.endpoints = {}
+        self.spiders = {}
+        for name, path in sorted(SPIDERS.items()):
+            klass = load_spiders([path])[0]
+            self.spiders[name] = klass
+            self.endpoints[name] = Endpoint.from_spider(klass, load_schema(self.db, klass))
+        self.endpoints['summaries'] = Endpoint(
+            aggregates.COLLECTION,
+            dict([('spider', str)] + [(name, str) for name in aggregates.SUMMARY_KEYS]),
+            object_ids=False
+        )
+        self.spider_collections = {endpoint.collection for name, endpoint in self.endpoints.items()
+                                   if name in SPIDERS}
+
+    @classmethod
+    def from_settings(cls, scrapy_settings):
+        return cls(
+            scrapy_settings.get('MONGO_URI'),
+            database=scrapy_settings.get('MONGO_DATABASE', 'ldch'),
+            pool_size=scrapy_settings.getint('API_MONGO_POOL_SIZE', 10),
+            page_size=scrapy_settings.getint('API_PAGE_SIZE', 100),
+            max_page_size=scrapy_settings.getint('API_MAX_PAGE_SIZE', 1000),
+            cache_size=scrapy_settings.getint('API_CACHE_SIZE', 1000),
+            cache_ttl=scrapy_settings.getfloat('API_CACHE_TTL', 60),
+            invalidation_interval=scrapy_settings.getfloat('API_INVALIDATION_INTERVAL', 10)
+        )
+
+    def resource(self):
+        root = IndexResource(self)
+        for name, endpoint in self.endpoints.items():
+            root.putChild(name.encode(), QueryResource(self, endpoint))
+        return root
+
+    def start(self, port, host='127.0.0.1'):
+        for endpoint in self.endpoints.values():
+            endpoint.ensure_indexes(self.db)
+        self.checked = self._last_change()
+        # as consultas ocupam uma thread cada; mais threads que conexões só formariam fila no pool
+        reactor.suggestThreadPoolSize(self.pool_size)
+        self.checker = task.LoopingCall(self.check_changes)
+        self.checker.start(self.invalidation_interval, now=False)
+        listening = reactor.listenTCP(port, _QuietSite(self.resource()), interface=host)
+        logger.info("API disponível em http://%s:%d/" % (host, listening.getHost().port))
+        return listening
+
+    def check_changes(self):
+        """Descarta o cache dos spiders com competências alteradas desde a última verificação.
+
+        Também relê o formato das coleções dos spiders; as que mudaram de
+        formato têm o cache descartado e os índices da API recriados.
+        """
+
+        d = threads.deferToThread(self._changed_spiders, self.checked)
+        d.addCallbacks(self._invalidate, self._check_failed)
+        d.addCallback(lambda _: threads.deferToThread(self._load_schemas))
+        d.addCallbacks(self._update_schemas, self._check_failed)
+        return d
+
+    def _last_change(self):
+        doc = self.db[planner.COLLECTION].find_one({'changed': {'$exists': True}}, {'changed': 1},
+                                                   sort=[('changed', pymongo.DESCENDING)])
+        return doc['changed'] if doc else None
+
+    def _changed_spiders(self, since):
+        query = {'changed': {'$gt': since}} if since else {'changed': {'$exists': True}}
+        spiders = set()
+        last = since
+        for doc in self.db[planner.COLLECTION].find(query, {'spider': 1, 'changed': 1}):
+            spiders.add(doc.get('spider'))
+            if last is None or doc['changed'] > last:
+                last = doc['changed']
+        return spiders, last
+
+    def _invalidate(self, result):
+        spiders, self.checked = result
+        changed = spiders & self.spider_collections
+        if changed:
+            logger.info("Novas competências em %s; cache descartado" % ', '.join(sorted(changed)))
+            self.cache.invalidate(changed | {aggregates.COLLECTION})
+
+    def _load_schemas(self):
+        return {name: load_schema(self.db, klass) for name, klass in self.spiders.items()}
+
+    def _update_schemas(self, schemas):
+        for name, schema in schemas.items():
+            endpoint = self.endpoints[name]
+            if endpoint.schema is not None and endpoint.schema.state() == schema.state():
+                continue
+            logger.info("Coleção %s agora no formato %s; cache descartado" % (endpoint.collection, schema.state()))
+            endpoint.schema = schema
+            self.cache.invalidate({endpoint.collection})
+            threads.deferToThread(endpoint.ensure_indexes, self.db).addErrback(self._check_failed)
+
+    def _check_failed(self, failure):
+        logger.error("Falha ao verificar alterações no banco: %s" % failure.getErrorMessage())
+
+
+def main():
+    scrapy_settings = Settings()
+    scrapy_settings.setmodule(settings)
+    configure_logging(scrapy_settings)
+
+    api = Api.from_settings(scrapy_settings)
+    api.start(scrapy_settings.getint('API_PORT', 8080), scrapy_settings.get('API_HOST', '127.0.0.1'))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+import collections
+import datetime
+import logging
+import threading
+from random import choice
+
+from twisted.internet import defer, reactor, threads
+
+from ldch import metrics
+from ldch.spiders.base import LRUCache, register_error, web_archive
+
+logger = logging.getLogger(__name__)
+
+
+class WebArchiveCache:
+    """Cache persistente das URLs arquivadas na web.archive.org.
+
+    As entradas ficam na coleção `WebArchive`, que tem um índice TTL para
+    descartá-las após `ttl` segundos, e as mais recentes também em memória.
+    Os métodos são bloqueantes e devem ser chamados fora do reactor.
+    """
+
+    def __init__(self, collection, ttl=30 * 24 * 3600, size=10000):
+        self.collection = collection
+        self.ttl = ttl
+        self.memory = LRUCache(size)
+        self.lock = threading.Lock()
+
+    def ensure_index(self):
+        self.collection.create_index('when', expireAfterSeconds=self.ttl)
+
+    def get(self, url):
+        with self.lock:
+            wa_url = self.memory.get(url)
+        if wa_url is not None:
+            return wa_url
+
+        entry = self.collection.find_one({'_id': url})
+        if entry is None:
+            return None
+        with self.lock:
+            self.memory.set(url, entry['web_archive'])
+        return entry['web_archive']
+
+    def set(self, url, wa_url):
+        with self.lock:
+            self.memory.set(url, wa_url)
+        self.collection.replace_one(
+            {'_id': url},
+            {'web_archive': wa_url, 'when': datetime.datetime.utcnow()},
+            upsert=True
+        )
+
+
+class WebArchiveQueue:
+    """Fila de arquivamento de páginas na web.archive.org.
+
+    As submissões rodam em threads, no máximo `concurrency` ao mesmo tempo,
+    para que o reactor nunca espere pela web.archive.org. Falhas são
+    repetidas `max_retries` vezes com espera exponencial a partir de
+    `backoff` segundos. Ao concluir, o documento da página em `Meta` recebe
+    o campo `web_archive`.
+
+    Páginas aguardando arquivamento são marcadas com `web_archive_pending`
+    em `Meta` e voltam para a fila na próxima execução caso o crawler seja
+    encerrado antes.
+    """
+
+    def __init__(self, db, base_url='http://web.archive.org', concurrency=2,
+                 max_pending=1000, timeout=60, max_retries=3, backoff=30,
+                 cache_ttl=30 * 24 * 3600, cache_size=10000, user_agents=None,
+                 proxy=None, stats=None, spider=None):
+        self.db = db
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.user_agents = user_agents
+        self.proxy = proxy
+        self.stats = stats
+        self.spider = spider
+        self.cache = WebArchiveCache(db['WebArchive'], cache_ttl, cache_size)
+
+        self.pending = collections.deque()
+        self.waiting = set()
+        self.active = 0
+        self.closing = False
+        self.closed = None
+
+    @classmethod
+    def from_settings(cls, settings, db, stats=None, spider=None):
+        proxy = None
+        if settings.getbool('ENABLE_TOR_PROXY'):
+            proxy = settings.get('HTTP_PROXY')
+        return cls(
+            db,
+            base_url=settings.get('WEB_ARCHIVE_URL', 'http://web.archive.org'),
+            concurrency=settings.getint('WEB_ARCHIVE_CONCURRENCY', 2),
+            max_pending=settings.getint('WEB_ARCHIVE_MAX_PENDING', 1000),
+            timeout=settings.getfloat('WEB_ARCHIVE_TIMEOUT', 60),
+            max_retries=settings.getint('WEB_ARCHIVE_MAX_RETRIES', 3),
+            backoff=settings.getfloat('WEB_ARCHIVE_BACKOFF', 30),
+            cache_ttl=settings.getint('WEB_ARCHIVE_CACHE_TTL', 30 * 24 * 3600),
+            cache_size=settings.getint('WEB_ARCHIVE_CACHE_SIZE', 10000),
+            user_agents=settings.getlist('USER_AGENTS'),
+            proxy=proxy,
+            stats=stats,
+            spider=spider
+        )
+
+    def __len__(self):
+        return len(self.pending) + len(self.waiting) + self.active
+
+    def start(self):
+        "Prepara o cache e recoloca na fila as páginas pendentes de execuções anteriores."
+
+        def _find_pending():
+            self.cache.ensure_index()
+            query = {'web_archive_pending': True}
+            fields = {'url': 1}
+            return list(self.db['Meta'].find(query, fields).limit(self.max_pending))
+
+        def _enqueue(pages):
+            for page in pages:
+                self.submit(page['url'], page['_id'])
+
+        d = threads.deferToThread(_find_pending)
+        d.addCallback(_enqueue)
+        d.addErrback(lambda f: logger.error("Falha ao carregar arquivamentos pendentes: %s" %
+                                            f.getErrorMessage()))
+        return d
+
+    def submit(self, url, page_id):
+        """Agenda o arquivamento de `url`.
+
+        Retorna False se a fila estiver cheia. Nesse caso a página continua
+        pendente em `Meta` e será arquivada numa próxima execução.
+        """
+
+        if self.closing or len(self) >= self.max_pending:
+            self._inc_stats('ldch/web_archive/deferred')
+            return False
+
+        self.pending.append((url, page_id, 0))
+        self._inc_stats('ldch/web_archive/submitted')
+        self._next()
+        return True
+
+    def close(self):
+        "Cancela as novas tentativas e espera as submissões em andamento."
+
+        self.closing = True
+        for call in list(self.waiting):
+            call.cancel()
+        self.waiting.clear()
+        self.pending.clear()
+
+        self.closed = defer.Deferred()
+        if not self.active:
+            self.closed.callback(None)
+        return self.closed
+
+    def _next(self):
+        while not self.closing and self.pending and self.active < self.concurrency:
+            job = self.pending.popleft()
+            self.active += 1
+            d = threads.deferToThread(self._archive, job[0], job[1])
+            d.addCallbacks(self._done, self._failed, errbackArgs=(job,))
+            d.addBoth(self._release)
+
+    def _release(self, _):
+        self.active -= 1
+        if self.closing:
+            if not self.active and self.closed is not None and not self.closed.called:
+                self.closed.callback(None)
+        else:
+            self._next()
+
+    def _archive(self, url, page_id):
+        wa_url = self.cache.get(url)
+        if wa_url is None:
+            user_agent = choice(self.user_agents) if self.user_agents else None
+            with metrics.registry.timer('web_archive', self.spider):
+                wa_url = web_archive(url, user_agent, self.proxy, self.base_url, self.timeout)
+            self.cache.set(url, wa_url)
+        self._update_page(page_id, wa_url)
+        return wa_url
+
+    def _update_page(self, page_id, wa_url):
+        self.db['Meta'].update_one(
+            {'_id': page_id},
+            {'$set': {'web_archive': wa_url}, '$unset': {'web_archive_pending': ''}}
+        )
+
+    def _done(self, wa_url):
+        self._inc_stats('ldch/web_archive/archived')
+
+    def _failed(self, failure, job):
+        url, page_id, attempt = job
+        if self.closing:
+            return
+
+        if attempt < self.max_retries:
+            self._inc_stats('ldch/web_archive/retries')
+            delay = self.backoff * 2 ** attempt
+            call = reactor.callLater(delay, self._retry, (url, page_id, attempt + 1))
+            self.waiting.add(call)
+            return
+
+        msg = "Falha ao registrar URL em web.archive.org: %s" % url
+        logger.error("%s (%s)" % (msg, failure.getErrorMessage()))
+        self._inc_stats('ldch/web_archive/failed')
+
+        def _give_up():
+            self._update_page(page_id, None)
+            register_error('web_archive_error', url=url)
+
+        # encadeado ao arquivamento, para que `_release` e `close` esperem a gravação
+        return threads.deferToThread(_give_up).addErrback(
+            lambda f: logger.error("Falha ao registrar erro de arquivamento: %s" %
+                                   f.getErrorMessage()))
+
+    def _retry(self, job):
+        self.waiting = {call for call in self.waiting if call.active()}
+        self.pending.append(job)
+        self._next()
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
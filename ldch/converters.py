@@ -0,0 +1,138 @@
+"""Conversão de valores e linhas raspadas de acordo com o `fields` dos spiders."""
+
+
+def parse_int(v):
+    return int(v.replace('.', ''))
+
+
+def parse_float(v):
+    return float(v.replace('.', '')
+                  .replace('%', '')
+                  .replace('R$', '')
+                  .replace(',', '.'))
+
+
+_SEPARATOR = '\x00'
+
+
+def _parse_float_column(column):
+    # aplica as substituições de `parse_float` uma única vez sobre a coluna
+    # inteira e deixa a conversão de cada célula para o `float` nativo
+    text = (_SEPARATOR.join(column)
+            .replace('.', '')
+            .replace('%', '')
+            .replace('R$', '')
+            .replace(',', '.'))
+    return text.split(_SEPARATOR), float
+
+
+def _parse_int_column(column):
+    return _SEPARATOR.join(column).replace('.', '').split(_SEPARATOR), int
+
+
+_COLUMN_PARSERS = {
+    parse_float: _parse_float_column,
+    parse_int: _parse_int_column
+}
+
+
+class RowConverter:
+    """Conversor de linhas compilado uma única vez a partir de um `fields`.
+
+    Produz os mesmos itens que a conversão célula a célula, mas converte
+    tabelas inteiras coluna a coluna: as colunas de `parse_float` e
+    `parse_int` são tratadas como um único texto, e as de `str` reaproveitam
+    os objetos de valores repetidos (cargos, tipos de servidor), guardando
+    até `cache_size` valores por coluna.
+
+    Os itens são instâncias de `item_class`, construída como um `dict`.
+    """
+
+    def __init__(self, fields, cache_size=10000, item_class=dict):
+        self.fields = tuple(fields)
+        self.item_class = item_class
+        self.names = tuple(name for name, _ in self.fields)
+        self.parsers = tuple(parser for _, parser in self.fields)
+        self.cache_size = cache_size
+        self.caches = tuple({} for _ in self.fields)
+
+    def list_to_item(self, args):
+        "Transforma uma lista num item, removendo espaços e tratando '' e '-' como vazios."
+
+        if len(args) != len(self.names):
+            raise ValueError("Quantidade de elementos diferente da de campos.")
+
+        result = self.item_class()
+        for name, parser, value in zip(self.names, self.parsers, args):
+            value = value.strip()
+            if value == '' or value == '-':
+                value = None
+            result[name] = parser(value)
+        return result
+
+    def dict_to_item(self, dict):
+        """Converte, no próprio dicionário, os valores dos campos.
+
+        Se o dicionário não for uma instância de `item_class`, retorna um
+        novo item com os valores convertidos.
+        """
+
+        if len(dict) != len(self.names):
+            raise ValueError("Length of dictionary is different from fields")
+        for name, parser in zip(self.names, self.parsers):
+            dict[name] = parser(dict[name])
+        if isinstance(dict, self.item_class):
+            return dict
+        return self.item_class((name, dict[name]) for name in self.names)
+
+    def convert_table(self, rows):
+        """Converte uma tabela (lista de listas) como `list_to_item`, coluna a coluna.
+
+        Equivale a `[self.list_to_item(row) for row in rows]`, exceto pela
+        ordem em que eventuais exceções são levantadas.
+        """
+
+        for row in rows:
+            if len(row) != len(self.names):
+                raise ValueError("Quantidade de elementos diferente da de campos.")
+        if not rows:
+            return []
+
+        columns = []
+        for column in zip(*rows):
+            column = list(map(str.strip, column))
+            if '' in column or '-' in column:
+                column = [None if v == '' or v == '-' else v for v in column]
+            columns.append(column)
+        return self.convert_columns(self.names, columns)
+
+    def convert_columns(self, names, columns):
+        """Converte colunas de valores, na ordem de `names`, em itens.
+
+        Os valores não passam por `strip` nem pelo tratamento de vazios,
+        como em `dict_to_item`.
+        """
+
+        index = dict(zip(self.names, range(len(self.names))))
+        converted = []
+        for name, column in zip(names, columns):
+            i = index[name]
+            converted.append(self._convert_column(i, column))
+        item_class = self.item_class
+        return [item_class(zip(names, values)) for values in zip(*converted)]
+
+    def _convert_column(self, i, column):
+        parser = self.parsers[i]
+
+        if parser in _COLUMN_PARSERS and None not in column:
+            cells, native = _COLUMN_PARSERS[parser](column)
+            if len(cells) == len(column):
+                return list(map(native, cells))
+
+        if parser is str and None not in column:
+            cache = self.caches[i]
+            if len(cache) > self.cache_size:
+                cache.clear()
+            return list(map(cache.setdefault, column, column))
+
+        return list(map(parser, column))
@@ -0,0 +1,173 @@
+"""Registro de erros em lotes, agrupados por assinatura.
+
+Cada erro gera um documento em `Errors` com a requisição (url, corpo,
+impressão digital), usado pelo `LdchDupeFilter` para ignorar requisições
+que falharam, e a sua `signature`. O traceback é guardado uma única vez
+por assinatura na coleção `ErrorGroups`, junto com a quantidade de
+ocorrências e as datas da primeira e da última:
+
+    _id         assinatura (SHA1 do tipo, spider, status e traceback)
+    type        tipo do erro
+    spider      nome do spider
+    traceback   traceback da primeira ocorrência
+    count       ocorrências
+    first_seen  primeira ocorrência
+    last_seen   última ocorrência
+    url         url da última ocorrência
+
+Os erros são acumulados em memória e gravados por um único cliente a cada
+`ERRORS_FLUSH_INTERVAL` segundos ou `ERRORS_BATCH_SIZE` erros, fora da
+thread do reactor. O registro é único por processo (`sink`) e é iniciado
+pelo `LdchSignalHandler`; fora de uma raspagem, inclusive durante o
+encerramento, os erros são gravados imediatamente por um cliente
+temporário.
+"""
+import hashlib
+import logging
+import re
+import threading
+
+import pymongo
+import pymongo.errors
+from twisted.internet import task, threads
+from twisted.python import threadable
+
+from ldch import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+# endereços de memória e números de linha não distinguem um erro de outro
+_VOLATILE = re.compile(r'0x[0-9a-fA-F]+|line \d+')
+
+
+def signature(error):
+    "Assinatura que agrupa ocorrências do mesmo erro."
+
+    trace = _VOLATILE.sub('', error.get('traceback') or '')
+    parts = (error['type'], error.get('spider') or '', str(error.get('status', '')), trace)
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+
+def _group_update(error):
+    return pymongo.UpdateOne(
+        {'_id': error['signature']},
+        {'$setOnInsert': {'type': error['type'], 'spider': error.get('spider'),
+                          'traceback': error.get('traceback')},
+         '$min': {'first_seen': error['when']},
+         '$max': {'last_seen': error['when']},
+         '$set': {'url': error.get('url')},
+         '$inc': {'count': 1}},
+        upsert=True
+    )
+
+
+class ErrorSink:
+    "Acumula erros e os grava em lotes."
+
+    def __init__(self, batch_size=100, flush_interval=5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.client = None
+        self.db = None
+        self.mongo_uri = settings.MONGO_URI
+        self.database = settings.MONGO_DATABASE
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.flusher = None
+        self.users = 0
+
+    def start(self, mongo_uri, database='ldch', batch_size=100, flush_interval=5):
+        "Passa a acumular os erros; cada `start` deve ter um `stop` correspondente."
+
+        if self.users == 0:
+            self.mongo_uri = mongo_uri
+            self.database = database
+            self.batch_size = batch_size
+            self.flush_interval = flush_interval
+            self.client = pymongo.MongoClient(mongo_uri)
+            self.db = self.client[database]
+            if flush_interval > 0:
+                self.flusher = task.LoopingCall(self._flush_in_thread)
+                self.flusher.start(flush_interval, now=False)
+        self.users += 1
+
+    def stop(self):
+        "Grava os erros pendentes e, quando ninguém mais usa o registro, fecha o cliente."
+
+        if self.users <= 0:
+            return
+        self.users -= 1
+        self.flush()
+        if self.users > 0:
+            return
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+        self.flusher = None
+        # espera uma gravação em andamento noutra thread antes de fechar o cliente
+        with self.write_lock:
+            self.client.close()
+            self.client = self.db = None
+
+    @property
+    def active(self):
+        return self.db is not None
+
+    def add(self, error):
+        "Acumula `error`; pode ser chamado de qualquer thread."
+
+        error['signature'] = signature(error)
+        with self.lock:
+            self.buffer.append(error)
+            # depois de `stop`, o erro é gravado na hora
+            full = len(self.buffer) >= self.batch_size or self.db is None
+        if full:
+            if self.db is not None and threadable.isInIOThread():
+                self._flush_in_thread()
+            else:
+                self.flush()
+
+    def flush(self):
+        "Grava os erros acumulados. Bloqueante."
+
+        with self.write_lock:
+            with self.lock:
+                errors, self.buffer = self.buffer, []
+            if not errors:
+                return
+            if self.db is not None:
+                write(self.db, errors)
+                return
+            with pymongo.MongoClient(self.mongo_uri) as client:
+                write(client[self.database], errors)
+
+    def _flush_in_thread(self):
+        if not self.buffer:
+            return
+        d = threads.deferToThread(self.flush)
+        d.addErrback(lambda f: logger.error("Falha ao gravar erros: %s" % f.getErrorMessage()))
+        return d
+
+
+def write(db, errors):
+    """Grava `errors` em `Errors` e atualiza os grupos em `ErrorGroups`.
+
+    Os erros devem ter `signature`. O traceback fica apenas no grupo.
+    """
+
+    spiders = {error.get('spider') for error in errors}
+    spider = spiders.pop() if len(spiders) == 1 else None
+    records = []
+    for error in errors:
+        record = dict(error)
+        record.pop('traceback', None)
+        records.append(record)
+    with metrics.registry.timer('register_error', spider):
+        try:
+            db['Errors'].insert_many(records, ordered=False)
+            db['ErrorGroups'].bulk_write([_group_update(error) for error in errors], ordered=False)
+        except pymongo.errors.PyMongoError:
+            logger.exception("Falha ao gravar %d erros" % len(errors))
+
+
+sink = ErrorSink()
@@ -0,0 +1,294 @@
+"""Exportação das coleções dos spiders para CSV e Parquet, para análise.
+
+Os documentos são lidos em lotes de `EXPORT_BATCH_SIZE`, apenas com os
+campos de `context_fields` e `fields` do spider, e gravados lote a lote,
+de modo que a memória usada não dependa do tamanho da coleção. No
+Parquet (requer o pacote `pyarrow`), as colunas de `parse_float` e `int`
+são gravadas como números. Coleções no formato compacto (veja
+`ldch.schema`) são exportadas com os nomes dos campos e valores em reais.
+
+    $ ldch_export ldch.spiders.tcm.TcmRemuneracaoSpider -o tcm.csv
+    $ ldch_export ldch.spiders.tcm.TcmRemuneracaoSpider -o tcm.parquet \\
+        --competencia 2017-01 2017-02 --municipio SALVADOR --meta
+
+Com `--chunk-rows`, a saída é dividida em arquivos numerados. Com
+`--incremental`, apenas os documentos gravados desde a exportação
+anterior para o mesmo arquivo são gravados, num arquivo com a data da
+exportação; o ponto de parada fica na coleção `Exports`. O momento da
+gravação é o campo `__updated`, renovado pelo pipeline também quando uma
+nova raspagem substitui uma linha pela chave natural, de modo que as
+linhas corrigidas voltam a ser exportadas; documentos anteriores a esse
+campo usam o momento de criação contido no `_id`. Linhas removidas não
+aparecem na exportação incremental. Documentos dos últimos
+`EXPORT_SETTLE_TIME` segundos ficam para a exportação seguinte, pois
+ainda podem estar sendo gravados por outros processos.
+"""
+import argparse
+import csv
+import datetime
+import os
+import sys
+import time
+
+from bson.objectid import ObjectId
+
+from ldch import settings
+from ldch.converters import parse_float, parse_int
+from ldch.schema import load_schema
+from ldch.spiders.base import Database, LRUCache, load_spiders
+
+COLLECTION = 'Exports'
+
+# campos de `Meta` incluídos com `--meta`
+META_FIELDS = (('url', str), ('when', datetime.datetime))
+
+FORMATS = ('csv', 'parquet')
+
+
+def columns(klass, meta=False):
+    "Lista de colunas exportadas de `klass`, com o tipo de cada uma."
+
+    result = [(name, str) for name in klass.context_fields]
+    for name, parser in klass.fields or ():
+        if parser in (parse_float, float):
+            result.append((name, float))
+        elif parser in (parse_int, int):
+            result.append((name, int))
+        else:
+            result.append((name, str))
+    if meta:
+        result.extend(META_FIELDS)
+    return result
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return value
+
+
+class CsvWriter:
+
+    def __init__(self, path, columns):
+        self.names = [name for name, _ in columns]
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.names)
+
+    def write(self, rows):
+        self.writer.writerows([_csv_value(row.get(name)) for name in self.names] for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("A exportação para Parquet requer o pacote `pyarrow`")
+
+        types = {str: pyarrow.string(), float: pyarrow.float64(), int: pyarrow.int64(),
+                 datetime.datetime: pyarrow.timestamp('ms')}
+        self.pyarrow = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+
+    def write(self, rows):
+        # cada lote vira um row group
+        arrays = [self.pyarrow.array([row.get(name) for row in rows], type=field.type)
+                  for (name, _), field in zip(self.columns, self.schema)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+class ChunkedOutput:
+    "Distribui as linhas entre arquivos de até `chunk_rows` linhas, ou um só arquivo."
+
+    def __init__(self, path, columns, format, chunk_rows=None):
+        self.stem, self.extension = os.path.splitext(path)
+        self.columns = columns
+        self.writer_class = WRITERS[format]
+        self.chunk_rows = chunk_rows
+        self.paths = []
+        self.writer = None
+        self.rows = 0
+
+    def write(self, rows):
+        while rows:
+            if self.writer is None:
+                self._open()
+            available = len(rows)
+            if self.chunk_rows:
+                available = min(available, self.chunk_rows - self.rows)
+            self.writer.write(rows[:available])
+            self.rows += available
+            rows = rows[available:]
+            if self.chunk_rows and self.rows >= self.chunk_rows:
+                self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.rows = 0
+
+    def _open(self):
+        if self.chunk_rows:
+            path = '%s-%05d%s' % (self.stem, len(self.paths), self.extension)
+        else:
+            path = self.stem + self.extension
+        self.paths.append(path)
+        self.writer = self.writer_class(path, self.columns)
+
+
+class MetaJoin:
+    "Acrescenta às linhas os campos do documento de `Meta` de cada uma."
+
+    def __init__(self, db, cache_size=10000):
+        self.collection = db['Meta']
+        self.cache = LRUCache(cache_size)
+
+    def apply(self, rows):
+        missing = {row['__meta'] for row in rows
+                   if '__meta' in row and row['__meta'] not in self.cache.data}
+        if missing:
+            fields = {name: 1 for name, _ in META_FIELDS}
+            for meta in self.collection.find({'_id': {'$in': list(missing)}}, fields):
+                self.cache.set(meta['_id'], meta)
+        for row in rows:
+            meta = self.cache.get(row.get('__meta')) or {}
+            for name, _ in META_FIELDS:
+                row[name] = meta.get(name)
+
+
+def export(db, klass, path, format='csv', filters=None, meta=False, chunk_rows=None,
+           incremental=False, batch_size=10000, settle_time=60):
+    """Exporta a coleção de `klass` para `path`.
+
+    `filters` associa campos a listas de valores aceitos. Retorna a
+    quantidade de linhas e a lista de arquivos gravados.
+    """
+
+    spider = klass()
+    collection = db[spider.name]
+    cols = columns(klass, meta)
+    schema = load_schema(db, klass)
+
+    query = {schema.key(field): {'$in': [schema.store_value(field, value) for value in values]}
+             for field, values in (filters or {}).items() if values}
+    state_id = until = None
+    if incremental:
+        # o ponto de parada é o momento da última gravação de cada documento
+        state_id = '%s:%s' % (spider.name, os.path.basename(path))
+        state = db[COLLECTION].find_one({'_id': state_id}) or {}
+        until = datetime.datetime.utcnow().replace(microsecond=0)
+        until -= datetime.timedelta(seconds=settle_time)
+        updated = {'$lt': until}
+        ids = {'$lt': ObjectId.from_datetime(until)}
+        if state.get('until'):
+            updated['$gte'] = state['until']
+            ids['$gte'] = ObjectId.from_datetime(state['until'])
+        query['$or'] = [{'__updated': updated}, {'__updated': {'$exists': False}, '_id': ids}]
+        stem, extension = os.path.splitext(path)
+        path = '%s-%s%s' % (stem, until.strftime('%Y%m%dT%H%M%S'), extension)
+
+    projection = {schema.key(name): 1 for name in schema.labels}
+    projection['_id'] = 0
+    if meta:
+        projection['__meta'] = 1
+    join = MetaJoin(db) if meta else None
+
+    output = ChunkedOutput(path, cols, format, chunk_rows)
+    total = 0
+    try:
+        cursor = collection.find(query, projection).batch_size(batch_size)
+        rows = []
+        for doc in cursor:
+            rows.append(schema.from_document(doc))
+            if len(rows) >= batch_size:
+                total += _write(output, join, rows)
+                rows = []
+        if rows:
+            total += _write(output, join, rows)
+    finally:
+        output.close()
+
+    if incremental:
+        db[COLLECTION].update_one(
+            {'_id': state_id},
+            {'$set': {'until': until, 'exported': datetime.datetime.now()}, '$inc': {'rows': total}},
+            upsert=True
+        )
+    return total, output.paths
+
+
+def _write(output, join, rows):
+    if join is not None:
+        join.apply(rows)
+    output.write(rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('spiders', nargs='+', metavar='spider',
+                        help="caminho completo da classe, ex. ldch.spiders.tcm.TcmRemuneracaoSpider")
+    parser.add_argument('-o', '--output',
+                        help="arquivo de saída (apenas com um spider); por padrão, o nome da coleção")
+    parser.add_argument('-d', '--directory', default='.', help="diretório dos arquivos de saída")
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help="formato de saída; por padrão, o da extensão de --output ou csv")
+    parser.add_argument('--competencia', nargs='+', help="competências exportadas, como gravadas")
+    parser.add_argument('--municipio', nargs='+', help="municípios exportados")
+    parser.add_argument('--meta', action='store_true', help="inclui a URL e a data da raspagem")
+    parser.add_argument('--chunk-rows', type=int, help="linhas por arquivo")
+    parser.add_argument('--incremental', action='store_true',
+                        help="exporta apenas os documentos novos desde a exportação anterior")
+    options = parser.parse_args()
+
+    spiders = load_spiders(options.spiders)
+    if spiders is None:
+        return 1
+    if options.output and len(spiders) > 1:
+        parser.error("--output só pode ser usado com um spider")
+
+    filters = {'Competência': options.competencia, 'Município': options.municipio}
+    with Database() as db:
+        for klass in spiders:
+            fields = klass.context_fields + tuple(name for name, _ in klass.fields or ())
+            unknown = [field for field, values in filters.items() if values and field not in fields]
+            if unknown:
+                parser.error("%s não tem o campo %s" % (klass.__name__, ', '.join(unknown)))
+
+            format = options.format
+            path = options.output
+            if path is None:
+                format = format or 'csv'
+                path = '%s.%s' % (klass().name, format)
+            elif format is None:
+                extension = os.path.splitext(path)[1].lstrip('.').lower()
+                format = extension if extension in FORMATS else 'csv'
+            path = os.path.join(options.directory, path)
+
+            start = time.time()
+            rows, paths = export(db, klass, path, format, filters, options.meta, options.chunk_rows,
+                                 options.incremental, settings.EXPORT_BATCH_SIZE,
+                                 settings.EXPORT_SETTLE_TIME)
+            print("%s: %d linhas em %s (%.1f s)" %
+                  (klass.__name__, rows, ', '.join(paths) or 'nenhum arquivo', time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""Armazenamentos compactos de impressões digitais para o `LdchDupeFilter`.
+
+As impressões digitais do Scrapy são hashes SHA1 em hexadecimal (40
+caracteres). Os armazenamentos abaixo guardam apenas os 20 bytes do
+digest e implementam a interface de conjunto usada pelo `RFPDupeFilter`:
+`add`, `update`, `in` e `len`. O modo é escolhido em
+`settings.DUPEFILTER_STORAGE`.
+"""
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
+from binascii import unhexlify
+
+DIGEST_SIZE = 20
+
+
+def digest(fp):
+    return unhexlify(fp)
+
+
+class _DigestArray:
+    "Sequência de digests de tamanho fixo sobre um buffer, usada com `bisect`."
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // DIGEST_SIZE
+
+    def __getitem__(self, i):
+        start = i * DIGEST_SIZE
+        return bytes(self.buffer[start:start + DIGEST_SIZE])
+
+    def __iter__(self):
+        for start in range(0, len(self.buffer), DIGEST_SIZE):
+            yield bytes(self.buffer[start:start + DIGEST_SIZE])
+
+
+class SortedFingerprints:
+    """Digests binários num único buffer ordenado.
+
+    As inclusões ficam num conjunto pequeno até que ele atinja uma fração
+    do buffer, quando são intercaladas num novo buffer ordenado. A busca é
+    binária: O(log n) comparações.
+    """
+
+    min_pending = 4096
+
+    def __init__(self, fingerprints=()):
+        self.sorted = bytearray()
+        self.pending = set()
+        self.update(fingerprints)
+
+    def __contains__(self, fp):
+        value = digest(fp)
+        return value in self.pending or self._search(value)
+
+    def __len__(self):
+        return len(self.sorted) // DIGEST_SIZE + len(self.pending)
+
+    def add(self, fp):
+        value = digest(fp)
+        if value in self.pending or self._search(value):
+            return
+        self.pending.add(value)
+        if len(self.pending) > max(self.min_pending, len(self) // 4):
+            self._merge()
+
+    def update(self, fingerprints):
+        for fp in fingerprints:
+            self.add(fp)
+
+    def _search(self, value):
+        array = _DigestArray(self.sorted)
+        i = bisect.bisect_left(array, value)
+        return i < len(array) and array[i] == value
+
+    def _merge(self):
+        if not self.pending:
+            return
+        merged = bytearray()
+        for value in heapq.merge(_DigestArray(self.sorted), sorted(self.pending)):
+            merged.extend(value)
+        self.sorted = merged
+        self.pending = set()
+
+
+class BloomFingerprints:
+    """Filtro de Bloom dimensionado para `capacity` elementos e taxa de falsos positivos `error_rate`.
+
+    Falsos positivos fazem o crawler ignorar uma requisição nova, portanto
+    a taxa deve ser pequena. Os índices são derivados do próprio digest, que
+    já é um hash uniforme.
+    """
+
+    def __init__(self, capacity=10000000, error_rate=0.0001, fingerprints=()):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.update(fingerprints)
+
+    def __contains__(self, fp):
+        bits = self.bits
+        for i in self._indexes(fp):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, fp):
+        added = False
+        bits = self.bits
+        for i in self._indexes(fp):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                bits[i >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def update(self, fingerprints):
+        for fp in fingerprints:
+            self.add(fp)
+
+    def _indexes(self, fp):
+        h1, h2 = struct.unpack_from('<QQ', digest(fp))
+        h2 |= 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+
+class MmapFingerprints(SortedFingerprints):
+    """Digests ordenados num arquivo mapeado em memória e reaproveitado entre execuções.
+
+    O arquivo é lido sob demanda pelo sistema operacional, sem ocupar a
+    memória do processo. Só vão para o arquivo as impressões digitais
+    confirmadas no banco (`confirm`), as das páginas gravadas em `Meta` e
+    dos erros ignorados em `Errors`; as das requisições vistas nesta
+    execução (`add`) ficam apenas em memória, já que podem não ter sido
+    baixadas.
+
+    Ao lado do arquivo, em `<path>.json`, fica o maior `_id` lido de cada
+    origem (`resume` e `advance`), de modo que o `LdchDupeFilter` só leia do
+    banco os documentos mais novos. Documentos removidos do banco continuam
+    no arquivo; apague-o para recriá-lo do zero.
+
+    Cada processo deve ter o seu arquivo (veja `shard_settings`).
+    """
+
+    def __init__(self, path, fingerprints=()):
+        self.path = path
+        self.state_path = path + '.json'
+        self.file = None
+        self.sorted = b''
+        self.pending = set()
+        self.confirmed = set()
+        self.state = {}
+        self.discarded = False
+        if os.path.exists(path) and os.path.getsize(path) >= DIGEST_SIZE:
+            self.file = open(path, 'rb')
+            self.sorted = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        self.update(fingerprints)
+
+    def __contains__(self, fp):
+        value = digest(fp)
+        return value in self.pending or value in self.confirmed or self._search(value)
+
+    def __len__(self):
+        return len(_DigestArray(self.sorted)) + len(self.confirmed) + len(self.pending)
+
+    def add(self, fp):
+        value = digest(fp)
+        if value in self.pending or value in self.confirmed or self._search(value):
+            return
+        self.pending.add(value)
+
+    def confirm(self, fp):
+        "Inclui `fp`, registrada no banco, e a mantém no arquivo."
+
+        value = digest(fp)
+        self.pending.discard(value)
+        if not self._search(value):
+            self.confirmed.add(value)
+
+    def resume(self, sources):
+        """Maior `_id` já incluído no arquivo de cada uma de `sources`.
+
+        Se as origens mudaram (as configurações `SKIP_FAILED_URLS_*`, por
+        exemplo), o conteúdo do arquivo é descartado e será refeito.
+        """
+
+        if self.state.get('sources') != list(sources):
+            self._release()
+            self.discarded = True
+            self.state = {'sources': list(sources), 'high_water': {}}
+        return dict(self.state['high_water'])
+
+    def advance(self, source, value):
+        "Registra `value` como o maior `_id` incluído de `source`, gravado em `close`."
+
+        self.state.setdefault('high_water', {})[source] = value
+
+    def close(self):
+        if self.confirmed or self.discarded:
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                for value in heapq.merge(_DigestArray(self.sorted), sorted(self.confirmed)):
+                    f.write(value)
+            self._release()
+            os.replace(tmp, self.path)
+        else:
+            self._release()
+        # depois do arquivo: se a gravação for interrompida, os documentos são apenas relidos
+        if self.state:
+            tmp = '%s.%d.tmp' % (self.state_path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.state_path)
+        self.pending = set()
+        self.confirmed = set()
+        self.discarded = False
+
+    def _merge(self):
+        pass
+
+    def _release(self):
+        if self.file is not None:
+            self.sorted.close()
+            self.file.close()
+            self.file = None
+        self.sorted = b''
+
+
+def from_settings(settings):
+    "Cria o armazenamento de impressões digitais configurado em `settings`."
+
+    storage = settings.get('DUPEFILTER_STORAGE', 'set')
+    if storage == 'set':
+        return set()
+    if storage == 'sorted':
+        return SortedFingerprints()
+    if storage == 'bloom':
+        return BloomFingerprints(
+            capacity=settings.getint('DUPEFILTER_BLOOM_CAPACITY', 10000000),
+            error_rate=settings.getfloat('DUPEFILTER_BLOOM_ERROR_RATE', 0.0001)
+        )
+    if storage == 'mmap':
+        return MmapFingerprints(settings.get('DUPEFILTER_FINGERPRINT_FILE', 'fingerprints.bin'))
+    raise ValueError("Armazenamento de impressões digitais desconhecido: %s" % storage)
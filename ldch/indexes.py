@@ -0,0 +1,89 @@
+"""Índices das coleções do banco, criados no início de cada raspagem.
+
+Além dos índices comuns (`Meta`, `Errors`, `Coverage`), cada spider pode
+declarar:
+
+    natural_key     campos que identificam uma linha; os itens são gravados
+                    com upserts por essa chave, de modo que repetir uma
+                    raspagem não duplique as linhas
+    indexes         índices adicionais da coleção do spider, usados nas
+                    consultas dos analistas
+
+Os campos são os nomes usados nos documentos da coleção (veja
+`ldch.schema`). `create_index` não faz nada quando o índice já existe.
+"""
+import logging
+
+import pymongo.errors
+
+logger = logging.getLogger(__name__)
+
+# índices comuns a todas as raspagens: coleção e lista de campos
+COMMON_INDEXES = (
+    ('Meta', ('url', 'request_body')),
+    ('Meta', ('spider',)),
+    ('Errors', ('type',)),
+    ('Errors', ('spider', 'type')),
+    ('Errors', ('signature',)),
+    ('ErrorGroups', ('spider', 'type')),
+    ('Coverage', ('spider',)),
+    ('Coverage', ('changed',)),
+    ('Summaries', ('spider', 'Competência')),
+    ('Summaries', ('spider', 'Município')),
+)
+
+
+def _keys(fields):
+    return [(field, pymongo.ASCENDING) for field in fields]
+
+
+def natural_key_filter(item, natural_key):
+    """Filtro do upsert de `item` ou None se algum campo da chave estiver vazio.
+
+    Linhas sem a chave completa não podem ser identificadas e são apenas
+    inseridas.
+    """
+
+    query = {}
+    for field in natural_key:
+        value = item.get(field)
+        if value is None or value == '':
+            return None
+        query[field] = value
+    return query
+
+
+def ensure_indexes(db, spider, schema=None):
+    "Cria os índices comuns e os da coleção de `spider`, com os nomes de campos de `schema`."
+
+    def stored(fields):
+        return tuple(schema.key(field) for field in fields) if schema is not None else tuple(fields)
+
+    for collection, fields in COMMON_INDEXES:
+        db[collection].create_index(_keys(fields), background=True)
+
+    collection = db[spider.name]
+    # usado para substituir os itens de páginas raspadas novamente
+    collection.create_index('__meta', background=True)
+    # usado pela exportação incremental (veja `ldch.export`)
+    collection.create_index('__updated', background=True)
+    for fields in getattr(spider, 'indexes', ()):
+        collection.create_index(_keys(stored(fields)), background=True)
+
+    natural_key = getattr(spider, 'natural_key', None)
+    if natural_key:
+        natural_key = stored(natural_key)
+        # a chave mudou desde a criação do índice (campos incluídos, por exemplo)
+        existing = collection.index_information().get('natural_key')
+        if existing is not None and [field for field, _ in existing['key']] != list(natural_key):
+            logger.info("Recriando o índice natural_key de %s com %s" % (spider.name, ', '.join(natural_key)))
+            collection.drop_index('natural_key')
+        try:
+            collection.create_index(_keys(natural_key), unique=True, background=True,
+                                    name='natural_key')
+        except pymongo.errors.OperationFailure:
+            # linhas duplicadas de raspagens anteriores impedem a unicidade;
+            # os upserts continuam funcionando, só sem a garantia do banco
+            logger.warning("Coleção %s tem linhas repetidas em %s; índice criado sem unicidade" %
+                           (spider.name, ', '.join(natural_key)))
+            collection.create_index(_keys(natural_key), background=True, name='natural_key')
@@ -0,0 +1,250 @@
+"""Histogramas de tempo das etapas do crawler e endpoint HTTP para consultá-los.
+
+As etapas são medidas em segundos e identificadas pelo nome do spider:
+
+    download        latência de download (`download_latency` do Scrapy)
+    parse           tempo gasto dentro dos callbacks, por resposta
+    conversion      conversão de tabelas e lotes de linhas em itens
+    meta            resolução do documento de `Meta` de cada item (amostrada)
+    mongo_write     gravação de um lote de itens
+    web_archive     submissão de uma página à web.archive.org
+    register_error  gravação de um lote de erros em `Errors` (veja `ldch.errors`)
+    summaries       recálculo dos resumos alterados (veja `ldch.aggregates`)
+    parse_pool      espera e conversão de uma resposta no pool de parse (veja `ldch.offload`)
+
+As etapas medidas por item só são cronometradas numa fração
+`METRICS_SAMPLE_RATE` das vezes; as contagens delas são de amostras.
+
+O registro é único por processo (`registry`) e pode ser consultado em
+`http://<METRICS_HOST>:<METRICS_PORT>/metrics`, no formato de texto do
+Prometheus, ou em `/metrics.json`.
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+from random import random
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+logger = logging.getLogger(__name__)
+
+# Limites superiores dos intervalos, de 100 µs a ~105 s, dobrando a cada intervalo
+BOUNDS = tuple(0.0001 * 2 ** i for i in range(21))
+
+
+class Histogram:
+    "Contagem de observações em intervalos exponenciais fixos."
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        "Estimativa do quantil `q`: o limite superior do intervalo que o contém."
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(BOUNDS, self.counts):
+            total += n
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.sum,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+
+class _Timer:
+
+    __slots__ = ('metrics', 'stage', 'spider', 'start')
+
+    def __init__(self, metrics, stage, spider):
+        self.metrics = metrics
+        self.stage = stage
+        self.spider = spider
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.stage, self.spider, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Registro de histogramas por etapa e spider.
+
+    `observe` pode ser chamado de qualquer thread. Também guarda as
+    estatísticas do Scrapy de cada spider para exibi-las no endpoint.
+    """
+
+    def __init__(self, enabled=True, sample_rate=1.0):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.histograms = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
+        self.enabled = settings.getbool('METRICS_ENABLED', True)
+        self.sample_rate = settings.getfloat('METRICS_SAMPLE_RATE', 1.0)
+
+    def observe(self, stage, spider, seconds):
+        if not self.enabled:
+            return
+        key = (stage, spider or '')
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def sampled(self):
+        "Indica se a observação atual de uma etapa por item deve ser cronometrada."
+
+        return self.enabled and (self.sample_rate >= 1 or random() < self.sample_rate)
+
+    def timer(self, stage, spider=None, sampled=False):
+        "Gerenciador de contexto que registra o tempo do bloco em `stage`."
+
+        if not self.enabled or (sampled and not self.sampled()):
+            return _NULL_TIMER
+        return _Timer(self, stage, spider)
+
+    def summary(self, spider=None):
+        "Resumo dos histogramas, por spider e etapa, opcionalmente de um único spider."
+
+        with self.lock:
+            items = list(self.histograms.items())
+        result = {}
+        for (stage, name), histogram in sorted(items):
+            if spider is None or name == spider:
+                result.setdefault(name, {})[stage] = histogram.summary()
+        return result
+
+    def render(self):
+        "Histogramas e estatísticas no formato de texto do Prometheus."
+
+        with self.lock:
+            items = [(key, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()]
+        lines = [
+            '# TYPE ldch_stage_seconds histogram'
+        ]
+        for (stage, spider), counts, count, total in sorted(items):
+            labels = 'stage="%s",spider="%s"' % (stage, spider)
+            cumulative = 0
+            for bound, n in zip(BOUNDS, counts):
+                cumulative += n
+                lines.append('ldch_stage_seconds_bucket{%s,le="%g"} %d' % (labels, bound, cumulative))
+            lines.append('ldch_stage_seconds_bucket{%s,le="+Inf"} %d' % (labels, count))
+            lines.append('ldch_stage_seconds_sum{%s} %f' % (labels, total))
+            lines.append('ldch_stage_seconds_count{%s} %d' % (labels, count))
+
+        lines.append('# TYPE ldch_sample_rate gauge')
+        lines.append('ldch_sample_rate %g' % self.sample_rate)
+
+        lines.append('# TYPE ldch_scrapy_stat gauge')
+        for spider, stats in sorted(self.stats.items()):
+            for key, value in sorted(stats.get_stats().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('ldch_scrapy_stat{spider="%s",key="%s"} %g' % (spider, key, value))
+        return '\n'.join(lines) + '\n'
+
+    def render_json(self):
+        stats = {}
+        for spider, collector in self.stats.items():
+            stats[spider] = {key: value for key, value in collector.get_stats().items()
+                             if isinstance(value, (int, float))}
+        return json.dumps({
+            'sample_rate': self.sample_rate,
+            'stages': self.summary(),
+            'stats': stats
+        }, sort_keys=True)
+
+
+registry = Metrics()
+
+
+class MetricsResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        if request.path.rstrip(b'/').endswith(b'.json'):
+            request.setHeader(b'Content-Type', b'application/json')
+            return self.metrics.render_json().encode()
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self.metrics.render().encode()
+
+
+class _QuietSite(server.Site):
+
+    def log(self, request):
+        pass
+
+
+class MetricsServer:
+    "Endpoint HTTP compartilhado pelos crawlers do processo."
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.port = None
+        self.users = 0
+
+    def start(self, port, host='127.0.0.1'):
+        if self.port is None:
+            self.port = reactor.listenTCP(port, _QuietSite(MetricsResource(self.metrics)),
+                                          interface=host)
+            logger.info("Métricas disponíveis em http://%s:%d/metrics" %
+                        (host, self.port.getHost().port))
+        self.users += 1
+
+    def stop(self):
+        self.users -= 1
+        if self.users <= 0 and self.port is not None:
+            d = self.port.stopListening()
+            self.port = None
+            return d
+
+
+metrics_server = MetricsServer(registry)
@@ -0,0 +1,233 @@
+"""Conversão das respostas grandes fora da thread do reactor.
+
+Com `PARSE_POOL_ENABLED`, os callbacks que extraem as tabelas (o
+`parse_tabela` do TCE e o `extrair_tabela` do TCM) enviam o corpo da
+resposta e os metadados necessários a uma função de módulo executada num
+pool, em vez de fazer o parse na thread do reactor. O callback retorna um
+Deferred com o lote de itens, e o reactor continua recebendo respostas e
+enviando requisições enquanto isso. Só atravessam a fronteira do pool o
+corpo, os textos do contexto e, na volta, os nomes e os valores dos
+campos dos itens, com os quais o reactor recria os itens.
+
+`PARSE_POOL_MODE` escolhe o pool:
+
+    thread      threads do próprio processo; só há ganho nos trechos que
+                liberam o GIL (o parse do HTML pelo lxml)
+    process     processos (`concurrent.futures`), que convertem em paralelo
+                de fato; os corpos são copiados para os processos
+
+No máximo `PARSE_POOL_WORKERS` conversões rodam ao mesmo tempo e as
+demais aguardam numa fila. Quando a fila chega a `PARSE_POOL_QUEUE_SIZE`
+respostas, o `ParsePoolMiddleware` segura as novas requisições até que
+ela diminua, de modo que os downloads não se acumulem além do que o pool
+consegue converter (as requisições já em andamento ainda podem somar até
+`CONCURRENT_REQUESTS` respostas à fila). O tempo entre o envio e o resultado é medido na etapa
+`parse_pool` (veja `ldch.metrics`) e as esperas ficam nas estatísticas
+`ldch/parse_pool/*`.
+"""
+import collections
+import logging
+import time
+
+import scrapy.exceptions
+import scrapy.signals
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, threadpool
+
+from ldch import metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ('thread', 'process')
+
+
+def collect_items(items):
+    """Consome `items` num worker do pool.
+
+    Retorna os valores dos itens, agrupados em sequências de itens com os
+    mesmos campos, e a exceção que interrompeu a geração ou None, para que
+    ela seja levantada no reactor depois dos itens anteriores, como num
+    callback executado diretamente. Tuplas de valores custam bem menos
+    para serializar que os próprios itens.
+    """
+
+    runs = []
+    names = None
+    try:
+        for item in items:
+            keys = tuple(item.keys())
+            if keys != names:
+                names = keys
+                rows = []
+                runs.append((names, rows))
+            rows.append(tuple(item.values()))
+    except Exception as e:
+        return runs, e
+    return runs, None
+
+
+def iterate_items(result, item_class=dict):
+    "Gera os itens de um resultado de `collect_items` e levanta a exceção, se houver."
+
+    runs, error = result
+    for names, rows in runs:
+        for values in rows:
+            yield item_class(zip(names, values))
+    if error is not None:
+        raise error
+
+
+class ParsePool:
+    "Pool de threads ou processos com fila limitada para as conversões das respostas."
+
+    def __init__(self, mode='process', workers=2, queue_size=4, stats=None, name=None):
+        if mode not in MODES:
+            raise ValueError("PARSE_POOL_MODE deve ser um de %s" % ', '.join(MODES))
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = stats
+        self.name = name
+        self.running = 0
+        self.queue = collections.deque()
+        self.waiting = []
+        self.pool = None
+
+    @classmethod
+    def from_settings(cls, settings, stats=None, name=None):
+        return cls(
+            mode=settings.get('PARSE_POOL_MODE', 'process'),
+            workers=settings.getint('PARSE_POOL_WORKERS', 2),
+            queue_size=settings.getint('PARSE_POOL_QUEUE_SIZE', 4),
+            stats=stats,
+            name=name
+        )
+
+    def start(self):
+        if self.mode == 'thread':
+            self.pool = threadpool.ThreadPool(self.workers, self.workers, name='ldch-parse')
+            self.pool.start()
+        else:
+            import concurrent.futures
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    def close(self):
+        if self.pool is None:
+            return
+        if self.mode == 'thread':
+            self.pool.stop()
+        else:
+            self.pool.shutdown(wait=False)
+        self.pool = None
+        # libera as requisições que ainda aguardavam espaço na fila
+        self._release(force=True)
+
+    @property
+    def full(self):
+        return len(self.queue) >= self.queue_size
+
+    def submit(self, func, *args):
+        """Executa `func(*args)` no pool; retorna um Deferred com o resultado.
+
+        `func` e os argumentos precisam ser serializáveis com pickle no modo
+        `process`.
+        """
+
+        d = defer.Deferred()
+        self.queue.append((func, args, d, time.time()))
+        self._inc_stats('ldch/parse_pool/submitted')
+        if self.stats is not None:
+            self.stats.max_value('ldch/parse_pool/queue_max', len(self.queue))
+        self._run()
+        return d
+
+    def wait(self):
+        "Deferred disparado quando a fila deixar de estar cheia, ou None se ela não está."
+
+        if not self.full:
+            return None
+        d = defer.Deferred()
+        self.waiting.append((d, time.time()))
+        self._inc_stats('ldch/parse_pool/backpressure')
+        return d
+
+    def _run(self):
+        while self.queue and self.running < self.workers:
+            func, args, d, submitted = self.queue.popleft()
+            self.running += 1
+            self._start(func, args).addBoth(self._done, d, submitted)
+        self._release()
+
+    def _start(self, func, args):
+        if self.mode == 'thread':
+            return threads.deferToThreadPool(reactor, self.pool, func, *args)
+
+        d = defer.Deferred()
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(lambda future: reactor.callFromThread(self._resolve, future, d))
+        return d
+
+    @staticmethod
+    def _resolve(future, d):
+        try:
+            result = future.result()
+        except Exception:
+            d.errback(failure.Failure())
+        else:
+            d.callback(result)
+
+    def _done(self, result, d, submitted):
+        self.running -= 1
+        metrics.registry.observe('parse_pool', self.name, time.time() - submitted)
+        self._run()
+        d.callback(result)
+
+    def _release(self, force=False):
+        if self.full and not force:
+            return
+        waiting, self.waiting = self.waiting, []
+        now = time.time()
+        for d, since in waiting:
+            if self.stats is not None:
+                self.stats.inc_value('ldch/parse_pool/backpressure_time', now - since)
+            d.callback(None)
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+
+class ParsePoolMiddleware:
+    """Middleware de download que cria o `ParsePool` do spider e limita a fila dele.
+
+    O pool fica em `spider.parse_pool` enquanto o spider estiver aberto.
+    Requisições feitas com a fila cheia aguardam, ocupando o seu lugar na
+    concorrência do downloader, até que o pool converta as respostas já
+    recebidas.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PARSE_POOL_ENABLED', False):
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(ParsePool.from_settings(crawler.settings, crawler.stats))
+        crawler.signals.connect(middleware.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=scrapy.signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.pool.name = spider.name
+        self.pool.start()
+        spider.parse_pool = self.pool
+        logger.info("Conversões de %s no pool de parse (%s, %d workers)" %
+                    (spider.name, self.pool.mode, self.pool.workers))
+
+    def spider_closed(self, spider):
+        spider.parse_pool = None
+        self.pool.close()
+
+    def process_request(self, request, spider):
+        return self.pool.wait()
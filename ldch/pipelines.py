@@ -0,0 +1,454 @@
+import datetime
+import logging
+import time
+
+import pymongo
+import pymongo.errors
+from scrapy.utils.request import request_fingerprint
+from twisted.internet import task
+
+from ldch import metrics
+from ldch.aggregates import SummaryUpdater
+from ldch.archive import WebArchiveQueue
+from ldch.indexes import ensure_indexes, natural_key_filter
+from ldch.planner import page_parsed, record_coverage
+from ldch.schema import WRITER_TIMEOUT, Item, Schema, load_schema, mark_writing, unmark_writing
+from ldch.store import RawStore, content_hash
+from ldch.spiders.base import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class LdchPageMiddleware:
+    """Middleware de spider que associa os itens à página de origem.
+
+    Todos os itens gerados a partir de uma mesma resposta compartilham o
+    mesmo dicionário em `__page`, usado pelo `LdchMongoPipeline` para criar
+    o documento em `Meta`.
+
+    Respostas com `cobertura` em `meta` (veja `ldch.planner`) têm o
+    conteúdo comparado ao da raspagem anterior: se não mudou, o callback
+    não é executado, portanto as requisições seguintes não devem depender
+    da saída dele (veja `TcmRemuneracaoSpider.extrair_tabela`). Ao final,
+    o sinal `page_parsed` é enviado com a quantidade de itens gerados.
+    """
+
+    def __init__(self, crawler=None):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        page = None
+        cobertura = response.meta.get('cobertura')
+        if cobertura is not None:
+            page = self._page(response)
+            page['cobertura'] = cobertura
+            if cobertura.get('hash') == page['hash']:
+                page['unchanged'] = True
+                self._page_parsed(page, spider)
+                return
+            page['replace'] = cobertura.get('refresh', False)
+
+        # o tempo gasto dentro do callback é medido a cada item obtido
+        rows = 0
+        parse_time = 0
+        result = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(result)
+            except StopIteration:
+                break
+            finally:
+                parse_time += time.perf_counter() - start
+
+            if isinstance(item, (dict, Item)):
+                if page is None:
+                    page = self._page(response)
+                item['__page'] = page
+                rows += 1
+            yield item
+        metrics.registry.observe('parse', spider.name, parse_time)
+
+        if page is not None and cobertura is not None:
+            page['rows'] = rows
+            self._page_parsed(page, spider)
+
+    def _page(self, response):
+        request = response.request
+        callback = request.callback
+        return {
+            'url': response.url,
+            'request_body': request.body.decode(),
+            'method': request.method,
+            'fingerprint': request_fingerprint(request),
+            'hash': content_hash(response.body),
+            'body': response.body,
+            'callback': callback.__name__ if callable(callback) else 'parse',
+            'callback_meta': {key: value for key, value in request.meta.items()
+                              if isinstance(value, (str, int, float, bool)) and
+                              not key.startswith('download_')},
+            'content_type': response.headers.get('Content-Type', b'').decode('latin-1')
+        }
+
+    def _page_parsed(self, page, spider):
+        if self.crawler is not None:
+            self.crawler.signals.send_catch_log(signal=page_parsed, page=page, spider=spider)
+
+
+class LdchMongoPipeline:
+    """Salva itens no banco de dados em lotes.
+
+    Mantém um único cliente por crawler e acumula os itens por coleção,
+    gravando-os quando o lote atinge `MONGO_BATCH_SIZE` itens, a cada
+    `MONGO_FLUSH_INTERVAL` segundos e no fechamento do spider. Itens de
+    spiders com `natural_key` são gravados com upserts por essa chave;
+    os demais, com `insert_many`. Os índices são criados ao abrir o spider
+    (veja `ldch.indexes`).
+
+    O documento de `Meta` é resolvido uma única vez por resposta e os
+    identificadores recentes ficam num cache LRU de `MONGO_META_CACHE_SIZE`
+    entradas. Páginas GET novas são enviadas à `WebArchiveQueue`.
+
+    Páginas com `cobertura` são registradas em `Coverage` depois que
+    todos os seus itens foram gravados. Com `AGGREGATES_ENABLED`, os
+    resumos dos grupos alterados são recalculados após cada gravação
+    (veja `ldch.aggregates`). Com `RAW_STORE_ENABLED`, o corpo
+    das respostas é gravado em `Raw` (veja `ldch.store`) e referenciado
+    em `Meta`, junto com o callback e os metadados da requisição.
+
+    Os documentos seguem o formato registrado da coleção (veja
+    `ldch.schema`); coleções novas usam `ITEM_STORAGE_COMPACT` e
+    `ITEM_STORAGE_CENTS`. As gravações são registradas em `Schemas` para
+    que `ldch_schema` não converta a coleção durante a raspagem.
+    """
+
+    def __init__(self, mongo_uri, database='ldch', batch_size=1000, flush_interval=5,
+                 meta_cache_size=10000, settings=None, stats=None):
+        self.mongo_uri = mongo_uri
+        self.database = database
+        self.settings = settings
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.pages = LRUCache(meta_cache_size)
+        self.client = None
+        self.db = None
+        self.buffers = {}
+        self.flusher = None
+        self.archive = None
+        self.raw_store = None
+        self.natural_keys = {}
+        self.schemas = {}
+        self.summaries = {}
+        # coleção -> (instante registrado em `Schemas`, momento do registro)
+        self.writing = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            crawler.settings.get('MONGO_URI'),
+            database=crawler.settings.get('MONGO_DATABASE', 'ldch'),
+            batch_size=crawler.settings.getint('MONGO_BATCH_SIZE', 1000),
+            flush_interval=crawler.settings.getfloat('MONGO_FLUSH_INTERVAL', 5),
+            meta_cache_size=crawler.settings.getint('MONGO_META_CACHE_SIZE', 10000),
+            settings=crawler.settings,
+            stats=crawler.stats
+        )
+        crawler.signals.connect(pipeline.page_parsed, signal=page_parsed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.db = self.client[self.database]
+        if self.settings is None:
+            schema = Schema(type(spider))
+        else:
+            schema = load_schema(self.db, type(spider),
+                                 compact=self.settings.getbool('ITEM_STORAGE_COMPACT', False),
+                                 cents=self.settings.getbool('ITEM_STORAGE_CENTS', False))
+        self.schemas[spider.name] = schema
+        self._mark_writing(spider.name)
+        natural_key = getattr(spider, 'natural_key', None)
+        self.natural_keys[spider.name] = natural_key and tuple(schema.key(field) for field in natural_key)
+        if self.settings is None or self.settings.getbool('MONGO_ENSURE_INDEXES', True):
+            ensure_indexes(self.db, spider, schema)
+        if self.settings is not None and self.settings.getbool('AGGREGATES_ENABLED', True):
+            summaries = SummaryUpdater.from_spider(self.db, spider,
+                                                   self.settings.getfloat('AGGREGATES_TETO'), schema)
+            if summaries is not None:
+                self.summaries[spider.name] = summaries
+        if self.settings is not None and self.settings.getbool('RAW_STORE_ENABLED', True):
+            self.raw_store = RawStore(self.db, self.settings.getint('RAW_STORE_COMPRESSION', 6))
+        if self.settings is not None and self.settings.getbool('WEB_ARCHIVE_ENABLED', True):
+            self.archive = WebArchiveQueue.from_settings(self.settings, self.db, self.stats,
+                                                         spider.name)
+            self.archive.start()
+        if self.flush_interval > 0:
+            self.flusher = task.LoopingCall(self.flush_all)
+            self.flusher.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+        self.flush_all()
+        since = self.writing.pop(spider.name, None)
+        if since is not None:
+            try:
+                unmark_writing(self.db, spider.name, since[0])
+            except pymongo.errors.PyMongoError:
+                logger.exception("Falha ao atualizar Schemas para %s" % spider.name)
+        if self.archive is None:
+            self.client.close()
+            return
+        d = self.archive.close()
+        d.addBoth(lambda _: self.client.close())
+        return d
+
+    def process_item(self, item, spider):
+        page = item.pop('__page', None)
+        created = None
+        if page is not None:
+            try:
+                with metrics.registry.timer('meta', spider.name, sampled=True):
+                    page_id, created = self.resolve_page(page, spider.name)
+            except pymongo.errors.PyMongoError:
+                logger.exception("Falha ao registrar página %s" % page['url'])
+                page['failed'] = True
+                return item
+            item['__meta'] = page_id
+            page['pending'] = page.get('pending', 0) + 1
+
+        buffer = self.buffers.setdefault(spider.name, [])
+        buffer.append((item, page, created))
+        if len(buffer) >= self.batch_size:
+            self.flush(spider.name)
+        return item
+
+    def resolve_page(self, page, collection=None):
+        """Busca ou cria o documento de `page` em `Meta`.
+
+        Retorna o identificador do documento e, caso ele tenha sido criado
+        agora, o mesmo identificador no segundo elemento da tupla. Se a
+        página substitui uma raspagem anterior, os itens antigos dela são
+        removidos de `collection`.
+        """
+
+        page_id, created = self._find_page(page, collection)
+        body = page.pop('body', None)
+        if page.pop('replace', False) and created is None and collection is not None:
+            if collection in self.summaries:
+                self.summaries[collection].touch_page(page_id)
+            self.db[collection].delete_many({'__meta': page_id})
+            fields = self._raw_fields(page, body)
+            if fields:
+                self.db['Meta'].update_one({'_id': page_id}, {'$set': fields})
+        return page_id, created
+
+    def _raw_fields(self, page, body):
+        "Grava o corpo da página em `Raw` e retorna os campos que o referenciam em `Meta`."
+
+        if self.raw_store is None or body is None:
+            return {}
+        raw = self.raw_store.put(body, page.get('hash'))
+        if raw is None:
+            logger.warning("Resposta grande demais para ser armazenada: %s" % page['url'])
+            return {}
+        return {
+            'raw': raw,
+            'method': page['method'],
+            'callback': page['callback'],
+            'callback_meta': page['callback_meta'],
+            'content_type': page['content_type']
+        }
+
+    def _find_page(self, page, collection=None):
+        if '_id' in page:
+            self._inc_stats('ldch/meta/response_hits')
+            return page['_id'], None
+
+        key = (page['url'], page['request_body'])
+        page_id = self.pages.get(key)
+        if page_id is not None:
+            self._inc_stats('ldch/meta/cache_hits')
+            page['_id'] = page_id
+            return page_id, None
+
+        self._inc_stats('ldch/meta/cache_misses')
+        query = {
+            'url': page['url'],
+            'request_body': page['request_body']
+        }
+        meta = self.db['Meta'].find_one(query, {'_id': 1})
+        if meta:
+            created = None
+            page_id = meta['_id']
+        else:
+            archive = self.archive is not None and page['method'] == 'GET'
+            if archive:
+                query['web_archive_pending'] = True
+            query['fingerprint'] = page['fingerprint']
+            query['when'] = datetime.datetime.now()
+            query['spider'] = collection
+            query.update(self._raw_fields(page, page.get('body')))
+            page_id = created = self.db['Meta'].insert_one(query).inserted_id
+            if archive:
+                self.archive.submit(page['url'], page_id)
+
+        page['_id'] = page_id
+        self.pages.set(key, page_id)
+        return page_id, created
+
+    def flush_all(self):
+        for collection in list(self.buffers):
+            self.flush(collection)
+        for summaries in self.summaries.values():
+            if summaries.dirty:
+                with metrics.registry.timer('summaries', summaries.spider):
+                    summaries.flush()
+
+    def flush(self, collection):
+        "Grava o lote acumulado para `collection`."
+
+        buffer = self.buffers.pop(collection, None)
+        if not buffer:
+            return
+
+        items = [item for item, _, _ in buffer]
+        failed = set()
+        start = time.time()
+        try:
+            self._mark_writing(collection)
+            self._write(collection, items)
+        except pymongo.errors.BulkWriteError as e:
+            failed = {error['index'] for error in e.details['writeErrors']}
+            logger.error("Falha ao salvar %d de %d itens em %s" %
+                         (len(failed), len(items), collection))
+        except pymongo.errors.PyMongoError:
+            failed = set(range(len(items)))
+            logger.exception("Falha ao salvar %d itens em %s" % (len(items), collection))
+        elapsed = time.time() - start
+        metrics.registry.observe('mongo_write', collection, elapsed)
+
+        if failed:
+            self._remove_orphan_pages(buffer, failed)
+        self._update_coverage(collection, buffer, failed)
+        if collection in self.summaries:
+            self.summaries[collection].touch(item for i, item in enumerate(items) if i not in failed)
+
+        if self.stats is not None:
+            self.stats.inc_value('ldch/mongo/flushes')
+            self.stats.inc_value('ldch/mongo/items_saved', len(items) - len(failed))
+            self.stats.inc_value('ldch/mongo/items_failed', len(failed))
+            self.stats.inc_value('ldch/mongo/flush_time', elapsed)
+            self.stats.max_value('ldch/mongo/flush_time_max', elapsed)
+            self.stats.max_value('ldch/mongo/batch_size_max', len(items))
+            self.stats.set_value('ldch/mongo/batch_size_last', len(items))
+
+    def _mark_writing(self, collection):
+        since = self.writing.get(collection)
+        if since is None or time.time() - since[1] >= WRITER_TIMEOUT / 4:
+            self.writing[collection] = (mark_writing(self.db, collection), time.time())
+
+    def _write(self, collection, items):
+        """Grava `items` em `collection`.
+
+        Se o spider define `natural_key`, os itens substituem as linhas com a
+        mesma chave; caso contrário, são inseridos. O momento da gravação
+        fica em `__updated`, usado pela exportação incremental.
+        """
+
+        schema = self.schemas[collection]
+        now = datetime.datetime.utcnow()
+        docs = []
+        for item in items:
+            doc = schema.to_document(item)
+            doc['__updated'] = now
+            docs.append(doc)
+        natural_key = self.natural_keys.get(collection)
+        if not natural_key:
+            self.db[collection].insert_many(docs, ordered=False)
+            return
+
+        requests = []
+        for doc in docs:
+            query = natural_key_filter(doc, natural_key)
+            if query is None:
+                requests.append(pymongo.InsertOne(doc))
+            else:
+                requests.append(pymongo.ReplaceOne(query, doc, upsert=True))
+        result = self.db[collection].bulk_write(requests, ordered=False)
+        if self.stats is not None:
+            self.stats.inc_value('ldch/mongo/items_upserted', result.upserted_count)
+            self.stats.inc_value('ldch/mongo/items_replaced', result.matched_count)
+
+    def page_parsed(self, page, spider):
+        page['parsed'] = True
+        if page.get('replace') and not page.get('rows'):
+            self._clear_page(page, spider.name)
+        if not page.get('pending'):
+            self._record_coverage(spider.name, page)
+
+    def _clear_page(self, page, collection):
+        "Remove os itens antigos de uma página raspada novamente que não gerou itens."
+
+        query = {'url': page['url'], 'request_body': page['request_body']}
+        try:
+            # páginas sem documento em `Meta` não têm itens a remover
+            if '_id' in page or self.db['Meta'].find_one(query, {'_id': 1}) is not None:
+                self.resolve_page(page, collection)
+        except pymongo.errors.PyMongoError:
+            logger.exception("Falha ao remover os itens antigos de %s" % page['url'])
+            page['failed'] = True
+
+    def _update_coverage(self, collection, buffer, failed):
+        "Registra a cobertura das páginas cujos itens terminaram de ser gravados."
+
+        finished = []
+        for i, (item, page, _) in enumerate(buffer):
+            if page is None:
+                continue
+            if i in failed:
+                page['failed'] = True
+            page['pending'] -= 1
+            if not page['pending'] and page.get('parsed'):
+                finished.append(page)
+        for page in finished:
+            self._record_coverage(collection, page)
+
+    def _record_coverage(self, spider, page):
+        if 'cobertura' not in page:
+            return
+        try:
+            record_coverage(self.db, spider, page)
+        except pymongo.errors.PyMongoError:
+            logger.exception("Falha ao registrar cobertura de %s" % page['url'])
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    def _remove_orphan_pages(self, buffer, failed):
+        "Remove de `Meta` as páginas criadas no lote que ficaram sem itens salvos."
+
+        created = {}
+        saved = set()
+        for i, (item, page, page_id) in enumerate(buffer):
+            if page_id is not None:
+                created[page_id] = page
+            if i not in failed and '__meta' in item:
+                saved.add(item['__meta'])
+
+        orphans = [page_id for page_id in created if page_id not in saved]
+        for page_id in orphans:
+            page = created[page_id]
+            page.pop('_id', None)
+            self.pages.discard((page['url'], page['request_body']))
+        if orphans:
+            try:
+                self.db['Meta'].delete_many({'_id': {'$in': orphans}})
+            except pymongo.errors.PyMongoError:
+                logger.exception("Falha ao remover páginas sem itens")
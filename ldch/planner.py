@@ -0,0 +1,113 @@
+"""Planejamento incremental das competências a raspar.
+
+A coleção `Coverage` guarda, para cada spider, chave (entidade do TCM ou
+página do TCE) e competência, a situação da última raspagem:
+
+    status      'complete' (itens salvos), 'empty' (sem linhas) ou 'failed'
+    rows        quantidade de itens
+    hash        SHA1 do conteúdo da resposta
+    fetched     data da última raspagem
+    changed     data da última raspagem em que o conteúdo mudou
+
+Os spiders só requisitam as competências ausentes, as que falharam e as
+que estão nos últimos `PLANNER_REFRESH_MONTHS` meses, que ainda podem ser
+alteradas pelos órgãos. Nestas, se o conteúdo não mudou, a resposta não é
+processada; se mudou, os itens anteriores são substituídos.
+"""
+import datetime
+
+from ldch import settings
+from ldch.spiders.base import Database
+
+COLLECTION = 'Coverage'
+
+# sinal enviado pelo `LdchPageMiddleware` quando um callback termina
+page_parsed = object()
+
+
+def coverage_id(spider, chave, competencia):
+    return '%s:%s:%s' % (spider, chave, competencia)
+
+
+def record_coverage(db, spider, page):
+    "Registra em `Coverage` o resultado da raspagem de `page`."
+
+    cobertura = page['cobertura']
+    now = datetime.datetime.now()
+    update = {'fetched': now}
+    if not page.get('unchanged'):
+        if page.get('failed'):
+            status = 'failed'
+        else:
+            status = 'complete' if page.get('rows') else 'empty'
+        update.update({
+            'changed': now,
+            'spider': spider,
+            'chave': cobertura['chave'],
+            'competencia': cobertura['competencia'],
+            'status': status,
+            'rows': page.get('rows', 0),
+            'hash': page.get('hash')
+        })
+    db[COLLECTION].update_one(
+        {'_id': coverage_id(spider, cobertura['chave'], cobertura['competencia'])},
+        {'$set': update},
+        upsert=True
+    )
+
+
+class CoveragePlanner:
+    """Decide quais competências de um spider precisam ser requisitadas."""
+
+    def __init__(self, spider, refresh_months=3, enabled=True):
+        self.spider = spider
+        self.refresh_months = refresh_months
+        self.enabled = enabled
+        self.coverage = None
+
+    @classmethod
+    def from_settings(cls, scrapy_settings, spider):
+        return cls(
+            spider,
+            refresh_months=scrapy_settings.getint('PLANNER_REFRESH_MONTHS', 3),
+            enabled=scrapy_settings.getbool('PLANNER_ENABLED', True)
+        )
+
+    def load(self):
+        self.coverage = {}
+        if not self.enabled:
+            return
+        query = {'spider': self.spider}
+        fields = {'_id': 0, 'chave': 1, 'competencia': 1, 'status': 1, 'hash': 1}
+        with Database() as db:
+            cursor = db[COLLECTION].find(query, fields).batch_size(settings.DUPEFILTER_LOAD_BATCH_SIZE)
+            for doc in cursor:
+                self.coverage[(doc['chave'], doc['competencia'])] = (doc['status'], doc.get('hash'))
+
+    def plan(self, chave, ano, mes):
+        """Retorna os metadados de cobertura da requisição ou None se ela deve ser ignorada.
+
+        Competências já raspadas voltam a ser requisitadas com o `hash`
+        anterior; essas requisições devem ignorar o dupefilter.
+        """
+
+        if self.coverage is None:
+            self.load()
+
+        competencia = '%d-%02d' % (ano, mes)
+        cobertura = {'chave': chave, 'competencia': competencia}
+        if not self.enabled:
+            return cobertura
+
+        anterior = self.coverage.get((chave, competencia))
+        if anterior is None:
+            return cobertura
+
+        status, content_hash = anterior
+        if status != 'failed':
+            agora = datetime.date.today()
+            if (agora.year * 12 + agora.month) - (ano * 12 + mes) >= self.refresh_months:
+                return None
+            cobertura['hash'] = content_hash
+        cobertura['refresh'] = True
+        return cobertura
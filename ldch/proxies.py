@@ -0,0 +1,265 @@
+"""Conjunto de proxies do Tor com roteamento pela saúde de cada um.
+
+`TOR_PROXIES` lista as instâncias do Tor/privoxy, cada uma com o endereço
+do proxy HTTP e da porta de controle. Para cada requisição é escolhido o
+proxy com a menor pontuação, calculada a partir da média móvel da latência,
+da taxa de erros e das requisições em andamento nele.
+
+Cada proxy troca de circuito em intervalos aleatórios dentro de
+`TOR_CHANGE_CIRCUIT_INTERVAL_RANGE`, ou antes disso se a taxa de erros
+passar de `TOR_MAX_ERROR_RATE`. Durante a troca, o proxy deixa de receber
+requisições novas; o sinal NEWNYM só é enviado quando as que estão em
+andamento terminam (ou após `TOR_DRAIN_TIMEOUT` segundos), e ele volta a
+ser usado em seguida. Com um único proxy, as requisições continuam
+passando por ele durante a troca.
+
+As conexões com as portas de controle são mantidas abertas e usadas fora
+da thread do reactor. O conjunto é único por processo (`pool`).
+"""
+import logging
+import time
+from random import randint
+
+import scrapy.exceptions
+import scrapy.signals
+import stem
+import stem.control
+from twisted.internet import reactor, threads
+
+logger = logging.getLogger(__name__)
+
+
+class TorController:
+    "Conexão persistente com a porta de controle de uma instância do Tor."
+
+    def __init__(self, host='127.0.0.1', port=9051, password=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.controller = None
+
+    def new_circuit(self):
+        "Envia NEWNYM, reconectando se a conexão tiver caído. Bloqueante."
+
+        for attempt in range(2):
+            try:
+                if self.controller is None or not self.controller.is_alive():
+                    self.controller = stem.control.Controller.from_port(self.host, self.port)
+                    self.controller.authenticate(self.password)
+                self.controller.signal(stem.Signal.NEWNYM)
+                return
+            except stem.SocketError:
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+
+
+class TorProxy:
+    "Estado de um proxy: médias de latência e de erros, requisições em andamento e trocas."
+
+    def __init__(self, index, url, controller, latency=1.0):
+        self.index = index
+        self.url = url
+        self.controller = controller
+        self.latency = latency
+        self.error_rate = 0.0
+        self.samples = 0
+        self.in_flight = 0
+        self.draining = False
+        self.rotating = False
+        self.drain_started = None
+        self.next_rotation = None
+
+    def score(self):
+        return self.latency * (1 + self.in_flight) * (1 + 10 * self.error_rate)
+
+
+class ProxyPool:
+    "Escolhe o proxy de cada requisição e coordena as trocas de circuito."
+
+    def __init__(self):
+        self.proxies = []
+        self.users = 0
+        self.stats = []
+        self.smoothing = 0.2
+        self.max_error_rate = 0.3
+        self.min_samples = 10
+        self.drain_timeout = 30
+        self.interval_range = (100, 400)
+        self.rotate = True
+        self.checker = None
+
+    def configure(self, settings):
+        proxies = settings.getlist('TOR_PROXIES') or [{'proxy': settings.get('HTTP_PROXY')}]
+        self.proxies = []
+        for index, config in enumerate(proxies):
+            controller = TorController(
+                config.get('control_host', '127.0.0.1'),
+                int(config.get('control_port', 9051)),
+                settings.get('TOR_CONTROL_PASSWORD')
+            )
+            self.proxies.append(TorProxy(index, config['proxy'], controller))
+        self.smoothing = settings.getfloat('TOR_SMOOTHING', 0.2)
+        self.max_error_rate = settings.getfloat('TOR_MAX_ERROR_RATE', 0.3)
+        self.min_samples = settings.getint('TOR_MIN_SAMPLES', 10)
+        self.drain_timeout = settings.getfloat('TOR_DRAIN_TIMEOUT', 30)
+        self.interval_range = tuple(settings.getlist('TOR_CHANGE_CIRCUIT_INTERVAL_RANGE') or (100, 400))
+        self.rotate = settings.getbool('TOR_ROTATE_CIRCUITS', True)
+
+    def start(self, settings, stats):
+        "Passa a distribuir as requisições; cada `start` deve ter um `stop` correspondente."
+
+        if self.users == 0:
+            self.configure(settings)
+            if self.rotate:
+                now = time.time()
+                for proxy in self.proxies:
+                    proxy.next_rotation = now + randint(*self.interval_range)
+                self.checker = reactor.callLater(1, self.check)
+        self.users += 1
+        self.stats.append(stats)
+
+    def stop(self, stats):
+        self.users -= 1
+        self.stats.remove(stats)
+        if self.users > 0:
+            return
+        self.users = 0
+        if self.checker is not None and self.checker.active():
+            self.checker.cancel()
+        self.checker = None
+        for proxy in self.proxies:
+            threads.deferToThread(proxy.controller.close)
+
+    def choose(self):
+        "Proxy com a menor pontuação entre os que não estão trocando de circuito."
+
+        available = [proxy for proxy in self.proxies if not proxy.draining] or self.proxies
+        proxy = min(available, key=TorProxy.score)
+        proxy.in_flight += 1
+        return proxy
+
+    def release(self, proxy):
+        "Libera uma requisição de `proxy` que não chegou a ser feita."
+
+        proxy.in_flight -= 1
+        if proxy.draining and proxy.in_flight <= 0:
+            self.new_circuit(proxy)
+
+    def finished(self, proxy, latency=None, error=False):
+        "Registra o resultado de uma requisição feita por `proxy`."
+
+        proxy.in_flight -= 1
+        proxy.samples += 1
+        proxy.error_rate += self.smoothing * ((1.0 if error else 0.0) - proxy.error_rate)
+        if latency is not None:
+            proxy.latency += self.smoothing * (latency - proxy.latency)
+        self._inc_stats('ldch/proxy/%d/%s' % (proxy.index, 'errors' if error else 'responses'))
+        if (self.rotate and not proxy.draining and proxy.samples >= self.min_samples and
+                proxy.error_rate > self.max_error_rate):
+            logger.info("Proxy %s com %.0f%% de erros; trocando de circuito" %
+                        (proxy.url, 100 * proxy.error_rate))
+            self.drain(proxy)
+        elif proxy.draining and proxy.in_flight <= 0:
+            self.new_circuit(proxy)
+
+    def drain(self, proxy):
+        proxy.draining = True
+        proxy.drain_started = time.time()
+        if proxy.in_flight <= 0:
+            self.new_circuit(proxy)
+
+    def new_circuit(self, proxy):
+        if proxy.rotating:
+            return
+        proxy.rotating = True
+        d = threads.deferToThread(proxy.controller.new_circuit)
+        d.addCallbacks(self._rotated, self._rotation_failed, callbackArgs=(proxy,),
+                       errbackArgs=(proxy,))
+
+    def check(self):
+        "Inicia as trocas de circuito vencidas e conclui as que esperaram demais."
+
+        now = time.time()
+        for proxy in self.proxies:
+            if not proxy.draining and now >= proxy.next_rotation:
+                self.drain(proxy)
+            elif proxy.draining and now - proxy.drain_started >= self.drain_timeout:
+                self.new_circuit(proxy)
+        self.checker = reactor.callLater(1, self.check)
+
+    def _rotated(self, _, proxy):
+        self._reset(proxy)
+        self._inc_stats('ldch/proxy/%d/rotations' % proxy.index)
+
+    def _rotation_failed(self, failure, proxy):
+        logger.error("Falha ao trocar o circuito de %s: %s" % (proxy.url, failure.getErrorMessage()))
+        self._reset(proxy)
+        self._inc_stats('ldch/proxy/%d/rotation_failures' % proxy.index)
+
+    def _reset(self, proxy):
+        proxy.draining = proxy.rotating = False
+        proxy.error_rate = 0.0
+        proxy.samples = 0
+        proxy.next_rotation = time.time() + randint(*self.interval_range)
+
+    def _inc_stats(self, key):
+        for stats in self.stats:
+            stats.inc_value(key)
+
+
+pool = ProxyPool()
+
+
+class TorProxyMiddleware:
+    "Middleware de download que envia cada requisição pelo proxy escolhido pelo `pool`."
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ENABLE_TOR_PROXY'):
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=scrapy.signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        pool.start(self.crawler.settings, self.crawler.stats)
+
+    def spider_closed(self, spider):
+        pool.stop(self.crawler.stats)
+
+    def process_request(self, request, spider):
+        proxy = pool.choose()
+        request.meta['tor_proxy'] = proxy.index
+        request.meta['proxy'] = proxy.url
+
+    def process_response(self, request, response, spider):
+        proxy = self._proxy(request)
+        if proxy is not None:
+            error = response.status == 429 or response.status >= 500
+            pool.finished(proxy, request.meta.get('download_latency'), error)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = self._proxy(request)
+        if proxy is None:
+            return
+        if isinstance(exception, scrapy.exceptions.IgnoreRequest):
+            pool.release(proxy)
+        else:
+            pool.finished(proxy, error=True)
+
+    def _proxy(self, request):
+        index = request.meta.pop('tor_proxy', None)
+        if index is None or index >= len(pool.proxies):
+            return None
+        return pool.proxies[index]
@@ -0,0 +1,162 @@
+"""Reprocessa as páginas armazenadas em `Raw`, sem acessar a rede.
+
+Para cada documento de `Meta` do spider com o campo `raw`, reconstrói a
+resposta, executa o callback original e substitui os itens da página na
+coleção do spider. Útil após correções nos parsers:
+
+    $ ldch_reparse ldch.spiders.tcm.TcmRemuneracaoSpider --workers 4
+"""
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+
+import scrapy
+import scrapy.signals
+from scrapy.crawler import Crawler
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import Settings
+from scrapy.utils.log import configure_logging
+
+from ldch import settings
+from ldch.pipelines import LdchMongoPipeline
+from ldch.schema import Item
+from ldch.spiders.base import Database, load_spiders
+from ldch.store import RawStore
+
+logger = logging.getLogger(__name__)
+
+
+def build_response(meta, body):
+    "Reconstrói a resposta de um documento de `Meta`."
+
+    request = scrapy.Request(
+        meta['url'],
+        method=meta.get('method', 'GET'),
+        body=meta['request_body'],
+        meta=dict(meta.get('callback_meta') or {}),
+        dont_filter=True
+    )
+    headers = {}
+    if meta.get('content_type'):
+        headers['Content-Type'] = meta['content_type']
+    cls = responsetypes.from_args(headers=headers, url=meta['url'], body=body)
+    return cls(meta['url'], body=body, headers=headers, request=request)
+
+
+def reparse(klass, shard_index=0, shard_count=1):
+    """Reprocessa as páginas de `klass` cujo índice módulo `shard_count` é `shard_index`.
+
+    Retorna a quantidade de páginas reprocessadas, de itens gerados e de
+    páginas que falharam.
+    """
+
+    scrapy_settings = Settings()
+    scrapy_settings.setmodule(settings)
+    scrapy_settings.set('WEB_ARCHIVE_ENABLED', False)
+    scrapy_settings.set('MONGO_FLUSH_INTERVAL', 0)
+    crawler = Crawler(klass, scrapy_settings)
+    spider = crawler._create_spider()
+
+    pipeline = LdchMongoPipeline.from_crawler(crawler)
+    pipeline.open_spider(spider)
+
+    pages = items = failed = 0
+    with Database() as db:
+        store = RawStore(db)
+        query = {'spider': spider.name, 'raw': {'$exists': True}}
+        fields = {'url': 1, 'method': 1, 'request_body': 1, 'raw': 1,
+                  'callback': 1, 'callback_meta': 1, 'content_type': 1}
+        cursor = db['Meta'].find(query, fields).batch_size(settings.DUPEFILTER_LOAD_BATCH_SIZE)
+        for i, meta in enumerate(cursor):
+            if i % shard_count != shard_index:
+                continue
+
+            body = store.get(meta['raw'])
+            if body is None:
+                logger.warning("Conteúdo %s não encontrado para %s" % (meta['raw'], meta['url']))
+                failed += 1
+                continue
+
+            response = build_response(meta, body)
+            callback = getattr(spider, meta.get('callback') or 'parse')
+            page = {
+                '_id': meta['_id'],
+                'url': meta['url'],
+                'request_body': meta['request_body'],
+                'replace': True
+            }
+            try:
+                # só os itens interessam; requisições são descartadas
+                generated = [item for item in callback(response) or () if isinstance(item, (dict, Item))]
+            except Exception:
+                logger.exception("Falha ao reprocessar %s" % meta['url'])
+                failed += 1
+                continue
+
+            for item in generated:
+                item['__page'] = page
+                pipeline.process_item(item, spider)
+            if not generated:
+                pipeline.resolve_page(page, spider.name)
+            pages += 1
+            items += len(generated)
+
+    pipeline.close_spider(spider)
+    crawler.signals.send_catch_log(signal=scrapy.signals.spider_closed, spider=spider, reason='finished')
+    return pages, items, failed
+
+
+def _reparse_shard(path, shard_index, shard_count, results):
+    result = None
+    try:
+        result = reparse(load_spiders([path])[0], shard_index, shard_count)
+    finally:
+        results.put(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('spiders', nargs='+', metavar='spider',
+                        help="caminho completo da classe, ex. ldch.spiders.tce.TceRemuneracaoSpider")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="quantidade de processos entre os quais as páginas são divididas")
+    options = parser.parse_args()
+
+    spiders = load_spiders(options.spiders)
+    if spiders is None:
+        return 1
+
+    scrapy_settings = Settings()
+    scrapy_settings.setmodule(settings)
+    configure_logging(scrapy_settings)
+
+    errors = 0
+    for path, klass in zip(options.spiders, spiders):
+        start = time.time()
+        if options.workers <= 1:
+            results = [reparse(klass)]
+        else:
+            context = multiprocessing.get_context('spawn')
+            queue = context.Queue()
+            workers = [context.Process(target=_reparse_shard, args=(path, i, options.workers, queue))
+                       for i in range(options.workers)]
+            for worker in workers:
+                worker.start()
+            results = [queue.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+        pages = sum(result[0] for result in results if result)
+        items = sum(result[1] for result in results if result)
+        failed = sum(result[2] for result in results if result)
+        failed += sum(1 for result in results if result is None)
+        errors += failed
+        print("%s: %d páginas, %d itens, %d falhas em %.1f s" %
+              (klass.__name__, pages, items, failed, time.time() - start))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
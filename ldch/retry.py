@@ -0,0 +1,225 @@
+"""Fila persistente de requisições a repetir após falhas transitórias.
+
+Substitui o `RetryMiddleware` do Scrapy. Respostas com um código de
+`RETRY_HTTP_CODES` (502, 503...) e exceções de rede (timeouts, conexões
+recusadas) são transitórias: a requisição é gravada na coleção `Retries`
+com a quantidade de tentativas e o momento da próxima, que cresce
+exponencialmente a partir de `RETRY_QUEUE_BACKOFF` segundos. Os demais
+erros (404, por exemplo) são permanentes e registrados em `Errors` como
+antes, e o `LdchDupeFilter` passa a ignorar a requisição.
+
+As requisições vencidas são reinjetadas na raspagem em andamento, no
+máximo `RETRY_QUEUE_CONCURRENCY` ao mesmo tempo. O spider continua aberto
+enquanto houver uma tentativa prevista para os próximos
+`RETRY_QUEUE_IDLE_WAIT` segundos; as demais ficam para a próxima raspagem.
+Após `RETRY_QUEUE_MAX_ATTEMPTS` tentativas, a falha se torna permanente.
+
+Competências sem dados (como as do TCE em 2013) respondem normalmente e
+são registradas como vazias pelo `ldch.planner`, não como falhas.
+
+No modo com `MongoScheduler`, as exceções de download já são devolvidas
+à fila compartilhada pelo `FrontierMiddleware` e não passam por aqui.
+"""
+import datetime
+import logging
+import pickle
+
+import pymongo
+import pymongo.errors
+import scrapy.exceptions
+import scrapy.signals
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from scrapy.utils.request import request_fingerprint
+from twisted.internet import task
+
+from ldch.spiders.base import register_error
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'Retries'
+
+# exceções de rede consideradas transitórias, as mesmas do `RetryMiddleware`
+TRANSIENT_EXCEPTIONS = RetryMiddleware.EXCEPTIONS_TO_RETRY
+
+
+def transient_http_codes(settings):
+    "Códigos HTTP repetidos pela fila ou um conjunto vazio se ela estiver desativada."
+
+    if not settings.getbool('RETRY_QUEUE_ENABLED', True):
+        return frozenset()
+    return frozenset(int(code) for code in settings.getlist('RETRY_HTTP_CODES'))
+
+
+class RetryQueueMiddleware:
+    "Middleware de download que grava as falhas transitórias em `Retries` e as repete."
+
+    def __init__(self, crawler, mongo_uri, database='ldch', max_attempts=5, backoff=30,
+                 max_delay=6 * 3600, concurrency=2, poll_interval=10, idle_wait=120):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.mongo_uri = mongo_uri
+        self.database = database
+        self.http_codes = transient_http_codes(crawler.settings)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.idle_wait = idle_wait
+
+        self.client = None
+        self.collection = None
+        self.spider = None
+        self.poller = None
+        self.in_flight = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RETRY_QUEUE_ENABLED', True):
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(
+            crawler,
+            settings.get('MONGO_URI'),
+            database=settings.get('MONGO_DATABASE', 'ldch'),
+            max_attempts=settings.getint('RETRY_QUEUE_MAX_ATTEMPTS', 5),
+            backoff=settings.getfloat('RETRY_QUEUE_BACKOFF', 30),
+            max_delay=settings.getfloat('RETRY_QUEUE_MAX_DELAY', 6 * 3600),
+            concurrency=settings.getint('RETRY_QUEUE_CONCURRENCY', 2),
+            poll_interval=settings.getfloat('RETRY_QUEUE_POLL_INTERVAL', 10),
+            idle_wait=settings.getfloat('RETRY_QUEUE_IDLE_WAIT', 120)
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=scrapy.signals.spider_closed)
+        crawler.signals.connect(middleware.spider_idle, signal=scrapy.signals.spider_idle)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.collection = self.client[self.database][COLLECTION]
+        self.collection.create_index([('spider', 1), ('status', 1), ('next_attempt', 1)])
+        self.poller = task.LoopingCall(self.reinject)
+        self.poller.start(self.poll_interval, now=True)
+
+    def spider_closed(self, spider):
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        # tentativas interrompidas voltam a ficar pendentes para a próxima raspagem
+        if self.in_flight:
+            self.collection.update_many(
+                {'_id': {'$in': list(self.in_flight)}, 'status': 'running'},
+                {'$set': {'status': 'pending'}}
+            )
+        self.in_flight.clear()
+        self.client.close()
+
+    def spider_idle(self, spider):
+        "Mantém o spider aberto enquanto houver tentativas em andamento ou próximas."
+
+        self.reinject()
+        if self.in_flight:
+            raise scrapy.exceptions.DontCloseSpider
+        soon = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.idle_wait)
+        if self.collection.find_one(self._due_query(soon), {'_id': 1}) is not None:
+            raise scrapy.exceptions.DontCloseSpider
+
+    def process_response(self, request, response, spider):
+        # a fila assume o registro dos erros HTTP, feito pelo `LdchSignalHandler` quando ela está desativada
+        if response.status in self.http_codes:
+            register_error('transient_http_error', request=request, spider=spider, status=response.status)
+            self.schedule(request, 'http_%d' % response.status, status=response.status)
+        elif response.status >= 400:
+            register_error('http_error', request=request, spider=spider, status=response.status)
+            self._finished(request, recovered=False)
+        else:
+            self._finished(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if 'frontier_id' in request.meta:
+            return
+        if isinstance(exception, TRANSIENT_EXCEPTIONS):
+            self.schedule(request, type(exception).__name__)
+        else:
+            self._finished(request, recovered=False)
+
+    def schedule(self, request, reason, status=None):
+        "Grava `request` para uma nova tentativa ou desiste dela após `max_attempts`."
+
+        retry_id = request.meta.get('retry_id') or request_fingerprint(request)
+        self.in_flight.discard(retry_id)
+        now = datetime.datetime.utcnow()
+        doc = self.collection.find_one_and_update(
+            {'_id': retry_id},
+            {'$inc': {'attempts': 1},
+             '$set': {'status': 'failed', 'reason': reason, 'last_failed': now},
+             '$setOnInsert': {
+                 'spider': self.spider.name,
+                 'url': request.url,
+                 'request': pickle.dumps(request_to_dict(request, self.spider), protocol=2),
+                 'first_failed': now
+             }},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        attempts = doc['attempts']
+        if attempts >= self.max_attempts:
+            self.collection.update_one({'_id': retry_id}, {'$set': {'status': 'gave_up'}})
+            logger.warning("Desistindo de %s após %d tentativas (%s)" % (request.url, attempts, reason))
+            # exceções já são registradas pelo `LdchMiddleware` a cada tentativa
+            if status is not None:
+                register_error('http_error', request=request, spider=self.spider,
+                               status=status, attempts=attempts)
+            self._inc_stats('ldch/retry/gave_up')
+            return
+
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_delay)
+        self.collection.update_one(
+            {'_id': retry_id},
+            {'$set': {'status': 'pending', 'next_attempt': now + datetime.timedelta(seconds=delay)}}
+        )
+        logger.debug("Nova tentativa de %s em %d s (%s)" % (request.url, delay, reason))
+        self._inc_stats('ldch/retry/scheduled')
+
+    def reinject(self):
+        "Envia ao engine as tentativas vencidas, até `concurrency` em andamento."
+
+        available = self.concurrency - len(self.in_flight)
+        if available <= 0 or self.crawler.engine is None:
+            return
+        try:
+            docs = list(self.collection.find(self._due_query(datetime.datetime.utcnow()))
+                        .sort('next_attempt', pymongo.ASCENDING).limit(available))
+            for doc in docs:
+                result = self.collection.update_one({'_id': doc['_id'], 'status': 'pending'},
+                                                    {'$set': {'status': 'running'}})
+                if not result.modified_count:
+                    continue
+                request = request_from_dict(pickle.loads(doc['request']), self.spider)
+                request = request.replace(dont_filter=True)
+                request.meta['retry_id'] = doc['_id']
+                self.in_flight.add(doc['_id'])
+                self.crawler.engine.crawl(request, self.spider)
+                self._inc_stats('ldch/retry/reinjected')
+        except pymongo.errors.PyMongoError:
+            logger.exception("Falha ao consultar as requisições a repetir")
+
+    def _due_query(self, until):
+        return {'spider': self.spider.name, 'status': 'pending', 'next_attempt': {'$lte': until}}
+
+    def _finished(self, request, recovered=True):
+        "Remove de `Retries` uma requisição repetida que não falhou de forma transitória."
+
+        retry_id = request.meta.get('retry_id')
+        if retry_id is None:
+            return
+        self.in_flight.discard(retry_id)
+        self.collection.delete_one({'_id': retry_id})
+        self._inc_stats('ldch/retry/recovered' if recovered else 'ldch/retry/failed')
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key, spider=self.spider)
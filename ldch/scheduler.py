@@ -0,0 +1,316 @@
+"""Fila de requisições compartilhada entre vários crawlers por meio do MongoDB.
+
+Ative com `SCHEDULER = 'ldch.scheduler.MongoScheduler'`. Cada requisição
+filtrável é gravada uma única vez na coleção `SCHEDULER_COLLECTION`, tendo
+como `_id` a sua impressão digital, e passa pelos estados:
+
+    pending     aguardando um crawler
+    leased      reservada por um crawler até `lease_until`
+    done        baixada
+    failed      abandonada
+
+Os crawlers reservam lotes de requisições de forma atômica e as confirmam
+ao receber a resposta. Reservas vencidas, como as de um crawler que
+morreu, voltam a ser distribuídas, até `SCHEDULER_MAX_ATTEMPTS` vezes por
+requisição (`attempts`); falhas de download devolvem a requisição à fila
+e também são limitadas a `SCHEDULER_MAX_ATTEMPTS` (`failures`). Ao atingir
+um dos limites, a requisição é abandonada e registrada em `Errors` como
+`frontier_exhausted`. Requisições com `dont_filter`, como as iniciais,
+ficam apenas na fila local. As confirmadas e as abandonadas são removidas
+após `SCHEDULER_DONE_TTL` segundos para que uma nova raspagem possa
+repeti-las.
+"""
+import collections
+import datetime
+import logging
+import os
+import pickle
+import socket
+import time
+import uuid
+
+import pymongo
+import pymongo.errors
+import scrapy.signals
+from scrapy.utils.misc import load_object
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from scrapy.utils.request import request_fingerprint
+
+from ldch.spiders.base import register_error
+
+logger = logging.getLogger(__name__)
+
+
+class MongoScheduler:
+    "Scheduler do Scrapy que distribui as requisições a partir de uma coleção do MongoDB."
+
+    def __init__(self, dupefilter, mongo_uri, database='ldch', collection='Frontier',
+                 lease_timeout=600, claim_batch_size=50, poll_interval=1,
+                 max_attempts=3, done_ttl=12 * 3600, stats=None):
+        self.df = dupefilter
+        self.mongo_uri = mongo_uri
+        self.database = database
+        self.collection_name = collection
+        self.lease_timeout = lease_timeout
+        self.claim_batch_size = claim_batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.done_ttl = done_ttl
+        self.stats = stats
+        self.node = '%s:%d' % (socket.gethostname(), os.getpid())
+
+        self.client = None
+        self.collection = None
+        self.spider = None
+        self.local = collections.deque()
+        self.claimed = collections.deque()
+        self.next_poll = 0
+        self.next_pending_check = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        dupefilter = load_object(settings['DUPEFILTER_CLASS']).from_settings(settings)
+        scheduler = cls(
+            dupefilter,
+            settings.get('MONGO_URI'),
+            database=settings.get('MONGO_DATABASE', 'ldch'),
+            collection=settings.get('SCHEDULER_COLLECTION', 'Frontier'),
+            lease_timeout=settings.getfloat('SCHEDULER_LEASE_TIMEOUT', 600),
+            claim_batch_size=settings.getint('SCHEDULER_CLAIM_BATCH_SIZE', 50),
+            poll_interval=settings.getfloat('SCHEDULER_POLL_INTERVAL', 1),
+            max_attempts=settings.getint('SCHEDULER_MAX_ATTEMPTS', 3),
+            done_ttl=settings.getint('SCHEDULER_DONE_TTL', 12 * 3600),
+            stats=crawler.stats
+        )
+        crawler.signals.connect(scheduler.response_received, signal=scrapy.signals.response_received)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.collection = self.client[self.database][self.collection_name]
+        self.collection.create_index([('spider', 1), ('state', 1), ('priority', -1)])
+        self.collection.create_index('finished', expireAfterSeconds=self.done_ttl)
+        return self.df.open()
+
+    def close(self, reason):
+        # devolve as requisições reservadas que não chegaram a ser baixadas
+        ids = [doc['_id'] for doc in self.claimed]
+        if ids:
+            try:
+                self.collection.update_many(
+                    {'_id': {'$in': ids}, 'owner': self.node},
+                    {'$set': {'state': 'pending'}, '$unset': {'owner': '', 'lease_until': ''},
+                     '$inc': {'attempts': -1}}
+                )
+            except pymongo.errors.PyMongoError:
+                logger.exception("Falha ao devolver %d requisições reservadas" % len(ids))
+        self.claimed.clear()
+        self.client.close()
+        return self.df.close(reason)
+
+    def __len__(self):
+        return len(self.local) + len(self.claimed)
+
+    def has_pending_requests(self):
+        if len(self):
+            return True
+
+        # requisições reservadas por outros crawlers podem gerar novas ou
+        # voltar para a fila, portanto também mantêm o spider aberto. Só a
+        # resposta positiva é reaproveitada: a negativa encerra o spider.
+        now = time.time()
+        if now < self.next_pending_check:
+            return True
+        self._give_up()
+        # reservas vencidas contam apenas enquanto puderem ser reservadas de
+        # novo; as vigentes nunca passam de `max_attempts` (veja `_claim`)
+        utcnow = datetime.datetime.utcnow()
+        query = {
+            'spider': self.spider.name,
+            '$or': [{'state': 'leased', 'lease_until': {'$gte': utcnow}},
+                    dict(self._available(), state='pending'),
+                    dict(self._available(), state='leased', lease_until={'$lt': utcnow})]
+        }
+        if self.collection.find_one(query, {'_id': 1}) is None:
+            return False
+        self.next_pending_check = now + self.poll_interval
+        return True
+
+    def enqueue_request(self, request):
+        if request.dont_filter:
+            self.local.append(request)
+            self._inc_stats('scheduler/enqueued/memory')
+            self._inc_stats('scheduler/enqueued')
+            return True
+
+        if self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return False
+
+        doc = {
+            '_id': request_fingerprint(request),
+            'spider': self.spider.name,
+            'state': 'pending',
+            'priority': request.priority,
+            'attempts': 0,
+            'failures': 0,
+            'request': pickle.dumps(request_to_dict(request, self.spider), protocol=2),
+            'enqueued': datetime.datetime.utcnow()
+        }
+        try:
+            self.collection.insert_one(doc)
+        except pymongo.errors.DuplicateKeyError:
+            # já enfileirada por outro crawler
+            self._inc_stats('scheduler/duplicate/mongo')
+            return False
+
+        self._inc_stats('scheduler/enqueued/mongo')
+        self._inc_stats('scheduler/enqueued')
+        self.next_poll = 0
+        return True
+
+    def next_request(self):
+        if self.local:
+            request = self.local.popleft()
+            self._inc_stats('scheduler/dequeued/memory')
+        else:
+            if not self.claimed and time.time() >= self.next_poll:
+                self._claim()
+            if not self.claimed:
+                return None
+            doc = self.claimed.popleft()
+            request = request_from_dict(pickle.loads(doc['request']), self.spider)
+            request.meta['frontier_id'] = doc['_id']
+            self._inc_stats('scheduler/dequeued/mongo')
+
+        self._inc_stats('scheduler/dequeued')
+        return request
+
+    def response_received(self, response, request, spider):
+        "Confirma a requisição reservada."
+
+        frontier_id = request.meta.get('frontier_id')
+        if frontier_id is None:
+            return
+        self.collection.update_one(
+            {'_id': frontier_id},
+            {'$set': {'state': 'done', 'finished': datetime.datetime.utcnow()},
+             '$unset': {'owner': '', 'lease_until': ''}}
+        )
+        self._inc_stats('ldch/frontier/acked')
+
+    def release(self, request):
+        """Devolve uma requisição reservada à fila após uma falha de download.
+
+        A reserva deixa de contar em `attempts` e a falha passa a contar em
+        `failures`; no limite, a requisição é abandonada.
+        """
+
+        frontier_id = request.meta.get('frontier_id')
+        if frontier_id is None:
+            return
+        result = self.collection.update_one(
+            {'_id': frontier_id, 'owner': self.node},
+            {'$set': {'state': 'pending'}, '$unset': {'owner': '', 'lease_until': ''},
+             '$inc': {'attempts': -1, 'failures': 1}}
+        )
+        self._inc_stats('ldch/frontier/released')
+        if result.modified_count:
+            self._give_up(frontier_id)
+
+    def _available(self):
+        "Condição das requisições que ainda podem ser reservadas."
+
+        return {'attempts': {'$lt': self.max_attempts}, 'failures': {'$not': {'$gte': self.max_attempts}}}
+
+    def _give_up(self, frontier_id=None):
+        """Abandona as requisições que atingiram `max_attempts` reservas ou falhas.
+
+        Elas passam para o estado `failed`, com `finished` para que o índice
+        TTL as remova, e são registradas em `Errors`. A atualização é
+        condicional, de modo que apenas um crawler registra cada uma.
+        """
+
+        now = datetime.datetime.utcnow()
+        exhausted = {
+            'spider': self.spider.name,
+            '$and': [
+                {'$or': [{'attempts': {'$gte': self.max_attempts}},
+                         {'failures': {'$gte': self.max_attempts}}]},
+                {'$or': [{'state': 'pending'}, {'state': 'leased', 'lease_until': {'$lt': now}}]}
+            ]
+        }
+        if frontier_id is not None:
+            exhausted['_id'] = frontier_id
+        for doc in self.collection.find(exhausted, {'request': 1, 'attempts': 1, 'failures': 1}):
+            result = self.collection.update_one(
+                dict(exhausted, _id=doc['_id']),
+                {'$set': {'state': 'failed', 'finished': now},
+                 '$unset': {'owner': '', 'lease_until': ''}}
+            )
+            if not result.modified_count:
+                continue
+            request = request_from_dict(pickle.loads(doc['request']), self.spider)
+            register_error('frontier_exhausted', request=request, spider=self.spider,
+                           attempts=doc.get('attempts', 0), failures=doc.get('failures', 0))
+            self._inc_stats('ldch/frontier/exhausted')
+
+    def _claim(self):
+        """Reserva até `claim_batch_size` requisições.
+
+        Os candidatos são marcados com um identificador único do lote numa
+        atualização condicional, de modo que cada requisição seja reservada
+        por um único crawler mesmo quando vários disputam os mesmos
+        documentos.
+        """
+
+        now = datetime.datetime.utcnow()
+        query = self._available()
+        query.update({
+            'spider': self.spider.name,
+            '$or': [{'state': 'pending'}, {'state': 'leased', 'lease_until': {'$lt': now}}]
+        })
+        candidates = self.collection.find(query, {'_id': 1}) \
+            .sort('priority', pymongo.DESCENDING).limit(self.claim_batch_size)
+        ids = [doc['_id'] for doc in candidates]
+        if not ids:
+            self.next_poll = time.time() + self.poll_interval
+            return
+
+        claim = uuid.uuid4().hex
+        lease_until = now + datetime.timedelta(seconds=self.lease_timeout)
+        self.collection.update_many(
+            dict(query, _id={'$in': ids}),
+            {'$set': {'state': 'leased', 'owner': self.node, 'claim': claim,
+                      'lease_until': lease_until},
+             '$inc': {'attempts': 1}}
+        )
+        docs = list(self.collection.find({'_id': {'$in': ids}, 'claim': claim},
+                                         {'request': 1, 'priority': 1}))
+        docs.sort(key=lambda doc: -doc['priority'])
+        self.claimed.extend(docs)
+        self._inc_stats('ldch/frontier/claims')
+        self._inc_stats('ldch/frontier/claimed', len(docs))
+
+    def _inc_stats(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count, spider=self.spider)
+
+
+class FrontierMiddleware:
+    "Middleware de download que devolve ao `MongoScheduler` as requisições que falharam."
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_exception(self, request, exception, spider):
+        slot = getattr(self.crawler.engine, 'slot', None)
+        scheduler = getattr(slot, 'scheduler', None)
+        if isinstance(scheduler, MongoScheduler):
+            scheduler.release(request)
@@ -0,0 +1,348 @@
+"""Itens tipados dos spiders e nomes curtos dos campos no banco.
+
+Cada spider declara em `stored_keys` uma chave curta (um identificador
+Python) para cada campo de `context_fields` e `fields`, e em
+`money_fields` os campos em reais. Dessas declarações saem:
+
+* a classe dos itens do spider (`item_class`), com `__slots__` em vez de
+  um dicionário por item e acesso pelos nomes dos campos, como antes
+  (`item['Salário Base']`);
+* o formato dos documentos na coleção do spider (`Schema`): com os nomes
+  dos campos (formato original) ou, com `ITEM_STORAGE_COMPACT`, com as
+  chaves curtas e, com `ITEM_STORAGE_CENTS`, os valores em reais como
+  centavos inteiros. Campos vazios não são gravados.
+
+O formato de cada coleção fica registrado em `Schemas`, e é ele, não as
+configurações, que os leitores (`ldch.export`, `ldch.api`,
+`ldch.aggregates`) e o pipeline usam. Coleções que já têm documentos
+mantêm o formato até serem convertidas:
+
+    $ ldch_schema ldch.spiders.tcm.TcmRemuneracaoSpider --compact --cents
+
+A conversão grava os documentos numa coleção temporária, que substitui a
+original ao final, e fica registrada em `Schemas` até terminar: uma
+conversão interrompida é refeita do início pelo mesmo comando e, enquanto
+isso, o pipeline não grava na coleção. Os crawlers registram em `Schemas`
+as suas gravações (`writing`), e a conversão não começa se alguma coleção
+recebeu itens nos últimos `WRITER_TIMEOUT` segundos.
+
+As chaves curtas não devem mudar depois que houver dados gravados com elas.
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+import pymongo
+
+from ldch import settings
+
+try:
+    from scrapy.item import BaseItem as _ItemBase
+except ImportError:
+    # `BaseItem` não existe no Scrapy 2.x; a raspagem requer o 1.x (veja setup.py), mas
+    # a exportação, a API e `ldch_schema` importam este módulo com qualquer versão
+    from scrapy.utils.trackref import object_ref as _ItemBase
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'Schemas'
+
+# segundos desde a última gravação de um crawler até que a coleção possa ser convertida
+WRITER_TIMEOUT = 120
+
+# campos internos do pipeline, fora de `stored_keys`
+_INTERNAL = {'__page': '_page', '__meta': '_meta'}
+
+
+class Item(_ItemBase):
+    """Base dos itens tipados, acessados pelos nomes dos campos como dicionários.
+
+    Campos nunca atribuídos são tratados como ausentes.
+    """
+
+    __slots__ = ('_page', '_meta')
+
+    # nome do campo -> atributo, definido em cada subclasse
+    _attributes = _INTERNAL
+
+    def __new__(cls, *args, **kwargs):
+        # sem o registro de `scrapy.utils.trackref`, que custaria uma referência fraca por item
+        return object.__new__(cls)
+
+    def __init__(self, pairs=()):
+        attributes = self._attributes
+        for name, value in pairs:
+            setattr(self, attributes[name], value)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, self._attributes[name])
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        setattr(self, self._attributes[name], value)
+
+    def __delitem__(self, name):
+        try:
+            delattr(self, self._attributes[name])
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        attribute = self._attributes.get(name)
+        return attribute is not None and hasattr(self, attribute)
+
+    def __iter__(self):
+        for name, attribute in self._attributes.items():
+            if hasattr(self, attribute):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr({name: value for name, value in self.items() if name not in _INTERNAL})
+
+    def get(self, name, default=None):
+        attribute = self._attributes.get(name)
+        if attribute is None:
+            return default
+        return getattr(self, attribute, default)
+
+    def pop(self, name, *default):
+        try:
+            value = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return value
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def values(self):
+        return [self[name] for name in self]
+
+
+def _labels(klass):
+    return tuple(klass.context_fields) + tuple(name for name, _ in klass.fields or ())
+
+
+def item_class(klass):
+    "Classe dos itens de `klass`, criada uma única vez por spider."
+
+    item = klass.__dict__.get('_item_class')
+    if item is None:
+        keys = klass.stored_keys or {}
+        missing = [name for name in _labels(klass) if name not in keys]
+        if missing:
+            raise ValueError("%s não declara a chave curta de %s" % (klass.__name__, ', '.join(missing)))
+        attributes = dict(_INTERNAL)
+        attributes.update((name, keys[name]) for name in _labels(klass))
+        item = type(klass.__name__.replace('Spider', 'Item'), (Item,), {
+            '__slots__': tuple(keys[name] for name in _labels(klass)),
+            '_attributes': attributes
+        })
+        klass._item_class = item
+    return item
+
+
+class Schema:
+    "Formato dos documentos da coleção de um spider."
+
+    def __init__(self, klass, compact=False, cents=False):
+        self.klass = klass
+        # spiders sem `stored_keys` (como o `TorTestSpider`) gravam os itens como estão
+        compact = compact and bool(klass.stored_keys)
+        self.compact = compact
+        self.cents = cents
+        self.labels = _labels(klass)
+        stored = klass.stored_keys or {}
+        self.keys = {name: stored[name] if compact else name for name in self.labels}
+        self.names = {key: name for name, key in self.keys.items()}
+        self.money = frozenset(klass.money_fields) if cents else frozenset()
+
+    def key(self, name):
+        "Nome do campo `name` no banco."
+
+        return self.keys.get(name, name)
+
+    def scale(self, name):
+        return 100 if name in self.money else 1
+
+    def store_value(self, name, value):
+        if value is not None and name in self.money:
+            return int(round(value * 100))
+        return value
+
+    def to_document(self, item):
+        """Documento gravado a partir de um item (tipado ou dicionário).
+
+        Campos vazios de `fields` não são gravados; os demais campos do item
+        são gravados como estão.
+        """
+
+        doc = {}
+        keys = self.keys
+        for name, value in item.items():
+            key = keys.get(name)
+            if key is None:
+                if name != '__page':
+                    doc[name] = value
+            elif value is not None:
+                doc[key] = self.store_value(name, value)
+        return doc
+
+    def from_document(self, doc):
+        "Dicionário com os nomes dos campos e os valores em reais de um documento."
+
+        row = {}
+        for key, value in doc.items():
+            name = self.names.get(key, key)
+            if value is not None and name in self.money:
+                value = value / 100.0
+            row[name] = value
+        return row
+
+    def state(self):
+        return {'compact': self.compact, 'cents': self.cents}
+
+
+def load_schema(db, klass, compact=None, cents=None):
+    """Formato registrado da coleção de `klass`.
+
+    Sem registro, uma coleção com documentos está no formato original. Se
+    `compact` e `cents` forem informados (pelo pipeline), uma coleção sem
+    registro e vazia passa a usá-los.
+    """
+
+    spider = klass().name
+    state = db[COLLECTION].find_one({'_id': spider})
+    if compact is not None and state is not None and 'converting' in state:
+        raise RuntimeError("Coleção %s em conversão para %s; conclua-a com `ldch_schema`" %
+                           (spider, state['converting']))
+    if state is None or 'compact' not in state:
+        schema = Schema(klass)
+        if compact is not None and db[spider].find_one({}, {'_id': 1}) is None:
+            schema = Schema(klass, compact, bool(cents))
+            db[COLLECTION].update_one({'_id': spider}, {'$set': schema.state()}, upsert=True)
+        return schema
+
+    schema = Schema(klass, state.get('compact', False), state.get('cents', False))
+    if compact is not None and (schema.compact, schema.cents) != (compact, bool(cents)):
+        logger.warning("Coleção %s continua no formato registrado em Schemas (%s); use `ldch_schema` "
+                       "para convertê-la" % (spider, schema.state()))
+    return schema
+
+
+def mark_writing(db, spider):
+    "Registra em `Schemas` que um crawler está gravando na coleção `spider`; retorna o instante."
+
+    now = datetime.datetime.utcnow()
+    db[COLLECTION].update_one({'_id': spider}, {'$set': {'writing': now}}, upsert=True)
+    return now
+
+
+def unmark_writing(db, spider, since):
+    "Desfaz `mark_writing`, a menos que outro crawler tenha gravado depois de `since`."
+
+    db[COLLECTION].update_one({'_id': spider, 'writing': since}, {'$unset': {'writing': ''}})
+
+
+def collection_stats(db, collection):
+    "Tamanho dos documentos, do armazenamento e dos índices de `collection`, em bytes."
+
+    stats = db.command('collStats', collection)
+    return {key: stats.get(key, 0) for key in ('count', 'size', 'avgObjSize', 'storageSize', 'totalIndexSize')}
+
+
+def convert(db, klass, compact, cents, batch_size=1000):
+    """Converte a coleção de `klass` para o formato informado e recria os índices.
+
+    Retorna a quantidade de documentos convertidos. Lança RuntimeError se
+    algum crawler gravou na coleção há menos de `WRITER_TIMEOUT` segundos.
+    """
+
+    from ldch.indexes import ensure_indexes
+
+    spider = klass()
+    name = spider.name
+    temporary = '%s.converting' % name
+    state = db[COLLECTION].find_one({'_id': name}) or {}
+
+    writing = state.get('writing')
+    if writing is not None and (datetime.datetime.utcnow() - writing).total_seconds() < WRITER_TIMEOUT:
+        raise RuntimeError("Coleção %s recebeu itens às %s; aguarde o fim da raspagem" % (name, writing))
+
+    # a coleção temporária só desaparece ao substituir a original: sem ela, a
+    # conversão registrada já foi aplicada e falta apenas atualizar `Schemas`
+    if 'converting' in state and temporary not in db.list_collection_names():
+        db[COLLECTION].update_one({'_id': name}, {'$set': state['converting'], '$unset': {'converting': ''}})
+
+    source = load_schema(db, klass)
+    target = Schema(klass, compact, cents)
+    if temporary in db.list_collection_names():
+        db[temporary].delete_many({})
+    else:
+        db.create_collection(temporary)
+    db[COLLECTION].update_one({'_id': name}, {'$set': {'converting': target.state()}}, upsert=True)
+
+    total = 0
+    docs = []
+    for doc in db[name].find().sort('_id', pymongo.ASCENDING).batch_size(batch_size):
+        docs.append(target.to_document(source.from_document(doc)))
+        if len(docs) >= batch_size:
+            db[temporary].insert_many(docs, ordered=False)
+            total += len(docs)
+            docs = []
+    if docs:
+        db[temporary].insert_many(docs, ordered=False)
+        total += len(docs)
+
+    # a substituição descarta também os índices antigos, com os nomes anteriores dos campos
+    db[temporary].rename(name, dropTarget=True)
+    db[COLLECTION].update_one({'_id': name}, {'$set': target.state(), '$unset': {'converting': ''}})
+    ensure_indexes(db, spider, target)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converte o formato das coleções dos spiders.")
+    parser.add_argument('spiders', nargs='+', metavar='spider',
+                        help="caminho completo da classe, ex. ldch.spiders.tcm.TcmRemuneracaoSpider")
+    parser.add_argument('--compact', action='store_true', help="grava as chaves curtas dos campos")
+    parser.add_argument('--cents', action='store_true', help="grava os valores em reais como centavos")
+    options = parser.parse_args()
+
+    from ldch.spiders.base import Database, load_spiders
+
+    spiders = load_spiders(options.spiders)
+    if spiders is None:
+        return 1
+
+    with Database() as db:
+        for klass in spiders:
+            name = klass().name
+            before = collection_stats(db, name)
+            start = time.time()
+            try:
+                total = convert(db, klass, options.compact, options.cents, settings.MONGO_BATCH_SIZE)
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                return 1
+            after = collection_stats(db, name)
+            print("%s: %d documentos convertidos em %.1f s" % (klass.__name__, total, time.time() - start))
+            for key in ('size', 'avgObjSize', 'storageSize', 'totalIndexSize'):
+                print("  %-15s %12d -> %12d" % (key, before[key], after[key]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
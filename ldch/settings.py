@@ -17,10 +17,24 @@ del os
 # DOWNLOAD_DELAY = 1
 CONCURRENT_REQUESTS_PER_DOMAIN = 4
 
-AUTOTHROTTLE_ENABLED = True
+# Substituído pelo controle adaptativo (veja `ldch.throttle`)
+AUTOTHROTTLE_ENABLED = False
 AUTOTHROTTLE_START_DELAY = 5
 AUTOTHROTTLE_TARGET_CONCURRENCY = 4
 
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_MIN_CONCURRENCY = 1
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 16
+ADAPTIVE_THROTTLE_START_DELAY = 1       # Intervalo inicial entre requisições, em segundos
+ADAPTIVE_THROTTLE_MIN_DELAY = 0
+ADAPTIVE_THROTTLE_MAX_DELAY = 60
+ADAPTIVE_THROTTLE_TARGET_LATENCY = 2    # p90 da latência abaixo do qual a concorrência aumenta
+ADAPTIVE_THROTTLE_MAX_ERROR_RATE = 0.05 # Taxa de erros acima da qual a concorrência cai pela metade
+ADAPTIVE_THROTTLE_MAX_TIMEOUT_RATE = 0.1 # Taxa de timeouts acima da qual a concorrência cai pela metade
+ADAPTIVE_THROTTLE_ERROR_BURST = 5       # Erros numa janela que reduzem a concorrência imediatamente
+ADAPTIVE_THROTTLE_MIN_SAMPLES = 10      # Respostas numa janela necessárias para aumentar a concorrência
+ADAPTIVE_THROTTLE_INTERVAL = 10         # Duração da janela de avaliação, em segundos
+
 # Outros ajustes de download
 DOWNLOADER_STATS = True
 RANDOMIZE_DOWNLOAD_DELAY = True
@@ -30,15 +44,44 @@ DNS_TIMEOUT = 30
 
 DOWNLOADER_MIDDLEWARES = {
     'ldch.spiders.base.LdchMiddleware': 1000,
+    'ldch.scheduler.FrontierMiddleware': 990,
+    'ldch.retry.RetryQueueMiddleware': 550,
+    'ldch.offload.ParsePoolMiddleware': 500,
+    'ldch.throttle.AdaptiveThrottleMiddleware': 600,
+    'ldch.proxies.TorProxyMiddleware': 740,
     'scrapy.downloadermiddlewares.retry.RetryMiddleware': None
 }
 
+SPIDER_MIDDLEWARES = {
+    'ldch.pipelines.LdchPageMiddleware': 900
+}
+
 EXTENSIONS = {
     'ldch.spiders.base.LdchSignalHandler': 500
 }
 
+ITEM_PIPELINES = {
+    'ldch.pipelines.LdchMongoPipeline': 300
+}
+
 DUPEFILTER_CLASS = 'ldch.spiders.base.LdchDupeFilter'
 
+# Fila compartilhada no MongoDB para vários crawlers ao mesmo tempo (veja `ldch.scheduler`)
+# SCHEDULER = 'ldch.scheduler.MongoScheduler'
+SCHEDULER_COLLECTION = 'Frontier'
+SCHEDULER_LEASE_TIMEOUT = 600       # Segundos até que uma requisição reservada volte para a fila
+SCHEDULER_CLAIM_BATCH_SIZE = 50     # Requisições reservadas de uma vez
+SCHEDULER_POLL_INTERVAL = 1         # Espera entre consultas quando a fila está vazia
+SCHEDULER_MAX_ATTEMPTS = 3          # Reservas vencidas ou falhas de uma requisição antes de desistir dela
+SCHEDULER_DONE_TTL = 12 * 3600      # Segundos até que requisições baixadas ou abandonadas possam ser repetidas
+
+# Estrutura usada para guardar as requisições já vistas (veja `ldch.fingerprints`):
+# 'set' (padrão do Scrapy), 'sorted', 'bloom' ou 'mmap'
+DUPEFILTER_STORAGE = 'set'
+DUPEFILTER_BLOOM_CAPACITY = 10000000        # Quantidade esperada de requisições no modo 'bloom'
+DUPEFILTER_BLOOM_ERROR_RATE = 0.0001        # Taxa de falsos positivos no modo 'bloom'
+DUPEFILTER_FINGERPRINT_FILE = 'fingerprints.bin'    # Arquivo do modo 'mmap' (um por processo)
+
 
 #
 # Logging
@@ -54,20 +97,91 @@ DUPEFILTER_DEBUG = False
 #
 
 START_YEAR = 2014           # Ano de início para raspagem
+CRAWL_WORKERS = 1           # Processos entre os quais o trabalho dos spiders é dividido
+PLANNER_ENABLED = True      # Requisita apenas as competências ainda não raspadas (veja `ldch.planner`)
+PLANNER_REFRESH_MONTHS = 3  # Competências dos últimos X meses são sempre raspadas novamente
+RAW_STORE_ENABLED = True    # Guarda as respostas comprimidas na coleção `Raw` (veja `ldch.store`)
+RAW_STORE_COMPRESSION = 6   # Nível de compressão do zlib
 ENABLE_TOR_PROXY = False    # Habilita ou desabilita o uso do Tor
 TOR_CHANGE_CIRCUIT_INTERVAL_RANGE = (100, 400) # Solicita mudança de circuito Tor entre X e Y segundos
-SKIP_FAILED_URLS_HTTP_ERRORS = True     # Não repete requisições que resultaram em erros HTTP
+TOR_ROTATE_CIRCUITS = True  # Troca os circuitos periodicamente e quando um proxy acumula erros (veja `ldch.proxies`)
+TOR_MAX_ERROR_RATE = 0.3    # Taxa de erros, em média móvel, que antecipa a troca de circuito
+TOR_MIN_SAMPLES = 10        # Respostas necessárias antes de avaliar a taxa de erros de um proxy
+TOR_SMOOTHING = 0.2         # Peso de cada resposta nas médias móveis de latência e de erros
+TOR_DRAIN_TIMEOUT = 30      # Espera máxima pelas requisições em andamento antes de trocar o circuito
+TOR_CONTROL_PASSWORD = None # Senha das portas de controle do Tor
+SKIP_FAILED_URLS_HTTP_ERRORS = True     # Não repete requisições que resultaram em erros HTTP permanentes
 SKIP_FAILED_URLS_EXCEPTIONS = False     # Repete requisições que causaram exceções
+DUPEFILTER_LOAD_BATCH_SIZE = 10000      # Documentos lidos por lote ao carregar requisições já feitas
+MONGO_BATCH_SIZE = 1000     # Quantidade de itens acumulados antes de gravar no banco
+MONGO_FLUSH_INTERVAL = 5    # Grava os itens acumulados a cada X segundos
+MONGO_META_CACHE_SIZE = 10000   # Quantidade de páginas de `Meta` mantidas em cache
+RETRY_QUEUE_ENABLED = True          # Repete as falhas transitórias pela coleção `Retries` (veja `ldch.retry`)
+RETRY_QUEUE_MAX_ATTEMPTS = 5        # Tentativas antes de considerar a falha permanente
+RETRY_QUEUE_BACKOFF = 30            # Espera antes da segunda tentativa, dobrada a cada nova falha
+RETRY_QUEUE_MAX_DELAY = 6 * 3600    # Espera máxima entre tentativas
+RETRY_QUEUE_CONCURRENCY = 2         # Tentativas em andamento ao mesmo tempo
+RETRY_QUEUE_POLL_INTERVAL = 10      # Consulta as tentativas vencidas a cada X segundos
+RETRY_QUEUE_IDLE_WAIT = 120         # Mantém o spider aberto por tentativas previstas para os próximos X segundos
+ERRORS_BATCH_SIZE = 100     # Quantidade de erros acumulados antes de gravar no banco (veja `ldch.errors`)
+ERRORS_FLUSH_INTERVAL = 5   # Grava os erros acumulados a cada X segundos
+MONGO_ENSURE_INDEXES = True     # Cria os índices das coleções ao abrir cada spider (veja `ldch.indexes`)
+AGGREGATES_ENABLED = True   # Mantém os resumos por município, entidade e competência (veja `ldch.aggregates`)
+AGGREGATES_TETO = 39293.32  # Teto constitucional usado na contagem de remunerações acima dele
+EXPORT_BATCH_SIZE = 10000   # Documentos lidos e gravados por lote na exportação (veja `ldch.export`)
+EXPORT_SETTLE_TIME = 60     # Exportações incrementais deixam para a próxima os documentos dos últimos X segundos
+ITEM_STORAGE_COMPACT = False  # Coleções novas gravam as chaves curtas dos campos (veja `ldch.schema`)
+ITEM_STORAGE_CENTS = False    # Coleções novas gravam os valores em reais como centavos inteiros
+PARSE_POOL_ENABLED = False  # Converte as tabelas do TCE e os CSVs do TCM fora do reactor (veja `ldch.offload`)
+PARSE_POOL_MODE = 'process' # 'thread' ou 'process'
+PARSE_POOL_WORKERS = 2      # Conversões simultâneas
+PARSE_POOL_QUEUE_SIZE = 4   # Respostas aguardando conversão antes de segurar as novas requisições
+
+WEB_ARCHIVE_ENABLED = True          # Arquiva as páginas GET na web.archive.org
+WEB_ARCHIVE_URL = 'http://web.archive.org'
+WEB_ARCHIVE_CONCURRENCY = 2         # Submissões simultâneas
+WEB_ARCHIVE_MAX_PENDING = 1000      # Tamanho máximo da fila de arquivamento
+WEB_ARCHIVE_TIMEOUT = 60            # Tempo limite de cada requisição, em segundos
+WEB_ARCHIVE_MAX_RETRIES = 3         # Novas tentativas em caso de falha
+WEB_ARCHIVE_BACKOFF = 30            # Espera antes da primeira nova tentativa, dobrada a cada falha
+WEB_ARCHIVE_CACHE_TTL = 30 * 24 * 3600  # Validade do cache de URLs arquivadas, em segundos
+WEB_ARCHIVE_CACHE_SIZE = 10000      # Entradas do cache mantidas em memória
+
+API_PORT = 8080             # Porta da API de consulta aos dados (veja `ldch.api`)
+API_PAGE_SIZE = 100         # Itens por página quando `limit` não é informado
+API_MAX_PAGE_SIZE = 1000    # Maior `limit` aceito
+API_CACHE_SIZE = 1000       # Respostas mantidas em cache
+API_CACHE_TTL = 60          # Validade das respostas em cache, em segundos
+API_MONGO_POOL_SIZE = 10    # Conexões com o MongoDB, e consultas simultâneas
+API_INVALIDATION_INTERVAL = 10  # Verifica novas competências em `Coverage` a cada X segundos
+
+METRICS_ENABLED = True          # Mede o tempo de cada etapa do crawler (veja `ldch.metrics`)
+METRICS_PORT = 8888             # Porta do endpoint HTTP de métricas (None desabilita)
+METRICS_DUMP_INTERVAL = 60      # Registra um resumo dos tempos no log a cada X segundos
+METRICS_SAMPLE_RATE = 0.1       # Fração dos itens cronometrados nas etapas medidas por item
 
 # Opções para caso esteja utilizando o Docker
 if DOCKER:
     MONGO_URI = 'mongodb://ldch_mongo/ldch'
     HTTP_PROXY = 'http://ldch_torproxy:8118'
+    TOR_PROXIES = [             # Instâncias do Tor: proxy HTTP e porta de controle de cada uma
+        {'proxy': 'http://ldch_torproxy:8118', 'control_host': 'ldch_torproxy', 'control_port': 9051},
+        {'proxy': 'http://ldch_torproxy_2:8118', 'control_host': 'ldch_torproxy_2', 'control_port': 9051}
+    ]
+    METRICS_HOST = '0.0.0.0'    # Endereço do endpoint de métricas, exposto pelo docker-compose
+    API_HOST = '0.0.0.0'        # Endereço da API, exposta pelo docker-compose
 
 # Opções para caso contrário
 else:
     MONGO_URI = 'mongodb://localhost/ldch'      # Conexão com o MongoDB
     HTTP_PROXY = 'http://localhost:8118'        # Endereço do proxy HTTP para acesso do Tor
+    TOR_PROXIES = [                             # Instâncias do Tor: proxy HTTP e porta de controle de cada uma
+        {'proxy': HTTP_PROXY, 'control_host': '127.0.0.1', 'control_port': 9051}
+    ]
+    METRICS_HOST = '127.0.0.1'                  # Endereço do endpoint de métricas
+    API_HOST = '127.0.0.1'                      # Endereço da API
+
+MONGO_DATABASE = 'ldch'     # Banco onde os dados são armazenados
 
 
 USER_AGENTS = [
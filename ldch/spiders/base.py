@@ -1,10 +1,17 @@
+import argparse
+import collections
 import datetime
 import importlib
+import io
+import itertools
 import json
 import logging.handlers
-import sys
+import multiprocessing
+import os
+import pprint
+import queue
 import traceback
-from random import randint, choice
+from random import choice
 from urllib.parse import quote
 
 import pymongo
@@ -15,13 +22,20 @@ import scrapy.dupefilters
 import scrapy.exceptions
 import scrapy.item
 import scrapy.signals
-import stem
-import stem.control
+from bson.objectid import ObjectId
 from scrapy.crawler import CrawlerProcess
 from scrapy.settings import Settings
-from twisted.internet import reactor
-
-from ldch import settings
+from scrapy.utils.log import configure_logging
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_fingerprint
+from twisted.internet import task
+from twisted.internet.error import CannotListenError
+
+from ldch import errors, fingerprints, metrics, settings
+from ldch.converters import RowConverter, parse_float, parse_int
+from ldch.offload import iterate_items
+from ldch.schema import item_class
+from ldch.store import content_hash
 
 logger = logging.getLogger(__name__)
 
@@ -52,34 +66,48 @@ def date_range(start, end=None):
             yield (year, month)
 
 
-def parse_int(v):
-    return int(v.replace('.', ''))
-
-
-def parse_float(v):
-    return float(v.replace('.', '')
-                  .replace('%', '')
-                  .replace('R$', '')
-                  .replace(',', '.'))
-
-
-def change_tor_circuit():
-    with stem.control.Controller.from_port() as tor:
-        tor.authenticate()
-        tor.signal(stem.Signal.NEWNYM)
+def iter_lines(data, head=0, tail=0, separator=b'\r\n', encoding='utf-8', chunk_size=1 << 18):
+    """Itera as linhas de `data` sem decodificar o conteúdo inteiro.
 
+    Descarta as `head` primeiras e as `tail` últimas partes, como um
+    `split(separator)` seguido de fatiamento, mas decodifica blocos de
+    aproximadamente `chunk_size` bytes diretamente de uma memoryview. As
+    linhas terminam com '\\n', para que possam ser passadas ao módulo `csv`.
+    """
 
-def web_archive(url, user_agent=None, proxy=None):
+    start = 0
+    for _ in range(head):
+        start = data.find(separator, start)
+        if start < 0:
+            return iter(())
+        start += len(separator)
+
+    end = len(data)
+    for _ in range(tail):
+        end = data.rfind(separator, 0, end)
+        if end < 0:
+            return iter(())
+
+    def _chunks(start):
+        view = memoryview(data)
+        newline = separator.decode(encoding)
+        while start <= end:
+            stop = data.find(separator, min(start + chunk_size, end), end)
+            if stop < 0:
+                stop = end
+            text = str(view[start:stop], encoding).replace(newline, '\n')
+            yield io.StringIO(text + '\n')
+            start = stop + len(separator)
+
+    return itertools.chain.from_iterable(_chunks(start))
+
+
+def web_archive(url, user_agent=None, proxy=None,
+                base_url='http://web.archive.org', timeout=None):
     "Aciona arquivamento da web.archive.org e retorna a URL."
 
-    if not hasattr(web_archive, '_cache'):
-        web_archive._cache = {}
-
-    if url in web_archive._cache:
-        return web_archive._cache[url]
-
-    url1 = 'http://web.archive.org/save/' + url
-    url2 = 'http://web.archive.org/__wb/sparkline?output=json&collection=web&url='
+    url1 = base_url + '/save/' + url
+    url2 = base_url + '/__wb/sparkline?output=json&collection=web&url='
     url2 += quote(url)
 
     with requests.Session() as session:
@@ -87,17 +115,52 @@ def web_archive(url, user_agent=None, proxy=None):
             session.proxies.update({'http': proxy})
         if user_agent is not None:
             session.headers.update({'User-Agent': user_agent})
-        session.get(url1)
-        req2 = session.get(url2)
+        session.get(url1, timeout=timeout)
+        req2 = session.get(url2, timeout=timeout)
+        req2.raise_for_status()
     payload = json.loads(req2.content.decode())
 
-    wa_url = 'http://web.archive.org/web/%s/%s' % (payload['last_ts'], url)
-    web_archive._cache[url] = wa_url
-    return wa_url
+    return 'http://web.archive.org/web/%s/%s' % (payload['last_ts'], url)
+
+
+class LRUCache:
+    "Dicionário de tamanho limitado que descarta os itens usados há mais tempo."
+
+    def __init__(self, size):
+        self.size = size
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return None
+        self.data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+
+def legacy_fingerprint(doc):
+    "Calcula a impressão digital de um documento de `Meta` ou `Errors` sem o campo `fingerprint`."
+
+    request = scrapy.Request(doc['url'], method=doc.get('method', 'GET'), body=doc['request_body'])
+    return request_fingerprint(request)
 
 
 def register_error(type, request=None, spider=None, **data):
-    """Registra erros no banco."""
+    """Registra erros no banco.
+
+    Durante a raspagem, os erros são acumulados e gravados em lotes (veja
+    `ldch.errors`); fora dela, são gravados imediatamente.
+    """
 
     error = {
         'type': type,
@@ -107,14 +170,20 @@ def register_error(type, request=None, spider=None, **data):
         error.update({
             'url': request.url,
             'method': request.method,
-            'request_body': request.body.decode()
+            'request_body': request.body.decode(),
+            'fingerprint': request_fingerprint(request)
         })
     if spider:
         error['spider'] = spider.name
     if data:
         error.update(data)
+
+    if errors.sink.active:
+        errors.sink.add(error)
+        return
+    error['signature'] = errors.signature(error)
     with Database() as db:
-        db['Errors'].insert_one(error)
+        errors.write(db, [error])
 
 
 class Database:
@@ -125,7 +194,7 @@ class Database:
         self.db = pymongo.MongoClient(settings.MONGO_URI)
 
     def __enter__(self):
-        return self.db.__enter__()['ldch']
+        return self.db.__enter__()[settings.MONGO_DATABASE]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.db.__exit__(exc_type, exc_val, exc_tb)
@@ -145,9 +214,7 @@ class LdchMiddleware:
         user_agent = choice(settings.USER_AGENTS)
         request.headers.setdefault(b'User-Agent', user_agent)
 
-        # atribúi o proxy
-        if settings.ENABLE_TOR_PROXY:
-            request.meta['proxy'] = settings.HTTP_PROXY
+        # o proxy do Tor é atribuído pelo `TorProxyMiddleware` (veja `ldch.proxies`)
 
     def process_exception(self, request, exception, spider):
         if isinstance(exception, scrapy.exceptions.IgnoreRequest):
@@ -165,16 +232,95 @@ class LdchMiddleware:
 
 
 class LdchSignalHandler:
-    "Lida com sinais do Scrapy."
+    """Lida com sinais do Scrapy.
+
+    Os erros são acumulados e gravados em lotes enquanto houver um spider
+    aberto (veja `ldch.errors`).
+
+    Também configura as métricas de tempo das etapas (veja `ldch.metrics`):
+    mede a latência de download, inicia o endpoint HTTP em `METRICS_PORT`,
+    registra um resumo no log a cada `METRICS_DUMP_INTERVAL` segundos e, ao
+    fechar o spider, copia o resumo para as estatísticas do Scrapy.
+    """
+
+    def __init__(self, stats=None, port=None, host='127.0.0.1', dump_interval=0, settings=None):
+        self.settings = settings
+        # com a fila de repetições (veja `ldch.retry`), os erros HTTP são registrados por ela
+        self.http_errors = settings is None or not settings.getbool('RETRY_QUEUE_ENABLED', True)
+        self.stats = stats
+        self.port = port
+        self.host = host
+        self.dump_interval = dump_interval
+        self.dumper = None
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
-        ext = cls()
+        metrics.registry.configure(crawler.settings)
+        port = None
+        if metrics.registry.enabled:
+            port = crawler.settings.get('METRICS_PORT')
+        ext = cls(
+            stats=crawler.stats,
+            port=int(port) if port else None,
+            host=crawler.settings.get('METRICS_HOST', '127.0.0.1'),
+            dump_interval=crawler.settings.getfloat('METRICS_DUMP_INTERVAL', 0),
+            settings=crawler.settings
+        )
+        crawler.signals.connect(ext.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=scrapy.signals.spider_closed)
         crawler.signals.connect(ext.spider_error, signal=scrapy.signals.spider_error)
-        crawler.signals.connect(ext.item_scraped, signal=scrapy.signals.item_scraped)
         crawler.signals.connect(ext.response_downloaded, signal=scrapy.signals.response_downloaded)
         return ext
 
+    def spider_opened(self, spider):
+        if self.settings is not None:
+            errors.sink.start(
+                self.settings.get('MONGO_URI'),
+                database=self.settings.get('MONGO_DATABASE', 'ldch'),
+                batch_size=self.settings.getint('ERRORS_BATCH_SIZE', 100),
+                flush_interval=self.settings.getfloat('ERRORS_FLUSH_INTERVAL', 5)
+            )
+        if not metrics.registry.enabled:
+            return
+        metrics.registry.stats[spider.name] = self.stats
+        if self.port is not None:
+            try:
+                metrics.metrics_server.start(self.port, self.host)
+            except CannotListenError:
+                logger.warning("Impossível abrir o endpoint de métricas na porta %d" % self.port)
+                self.port = None
+        if self.dump_interval > 0:
+            self.dumper = task.LoopingCall(self.dump, spider)
+            self.dumper.start(self.dump_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.settings is not None:
+            errors.sink.stop()
+        if self.dumper is not None and self.dumper.running:
+            self.dumper.stop()
+        if not metrics.registry.enabled:
+            return
+        self.dump(spider)
+        for stage, summary in metrics.registry.summary(spider.name).get(spider.name, {}).items():
+            for key, value in summary.items():
+                if value is not None:
+                    self.stats.set_value('ldch/timing/%s/%s' % (stage, key), value)
+        metrics.registry.stats.pop(spider.name, None)
+        if self.port is not None:
+            return metrics.metrics_server.stop()
+
+    def dump(self, spider):
+        "Registra no log um resumo dos tempos das etapas do spider."
+
+        stages = metrics.registry.summary(spider.name).get(spider.name)
+        if not stages:
+            return
+        parts = []
+        for stage, summary in sorted(stages.items()):
+            parts.append('%s n=%d p50=%.4f p99=%.4f max=%.4f' % (
+                stage, summary['count'], summary['p50'], summary['p99'], summary['max']))
+        logger.info("Tempos de %s: %s" % (spider.name, '; '.join(parts)))
+
     def spider_error(self, failure, response, spider):
         "Registra exceções no banco de dados."
 
@@ -185,39 +331,14 @@ class LdchSignalHandler:
             traceback=failure.getTraceback()
         )
 
-    def item_scraped(self, item, response, spider):
-        "Salva itens no banco de dados."
-
-        logger.debug("Salvando item %r %s" % (response.request, item))
-        try:
-            result = None
-            with Database(clear_exceptions=False) as db:
-                new_page = {
-                    'url': response.url,
-                    'request_body': response.request.body.decode()
-                }
-                page = db['Meta'].find_one(new_page)
-                if page:
-                    page_id = page['_id']
-                else:
-                    if response.request.method == 'GET':
-                         new_page['web_archive'] = self._web_archive(response.url)
-
-                    new_page['when'] = datetime.datetime.now()
-                    result = db['Meta'].insert_one(new_page)
-                    page_id = result.inserted_id
-
-                item['__meta'] = page_id
-                db[spider.name].insert_one(item)
-        except pymongo.errors.PyMongoError:
-            logger.exception("Falha ao salvar item %r" % response.request)
-            if result:
-                db['Meta'].remove({'_id': result.inserted_id})
-
     def response_downloaded(self, response, request, spider):
         "Registra erros HTTP no banco de dados."
 
-        if response.status >= 400:
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            metrics.registry.observe('download', spider.name, latency)
+
+        if response.status >= 400 and self.http_errors:
             register_error(
                 'http_error',
                 request=request,
@@ -225,54 +346,107 @@ class LdchSignalHandler:
                 status=response.status
             )
 
-    @classmethod
-    def _web_archive(cls, url):
-        try:
-            user_agent = choice(settings.USER_AGENTS)
-            proxy = None
-            if settings.ENABLE_TOR_PROXY:
-                proxy = settings.HTTP_PROXY
-            return web_archive(url, user_agent, proxy)
-        except:
-            msg = "Falha ao registrar URL em web.archive.org: %s" % url
-            logger.exception(msg)
-            register_error(
-                'web_archive_error',
-                url=url
-            )
-            return None
-
 
 class LdchDupeFilter(scrapy.dupefilters.RFPDupeFilter):
-    "Ignora requisições duplicadas, inclusive as já registradas previamente no banco."
+    """Ignora requisições duplicadas, inclusive as já registradas previamente no banco.
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    As impressões digitais das requisições são gravadas em `Meta` e `Errors`
+    no momento da escrita e apenas carregadas aqui. Documentos antigos, sem
+    o campo `fingerprint`, são convertidos como antes; use o comando
+    `ldch_fingerprints` para preenchê-los de uma vez.
 
-        for request in self.find_requests_to_ignore():
-            self.request_seen(request)
+    A estrutura que guarda as impressões digitais é definida por
+    `DUPEFILTER_STORAGE` (veja `ldch.fingerprints`). No modo 'mmap', as
+    impressões digitais vêm do arquivo e só os documentos gravados depois
+    do maior `_id` registrado nele são lidos do banco.
+    """
 
-    @classmethod
-    def find_requests_to_ignore(cls):
-        def _find():
-            with Database() as db:
-                query = {'url': {'$exists': True}}
-                fields = {'url': 1, 'request_body': 1}
-                for meta in db['Meta'].find(query, fields):
-                    yield meta
+    def __init__(self, path=None, debug=False, storage=None):
+        super().__init__(path, debug)
+        if storage is not None:
+            storage.update(self.fingerprints)
+            self.fingerprints = storage
 
-                if settings.SKIP_FAILED_URLS_HTTP_ERRORS:
-                    query['type'] = 'http_error'
-                    for url in db['Errors'].find(query, fields):
-                        yield url
+        with Database() as db:
+            if hasattr(self.fingerprints, 'resume'):
+                self._resume(db)
+            else:
+                for fp in self.find_fingerprints_to_ignore(db):
+                    self.fingerprint_seen(fp)
 
-                if settings.SKIP_FAILED_URLS_EXCEPTIONS:
-                    query['type'] = 'downloader_exception'
-                    for url in db['Errors'].find(query, fields):
-                        yield url
+    @classmethod
+    def from_settings(cls, settings):
+        debug = settings.getbool('DUPEFILTER_DEBUG')
+        return cls(job_dir(settings), debug, fingerprints.from_settings(settings))
+
+    def close(self, reason):
+        super().close(reason)
+        if hasattr(self.fingerprints, 'close'):
+            self.fingerprints.close()
+
+    def fingerprint_seen(self, fp):
+        if fp in self.fingerprints:
+            return True
+        self.fingerprints.add(fp)
+        if self.file:
+            self.file.write(fp + os.linesep)
+
+    def _resume(self, db):
+        # o arquivo já tem as confirmadas até o maior `_id` de cada origem lido antes
+        sources = [name for name, _, _ in self.fingerprint_sources()]
+        after = {name: ObjectId(value) for name, value in self.fingerprints.resume(sources).items()}
+        high_water = dict(after)
+        for fp in self.find_fingerprints_to_ignore(db, after=after, high_water=high_water):
+            self.fingerprints.confirm(fp)
+        for name, value in high_water.items():
+            self.fingerprints.advance(name, str(value))
+
+    @staticmethod
+    def fingerprint_sources():
+        "Origens das impressões digitais a ignorar: nome, coleção e filtro."
+
+        sources = [('Meta', 'Meta', {})]
+        if settings.SKIP_FAILED_URLS_HTTP_ERRORS:
+            sources.append(('Errors:http_error', 'Errors', {'type': 'http_error'}))
+        if settings.SKIP_FAILED_URLS_EXCEPTIONS:
+            sources.append(('Errors:downloader_exception', 'Errors', {'type': 'downloader_exception'}))
+        return sources
 
-        for url in _find():
-            yield scrapy.Request(url['url'], body=url['request_body'])
+    @classmethod
+    def find_fingerprints_to_ignore(cls, db, batch_size=None, after=None, high_water=None):
+        """Gera as impressões digitais dos documentos de `fingerprint_sources`.
+
+        Com `after`, lê apenas os documentos com `_id` maior que o de cada
+        origem; `high_water` recebe o maior `_id` lido de cada uma.
+        """
+
+        if batch_size is None:
+            batch_size = settings.DUPEFILTER_LOAD_BATCH_SIZE
+
+        for name, collection, query in cls.fingerprint_sources():
+            if after and name in after:
+                query = dict(query, _id={'$gt': after[name]})
+
+            def track(doc):
+                if high_water is not None and (name not in high_water or doc['_id'] > high_water[name]):
+                    high_water[name] = doc['_id']
+
+            query = dict(query, fingerprint={'$exists': True})
+            fields = {'_id': 1, 'fingerprint': 1}
+            for doc in db[collection].find(query, fields).batch_size(batch_size):
+                track(doc)
+                yield doc['fingerprint']
+
+            query = dict(query, url={'$exists': True}, fingerprint={'$exists': False})
+            fields = {'_id': 1, 'url': 1, 'request_body': 1}
+            legacy = 0
+            for doc in db[collection].find(query, fields).batch_size(batch_size):
+                legacy += 1
+                track(doc)
+                yield legacy_fingerprint(doc)
+            if legacy:
+                logger.warning("%d documentos de %s sem impressão digital; execute ldch_fingerprints" %
+                               (legacy, collection))
 
 
 class LdchSpider(scrapy.Spider):
@@ -282,6 +456,25 @@ class LdchSpider(scrapy.Spider):
     """
 
     fields = None
+    # campos preenchidos pelo spider além dos de `fields` (competência, entidade...)
+    context_fields = ()
+
+    # campos que identificam uma linha, usados nos upserts (veja `ldch.indexes`)
+    natural_key = None
+    # índices adicionais da coleção do spider
+    indexes = ()
+    # campo resumido em `Summaries` e, opcionalmente, o do desconto do teto (veja `ldch.aggregates`)
+    summary_value = None
+    summary_teto = None
+    # chave curta de cada campo e campos em reais, para os itens tipados e o banco (veja `ldch.schema`)
+    stored_keys = None
+    money_fields = ()
+    # pool das conversões, definido pelo `ParsePoolMiddleware` com PARSE_POOL_ENABLED (veja `ldch.offload`)
+    parse_pool = None
+
+    # parte do trabalho feita por este processo no modo com vários processos
+    shard_index = 0
+    shard_count = 1
 
     @property
     def name(self):
@@ -289,29 +482,114 @@ class LdchSpider(scrapy.Spider):
         assert name.endswith("Spider"), "Nome do spider deve terminar com 'Spider'"
         return name[:name.index('Spider')]
 
+    @property
+    def converter(self):
+        "Conversor de linhas compilado a partir de `fields`, compartilhado pelas instâncias da classe."
+
+        cls = type(self)
+        converter = cls.__dict__.get('_converter')
+        if converter is None:
+            converter = cls._converter = RowConverter(
+                cls.fields, item_class=item_class(cls) if cls.stored_keys else dict)
+        return converter
+
+    def shard(self, iterable):
+        """Filtra os elementos de `iterable` que cabem a este processo.
+
+        Os elementos são distribuídos alternadamente entre os `shard_count`
+        processos, de modo que cada um receba uma parte equilibrada do
+        trabalho e nenhum elemento seja feito duas vezes.
+        """
+
+        shard_count = int(self.shard_count)
+        if shard_count <= 1:
+            return iter(iterable)
+        return itertools.islice(iterable, int(self.shard_index), None, shard_count)
+
+    def offload(self, response, func, *args):
+        """Converte `response` com `func(*args)` no pool de parse.
+
+        `func` deve retornar o resultado de `collect_items`. Retorna um
+        Deferred com os itens. Respostas iguais às da raspagem anterior não
+        vão ao pool, pois o `LdchPageMiddleware` descarta os itens delas.
+        """
+
+        cobertura = response.meta.get('cobertura')
+        if cobertura is not None and cobertura.get('hash') == content_hash(response.body):
+            return ()
+        d = self.parse_pool.submit(func, *args)
+        d.addCallback(iterate_items, self.converter.item_class)
+        return d
+
     def list_to_item(self, args):
         "Transforma uma lista num item de acordo com os campos e validação da variável `fields`."
 
-        if self.fields is not None and len(args) != len(self.fields):
-            raise ValueError("Quantidade de elementos diferente da de campos.")
-
-        result = {}
-        for (name, parser), value in zip(self.fields, args):
-            value = value.strip()
-            if value in ['', '-']:
-                value = None
-            result[name] = parser(value)
-
-        return result
+        return self.converter.list_to_item(args)
 
     def dict_to_item(self, dict):
         "Transforma dicionário num item de acordo com os campos e validação da variável `fields`."
 
-        if len(dict) != len(self.fields):
-            raise ValueError("Length of dictionary is different from fields")
-        for name, converter in self.fields:
-            dict[name] = converter(dict[name])
-        return dict
+        return self.converter.dict_to_item(dict)
+
+    def table_to_items(self, rows):
+        """Transforma uma tabela (lista de listas) em itens.
+
+        Converte a tabela de uma vez, coluna a coluna. Se alguma célula for
+        inválida, refaz a conversão linha a linha para que os itens
+        anteriores ao erro sejam gerados antes da exceção, como em
+        `list_to_item`.
+        """
+
+        try:
+            with metrics.registry.timer('conversion', self.name):
+                items = self.converter.convert_table(rows)
+        except Exception:
+            items = (self.list_to_item(row) for row in rows)
+        for item in items:
+            yield item
+
+    def records_to_items(self, header, rows, ignore=('',)):
+        """Transforma linhas de um CSV com cabeçalho `header` em itens.
+
+        Equivale a passar cada linha de um `csv.DictReader` para
+        `dict_to_item` após remover as colunas em `ignore`, mas converte o
+        lote inteiro coluna a coluna quando as linhas estão completas.
+        """
+
+        rows = [row for row in rows if row]
+        names = [name for name in header if name not in ignore]
+        complete = (
+            len(names) + len(ignore) == len(header) and
+            sorted(names) == sorted(self.converter.names) and
+            all(len(row) == len(header) for row in rows)
+        )
+
+        items = None
+        if complete:
+            columns = [column for name, column in zip(header, zip(*rows)) if name not in ignore]
+            try:
+                with metrics.registry.timer('conversion', self.name):
+                    items = self.converter.convert_columns(names, columns) if rows else []
+            except Exception:
+                pass
+
+        if items is None:
+            items = (self.dict_to_item(self._record(header, row, ignore)) for row in rows)
+        for item in items:
+            yield item
+
+    @staticmethod
+    def _record(header, row, ignore):
+        # mesmas regras de `csv.DictReader`
+        record = dict(zip(header, row))
+        if len(header) < len(row):
+            record[None] = row[len(header):]
+        elif len(header) > len(row):
+            for key in header[len(row):]:
+                record[key] = None
+        for key in ignore:
+            del record[key]
+        return record
 
 
 class TorTestSpider(LdchSpider):
@@ -328,23 +606,11 @@ class TorTestSpider(LdchSpider):
         }
 
 
-def run_spiders():
-
-    # alguma duração dentro do intervalo de troca de circuit
-    def random_wait_time():
-        start, end = settings.TOR_CHANGE_CIRCUIT_INTERVAL_RANGE
-        return randint(start, end)
-
-    # solicita ao TOR para trocar de circuito
-    def change_tor_circuit_randomly():
-        try:
-            change_tor_circuit()
-        finally:
-            reactor.callLater(random_wait_time(), change_tor_circuit_randomly)
+def load_spiders(paths):
+    "Carrega as classes de spiders a partir de seus caminhos completos."
 
-    # carrega classes de spiders passadas em sys.argv
-    spiders = set()
-    for arg in sys.argv[1:]:
+    spiders = []
+    for arg in paths:
         last_dot = arg.rfind('.')
         module_name = arg[:last_dot]
         klass_name = arg[last_dot+1:]
@@ -352,27 +618,191 @@ def run_spiders():
         try:
             module = importlib.import_module(module_name)
             klass = getattr(module, klass_name)
-            spiders.add(klass)
         except (ImportError, AttributeError):
             logger.critical('Impossível encontrar %s' % arg)
-            return 1
+            return None
+        if klass not in spiders:
+            spiders.append(klass)
+    return spiders
+
+
+def shard_settings(scrapy_settings, shard_index, shard_count):
+    """Ajusta as configurações de um dos `shard_count` processos do modo com vários processos.
+
+    Os limites de concorrência por domínio são divididos entre os processos,
+    para que o total continue respeitando os servidores.
+    """
+
+    per_domain = scrapy_settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+    scrapy_settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', max(1, per_domain // shard_count))
+    target = scrapy_settings.getfloat('AUTOTHROTTLE_TARGET_CONCURRENCY')
+    scrapy_settings.set('AUTOTHROTTLE_TARGET_CONCURRENCY', max(1.0, target / shard_count))
+    maximum = scrapy_settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 16)
+    scrapy_settings.set('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', max(1, maximum // shard_count))
+
+    # apenas um dos processos troca os circuitos do Tor
+    if shard_index > 0:
+        scrapy_settings.set('TOR_ROTATE_CIRCUITS', False)
+
+    port = scrapy_settings.get('METRICS_PORT')
+    if port:
+        scrapy_settings.set('METRICS_PORT', int(port) + shard_index)
+    jobdir = scrapy_settings.get('JOBDIR')
+    if jobdir:
+        scrapy_settings.set('JOBDIR', os.path.join(jobdir, 'shard-%d' % shard_index))
+    # cada processo reescreve o seu arquivo de impressões digitais ao terminar
+    path = scrapy_settings.get('DUPEFILTER_FINGERPRINT_FILE')
+    if path:
+        scrapy_settings.set('DUPEFILTER_FINGERPRINT_FILE', '%s.shard-%d' % (path, shard_index))
+
+
+def crawl(spiders, shard_index=0, shard_count=1):
+    """Executa os spiders num único reactor e retorna as estatísticas de cada um.
+
+    Com `shard_count` maior que 1, cada spider recebe apenas a parte
+    `shard_index` do trabalho (veja `LdchSpider.shard`).
+    """
 
     # cria o crawler
     scrapy_settings = Settings()
     scrapy_settings.setmodule(settings)
+    if shard_count > 1:
+        shard_settings(scrapy_settings, shard_index, shard_count)
     proc = CrawlerProcess(scrapy_settings)
 
     # registra spiders
+    crawlers = []
     for klass in spiders:
-        proc.crawl(klass)
-
-    # solicita a troca de circuito periodicamente
-    if settings.ENABLE_TOR_PROXY:
-        reactor.callLater(random_wait_time(), change_tor_circuit_randomly)
+        crawler = proc.create_crawler(klass)
+        crawlers.append(crawler)
+        proc.crawl(crawler, shard_index=shard_index, shard_count=shard_count)
 
     # inicia o processo
     proc.start()
 
+    return {crawler.spider.name: crawler.stats.get_stats()
+            for crawler in crawlers if crawler.spider is not None}
+
+
+def _crawl_shard(paths, shard_index, shard_count, results):
+    stats = None
+    try:
+        stats = crawl(load_spiders(paths), shard_index, shard_count)
+    finally:
+        results.put((shard_index, stats))
+
+
+_MAX_SUFFIXES = ('max', '/startup', '/p50', '/p90', '/p99', '_last')
+
+
+def merge_stats(all_stats):
+    "Junta as estatísticas de um spider vindas de vários processos."
+
+    merged = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if key not in merged:
+                merged[key] = value
+            elif isinstance(value, bool) or not isinstance(value, (int, float, datetime.datetime)):
+                continue
+            elif key == 'start_time':
+                merged[key] = min(merged[key], value)
+            elif isinstance(value, datetime.datetime) or key.endswith(_MAX_SUFFIXES):
+                merged[key] = max(merged[key], value)
+            else:
+                merged[key] += value
+    return merged
+
+
+def crawl_sharded(paths, shard_count):
+    """Divide o trabalho dos spiders entre `shard_count` processos, cada um com seu reactor.
+
+    Todos carregam as requisições já feitas do mesmo banco pelo
+    `LdchDupeFilter`. Ao final, as estatísticas são somadas e registradas
+    no log. Retorna o número de processos que falharam.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = []
+    for i in range(shard_count):
+        worker = context.Process(target=_crawl_shard, args=(paths, i, shard_count, results),
+                                 name='ldch-shard-%d' % i)
+        worker.start()
+        workers.append(worker)
+
+    collected = {}
+    while len(collected) < shard_count:
+        try:
+            shard_index, stats = results.get(timeout=5)
+            collected[shard_index] = stats
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+    for worker in workers:
+        worker.join()
+
+    failed = [i for i, worker in enumerate(workers)
+              if worker.exitcode != 0 or collected.get(i) is None]
+    for i in failed:
+        logger.error("Processo %d terminou com falha (código %s)" % (i, workers[i].exitcode))
+
+    by_spider = {}
+    for stats in collected.values():
+        for name, spider_stats in (stats or {}).items():
+            by_spider.setdefault(name, []).append(spider_stats)
+    for name, all_stats in sorted(by_spider.items()):
+        logger.info("Estatísticas de %s em %d processos:\n%s" %
+                    (name, len(all_stats), pprint.pformat(merge_stats(all_stats))))
+    return len(failed)
+
+
+def run_spiders():
+    parser = argparse.ArgumentParser(description="Executa os spiders do LDCH.")
+    parser.add_argument('spiders', nargs='+', metavar='spider',
+                        help="caminho completo da classe, ex. ldch.spiders.tce.TceRemuneracaoSpider")
+    parser.add_argument('-w', '--workers', type=int, default=settings.CRAWL_WORKERS,
+                        help="quantidade de processos entre os quais o trabalho é dividido")
+    options = parser.parse_args()
+
+    # carrega classes de spiders passadas na linha de comando
+    spiders = load_spiders(options.spiders)
+    if spiders is None:
+        return 1
+
+    if options.workers <= 1:
+        crawl(spiders)
+        return
+
+    scrapy_settings = Settings()
+    scrapy_settings.setmodule(settings)
+    configure_logging(scrapy_settings)
+    if crawl_sharded(options.spiders, options.workers):
+        return 1
+
+
+def migrate_fingerprints():
+    "Preenche o campo `fingerprint` dos documentos antigos de `Meta` e `Errors`."
+
+    batch_size = settings.DUPEFILTER_LOAD_BATCH_SIZE
+    with Database() as db:
+        for collection in ('Meta', 'Errors'):
+            query = {'url': {'$exists': True}, 'fingerprint': {'$exists': False}}
+            fields = {'url': 1, 'method': 1, 'request_body': 1}
+            updates = []
+            total = 0
+            for doc in db[collection].find(query, fields).batch_size(batch_size):
+                fp = legacy_fingerprint(doc)
+                updates.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {'fingerprint': fp}}))
+                if len(updates) >= batch_size:
+                    db[collection].bulk_write(updates, ordered=False)
+                    total += len(updates)
+                    updates = []
+            if updates:
+                db[collection].bulk_write(updates, ordered=False)
+                total += len(updates)
+            print("%s: %d documentos atualizados" % (collection, total))
+
 
 if __name__ == '__main__':
     run_spiders()
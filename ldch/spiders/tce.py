@@ -1,11 +1,59 @@
 from urllib.parse import urlencode
 
 import scrapy
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
 
 from ldch import settings
+from ldch.planner import CoveragePlanner
+from ldch.offload import collect_items
 from ldch.spiders.base import LdchSpider, parse_float, date_range
 
 
+# Expressões compiladas uma única vez e aplicadas diretamente à árvore do lxml,
+# sem criar um `Selector` para cada linha
+_CARGOS = etree.XPath("//b[contains(text(), 'CARGO:')]/../text()", smart_strings=False)
+_COMPETENCIA = etree.XPath("//b[contains(text(), 'Mês/Ano')]/../text()", smart_strings=False)
+_TABELAS = etree.XPath(HTMLTranslator().css_to_xpath('.cTable tbody'))
+_LINHAS = etree.XPath(HTMLTranslator().css_to_xpath('tr'))
+_CELULAS = etree.XPath('td/text()', smart_strings=False)
+
+
+def extrair_tabelas(root):
+    """Extrai os cargos, a competência e as linhas de cada tabela da página consolidada.
+
+    `root` é o elemento raiz do documento no lxml. Retorna a lista de
+    cargos, a competência ('mês/ano') e uma lista de tabelas, cada uma
+    com as células de suas linhas, na ordem dos cargos.
+    """
+
+    cargos = (p.strip() for p in _CARGOS(root)[3:])
+    cargos = [p for p in cargos if p != ""]
+
+    competencia = _COMPETENCIA(root)
+    competencia = competencia[0].strip() if competencia else None
+
+    tabelas = []
+    for tbody in _TABELAS(root):
+        linhas = []
+        for tr in _LINHAS(tbody):
+            celulas = _CELULAS(tr)
+            if len(celulas) == 1:
+                assert celulas[0].strip().startswith("* A remuneração")
+                continue
+            linhas.append(celulas)
+        tabelas.append(linhas)
+
+    return cargos, competencia, tabelas
+
+
+def converter_consolidado(body, encoding):
+    "Itens de uma página consolidada, convertidos no pool de parse (veja `ldch.offload`)."
+
+    root = etree.fromstring(body, etree.HTMLParser(recover=True, encoding=encoding))
+    return collect_items(TceRemuneracaoSpider().itens_consolidado(root))
+
+
 class TceRemuneracaoSpider(LdchSpider):
     "Raspa a Tabela de Remuneração consolidada do TCE"
 
@@ -18,9 +66,38 @@ class TceRemuneracaoSpider(LdchSpider):
         ('Dedução previdência', parse_float), ('Teto constitucional', parse_float),
         ('Total de descontos', parse_float), ('Remuneração líquida', parse_float)
     )
+    context_fields = ('Cargo', 'Competência')
+    summary_value = 'Total da remuneração'
+    summary_teto = 'Teto constitucional'
+
+    stored_keys = {
+        'Cargo': 'ca', 'Competência': 'co', 'Matrícula': 'ma', 'Nome': 'no', 'Cargo comissionado': 'cc',
+        'Vencimento básico': 'vb', 'Percentual Adicional': 'pa', 'Valor adicional': 'va',
+        'Remuneração variável': 'rv', 'Outras vantagens': 'ov', 'CET/RTI': 'ct',
+        'Abono permanência': 'ap', 'Total da remuneração': 'tr', 'Dedução IR': 'ir',
+        'Dedução previdência': 'dp', 'Teto constitucional': 'tc', 'Total de descontos': 'td',
+        'Remuneração líquida': 'rl'
+    }
+    money_fields = tuple(name for name, parser in fields
+                         if parser is parse_float and name != 'Percentual Adicional')
+
+    # a página de uma competência tem uma tabela por cargo, e nada garante que
+    # uma matrícula apareça em apenas uma delas; o cargo também identifica a linha
+    natural_key = ('Matrícula', 'Cargo', 'Competência')
+    indexes = (('Competência',), ('Cargo',))
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.planner = CoveragePlanner.from_settings(crawler.settings, spider.name)
+        return spider
 
     def start_requests(self):
-        for ano, mes in date_range(settings.START_YEAR):
+        for ano, mes in self.shard(date_range(settings.START_YEAR)):
+            cobertura = self.planner.plan('consolidado', ano, mes)
+            if cobertura is None:
+                continue
+
             url = 'https://www.tce.ba.gov.br/component/cdsremuneracao/?' + urlencode({
                 'ano': ano,
                 'mes': mes,
@@ -29,25 +106,21 @@ class TceRemuneracaoSpider(LdchSpider):
                 'view': 'consolidado'
 
             })
-            yield scrapy.Request(url, callback=self.parse_tabela)
+            yield scrapy.Request(url, callback=self.parse_tabela, meta={'cobertura': cobertura},
+                                 dont_filter=cobertura.get('refresh', False))
 
     def parse_tabela(self, response):
-        cargos = response.xpath("//b[contains(text(), 'CARGO:')]/../text()").extract()[3:]
-        cargos = (p.strip() for p in cargos)
-        cargos = [p for p in cargos if p != ""]
+        if self.parse_pool is not None:
+            return self.offload(response, converter_consolidado, response.body, response.encoding)
+        return self.itens_consolidado(response.selector.root)
 
-        competencia = response.xpath("//b[contains(text(), 'Mês/Ano')]/../text()").extract_first().strip()
+    def itens_consolidado(self, root):
+        cargos, competencia, tabelas = extrair_tabelas(root)
         mes, ano = competencia.split('/')
 
         i = None
-        for i, table in enumerate(response.css('.cTable tbody')):
-            for remuneracao in table.css('tr'):
-                remuneracao = remuneracao.xpath('td/text()').extract()
-                if len(remuneracao) == 1:
-                    assert remuneracao[0].strip().startswith("* A remuneração")
-                    continue
-
-                remuneracao = self.list_to_item(remuneracao)
+        for i, linhas in enumerate(tabelas):
+            for remuneracao in self.table_to_items(linhas):
                 remuneracao['Cargo'] = cargos[i].strip()
                 remuneracao['Competência'] = '%s-%s' % (mes, ano)
                 yield remuneracao
@@ -1,12 +1,39 @@
 import csv
 import datetime
-import io
+import itertools
 import json
+import os
+import shutil
+import tempfile
 from urllib.parse import urlencode
 
 import scrapy
+import scrapy.exceptions
+import scrapy.signals
+from queuelib import FifoDiskQueue
+from scrapy.utils.job import job_dir
 
-from ldch.spiders.base import LdchSpider, parse_float
+from ldch.planner import CoveragePlanner
+from ldch.offload import collect_items
+from ldch.spiders.base import LdchSpider, iter_lines, parse_float
+
+
+def competencias(ano, mes=1):
+    "Competências (ano, mês) a partir de `ano`/`mes` até o mês seguinte ao atual."
+
+    agora = datetime.datetime.now()
+    for ano in range(ano, agora.year + 1):
+        for mes in range(mes, 13):
+            if ano == agora.year and mes > agora.month + 1:
+                return
+            yield ano, mes
+        mes = 1
+
+
+def converter_exportacao(body, municipio, entidade, competencia):
+    "Itens de uma exportação CSV, convertidos no pool de parse (veja `ldch.offload`)."
+
+    return collect_items(TcmRemuneracaoSpider().itens_exportacao(body, municipio, entidade, competencia))
 
 
 class TcmRemuneracaoSpider(LdchSpider):
@@ -19,12 +46,39 @@ class TcmRemuneracaoSpider(LdchSpider):
         ('Salário Vantagens', parse_float),
         ('Salário Gratificação', parse_float)
     ]
+    context_fields = ('Município', 'Entidade', 'Competência')
+    summary_value = 'Salário Base'
+
+    stored_keys = {
+        'Município': 'mu', 'Entidade': 'en', 'Competência': 'co', 'Nome': 'no', 'Matrícula': 'ma',
+        'Tipo Servidor': 'ts', 'Cargo': 'ca', 'Salário Base': 'sb', 'Salário Vantagens': 'sv',
+        'Salário Gratificação': 'sg'
+    }
+    money_fields = ('Salário Base', 'Salário Vantagens', 'Salário Gratificação')
+
+    # a matrícula só é única dentro da entidade, e um servidor pode ter mais de um cargo
+    natural_key = ('Município', 'Entidade', 'Competência', 'Matrícula', 'Cargo')
+    indexes = (('Competência',), ('Município', 'Entidade', 'Competência'))
+
+    batch_size = 1000   # Linhas do CSV convertidas de uma vez
+    lote_requisicoes = 100  # Requisições de CSVs geradas de uma vez quando o scheduler se esvazia
+
+    _pendentes = None
+    _atual = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.planner = CoveragePlanner.from_settings(crawler.settings, spider.name)
+        crawler.signals.connect(spider.spider_idle, signal=scrapy.signals.spider_idle)
+        crawler.signals.connect(spider.spider_closed, signal=scrapy.signals.spider_closed)
+        return spider
 
     def parse(self, response):
         municipios_id = response.xpath("//select[@id='municipios']/option[@value != '']/@value").extract()
         municipios_nome = response.xpath("//select[@id='municipios']/option[@value != '']/text()").extract()
 
-        for municipio_id, municipio_nome in zip(municipios_id, municipios_nome):
+        for municipio_id, municipio_nome in self.shard(zip(municipios_id, municipios_nome)):
             url = "http://www.tcm.ba.gov.br/Webservice/public/index.php/entidades?" + urlencode({
                 'cdMunicipio': municipio_id.strip()
             })
@@ -34,42 +88,140 @@ class TcmRemuneracaoSpider(LdchSpider):
             yield scrapy.Request(url, meta=meta, callback=self.extrair_entidades)
 
     def extrair_entidades(self, response):
+        # as requisições dos CSVs são geradas aos poucos por `proximas_requisicoes`
         entidades = json.loads(response.body_as_unicode())
 
         for entidade in entidades:
-            entidade_id = entidade['cdEntidade'].strip()
-            entidade_nome = entidade['dsEntidade'].strip()
-
-            agora = datetime.datetime.now()
-            ano = self.settings['START_YEAR']
-            for ano in range(ano, agora.year + 1):
-                for mes in range(1, 13):
-                    if ano == agora.year and mes > agora.month + 1:
-                        continue
-
-                    url = "http://www.tcm.ba.gov.br/Webservice/public/index.php/exportar/pessoal?" + urlencode({
-                        'entidades': entidade_id,
-                        'ano': str(ano),
-                        'mes': str(mes),
-                        'tipo': 'csv'
-                    })
-                    meta = {
-                        'competencia': '%d-%02d' % (ano, mes),
-                        'entidade_nome': entidade_nome,
-                        'municipio_nome': response.meta['municipio_nome']
-                    }
-                    yield scrapy.Request(url, callback=self.extrair_tabela, meta=meta)
+            self.pendentes.push(json.dumps([
+                entidade['cdEntidade'].strip(),
+                entidade['dsEntidade'].strip(),
+                response.meta['municipio_nome'],
+                self.settings['START_YEAR'],
+                1
+            ]).encode())
+        return ()
+
+    @property
+    def pendentes(self):
+        """Fila em disco das entidades cujos CSVs ainda não foram requisitados.
+
+        Cada entrada guarda a entidade, o município e a primeira competência
+        a requisitar. Fica em `JOBDIR`, quando definido, para que a raspagem
+        possa ser retomada; caso contrário, num diretório temporário.
+        """
+
+        if self._pendentes is None:
+            jobdir = job_dir(self.settings)
+            if jobdir:
+                self._pendentes_dir = os.path.join(jobdir, 'tcm_entidades')
+            else:
+                self._pendentes_dir = tempfile.mkdtemp(prefix='ldch-tcm-')
+            self._pendentes = FifoDiskQueue(self._pendentes_dir)
+        return self._pendentes
+
+    def proximas_requisicoes(self, quantidade):
+        "Gera até `quantidade` requisições de CSVs a partir da fila de entidades."
+
+        while quantidade > 0:
+            if self._atual is None:
+                entrada = self.pendentes.pop()
+                if entrada is None:
+                    return
+                entidade_id, entidade_nome, municipio_nome, ano, mes = json.loads(entrada.decode())
+                self._atual = (entidade_id, entidade_nome, municipio_nome, competencias(ano, mes))
+
+            entidade_id, entidade_nome, municipio_nome, meses = self._atual
+            competencia = next(meses, None)
+            if competencia is None:
+                self._atual = None
+                continue
+
+            ano, mes = competencia
+            cobertura = self.planner.plan(entidade_id, ano, mes)
+            if cobertura is None:
+                continue
+
+            url = "http://www.tcm.ba.gov.br/Webservice/public/index.php/exportar/pessoal?" + urlencode({
+                'entidades': entidade_id,
+                'ano': str(ano),
+                'mes': str(mes),
+                'tipo': 'csv'
+            })
+            meta = {
+                'competencia': '%d-%02d' % (ano, mes),
+                'entidade_nome': entidade_nome,
+                'municipio_nome': municipio_nome,
+                'cobertura': cobertura
+            }
+            quantidade -= 1
+            yield scrapy.Request(url, callback=self.extrair_tabela, meta=meta,
+                                 dont_filter=cobertura.get('refresh', False))
+
+    def spider_idle(self, spider):
+        """Alimenta o scheduler quando ele se esvazia.
+
+        Gera lotes de `lote_requisicoes` até que alguma requisição seja
+        aceita (as já feitas são descartadas pelo dupefilter) e mantém o
+        spider aberto enquanto houver entidades pendentes.
+        """
+
+        engine = self.crawler.engine
+        while True:
+            requisicoes = list(self.proximas_requisicoes(self.lote_requisicoes))
+            if not requisicoes:
+                return
+            for requisicao in requisicoes:
+                engine.crawl(requisicao, self)
+            if engine.slot.scheduler.has_pending_requests():
+                raise scrapy.exceptions.DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self._pendentes is None:
+            return
+
+        # devolve à fila o restante da entidade em andamento
+        if self._atual is not None:
+            entidade_id, entidade_nome, municipio_nome, meses = self._atual
+            competencia = next(meses, None)
+            if competencia is not None:
+                self._pendentes.push(json.dumps(
+                    [entidade_id, entidade_nome, municipio_nome] + list(competencia)).encode())
+            self._atual = None
+
+        self._pendentes.close()
+        self._pendentes = None
+        if not job_dir(self.settings):
+            shutil.rmtree(self._pendentes_dir, ignore_errors=True)
 
     def extrair_tabela(self, response):
-        texto = response.body.decode()
-        texto = texto.split('\r\n')[2:-2]
-        texto = '\n'.join(texto)
-
-        for linha in csv.DictReader(io.StringIO(texto)):
-            del linha['']
-            remuneracao = self.dict_to_item(linha)
-            remuneracao['Município'] = response.meta['municipio_nome']
-            remuneracao['Entidade'] = response.meta['entidade_nome']
-            remuneracao['Competência'] = response.meta['competencia']
-            yield remuneracao
+        # cada CSV recebido libera espaço para uma nova requisição. Ela é
+        # enviada aqui, e não gerada com os itens, porque a saída de um CSV
+        # igual ao da raspagem anterior é descartada pelo `LdchPageMiddleware`
+        # e a da conversão no pool só chega depois dela
+        for requisicao in self.proximas_requisicoes(1):
+            self.crawler.engine.crawl(requisicao, self)
+
+        contexto = (response.meta['municipio_nome'], response.meta['entidade_nome'],
+                    response.meta['competencia'])
+        if self.parse_pool is None:
+            return self.itens_exportacao(response.body, *contexto)
+        return self.offload(response, converter_exportacao, response.body, *contexto)
+
+    def itens_exportacao(self, body, municipio, entidade, competencia):
+        # ignora as duas linhas de cabeçalho e as duas de rodapé
+        linhas = csv.reader(iter_lines(body, head=2, tail=2))
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+
+        while True:
+            lote = list(itertools.islice(linhas, self.batch_size))
+            if not lote:
+                break
+
+            for remuneracao in self.records_to_items(cabecalho, lote):
+                remuneracao['Município'] = municipio
+                remuneracao['Entidade'] = entidade
+                remuneracao['Competência'] = competencia
+                yield remuneracao
 
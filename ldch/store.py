@@ -0,0 +1,55 @@
+"""Armazenamento das respostas brutas, comprimidas e endereçadas pelo conteúdo.
+
+Cada corpo de resposta é gravado uma única vez na coleção `Raw`, tendo
+como `_id` o seu SHA1, o mesmo registrado em `Coverage`. Os documentos de
+`Meta` apontam para ele no campo `raw`, o que permite reprocessar as
+páginas sem acessar a rede (veja `ldch.reparse`).
+"""
+import datetime
+import hashlib
+import zlib
+
+import bson
+import pymongo.errors
+
+COLLECTION = 'Raw'
+
+
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class RawStore:
+    "Coleção de corpos de respostas comprimidos com zlib."
+
+    def __init__(self, db, compression=6):
+        self.collection = db[COLLECTION]
+        self.compression = compression
+
+    def put(self, body, digest=None):
+        """Grava `body`, se ainda não existir, e retorna o seu hash.
+
+        Retorna None se o corpo comprimido não couber num documento.
+        """
+
+        if digest is None:
+            digest = content_hash(body)
+        data = zlib.compress(body, self.compression)
+        try:
+            self.collection.insert_one({
+                '_id': digest,
+                'body': bson.Binary(data),
+                'size': len(body),
+                'stored': datetime.datetime.now()
+            })
+        except pymongo.errors.DuplicateKeyError:
+            pass
+        except pymongo.errors.DocumentTooLarge:
+            return None
+        return digest
+
+    def get(self, digest):
+        doc = self.collection.find_one({'_id': digest}, {'body': 1})
+        if doc is None:
+            return None
+        return zlib.decompress(doc['body'])
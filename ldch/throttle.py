@@ -0,0 +1,200 @@
+"""Controle adaptativo da concorrência e do intervalo entre requisições por domínio.
+
+Substitui o AutoThrottle do Scrapy, que só considera a latência. A cada
+`ADAPTIVE_THROTTLE_INTERVAL` segundos, cada slot de download (um por
+domínio) é avaliado com as respostas da janela:
+
+* se a taxa de erros (respostas 429/5xx e exceções) passou de
+  `ADAPTIVE_THROTTLE_MAX_ERROR_RATE` ou a de timeouts passou de
+  `ADAPTIVE_THROTTLE_MAX_TIMEOUT_RATE`, a concorrência cai pela metade e o
+  intervalo dobra. A taxa de timeouts considera ao menos
+  `ADAPTIVE_THROTTLE_MIN_SAMPLES` respostas, para que um único timeout
+  numa janela com poucas respostas não reduza a concorrência;
+* se o p90 da latência passou do dobro de `ADAPTIVE_THROTTLE_TARGET_LATENCY`,
+  a concorrência diminui em um;
+* se a janela está saudável, com ao menos `ADAPTIVE_THROTTLE_MIN_SAMPLES`
+  respostas e p90 abaixo do alvo, a concorrência aumenta em um e o
+  intervalo cai pela metade, até zero. Enquanto houver intervalo, o
+  Scrapy envia uma requisição por vez ao domínio.
+
+Uma rajada de `ADAPTIVE_THROTTLE_ERROR_BURST` erros dentro da janela reduz
+a concorrência imediatamente, sem esperar a avaliação. As decisões ficam
+nas estatísticas (`ldch/throttle/*`) e no log.
+
+A concorrência inicial é `CONCURRENT_REQUESTS_PER_DOMAIN`.
+"""
+import logging
+
+import scrapy.exceptions
+import scrapy.signals
+from twisted.internet import defer, error, task
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_EXCEPTIONS = (defer.TimeoutError, error.TimeoutError, error.TCPTimedOutError)
+
+
+class _Window:
+
+    __slots__ = ('latencies', 'errors', 'timeouts')
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.timeouts = 0
+
+    @property
+    def count(self):
+        return len(self.latencies) + self.errors + self.timeouts
+
+    def p90(self):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(0.9 * (len(latencies) - 1))]
+
+
+class AdaptiveThrottleMiddleware:
+    "Middleware de download que ajusta a concorrência e o intervalo de cada slot."
+
+    def __init__(self, crawler, min_concurrency=1, max_concurrency=16,
+                 start_delay=1, min_delay=0, max_delay=60, target_latency=2, max_error_rate=0.05,
+                 max_timeout_rate=0.1, error_burst=5, min_samples=10, interval=10):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.start_delay = start_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.max_timeout_rate = max_timeout_rate
+        self.error_burst = error_burst
+        self.min_samples = min_samples
+        self.interval = interval
+
+        self.windows = {}
+        self.spider = None
+        self.evaluator = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED', True):
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(
+            crawler,
+            min_concurrency=settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY', 1),
+            max_concurrency=settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 16),
+            start_delay=settings.getfloat('ADAPTIVE_THROTTLE_START_DELAY', 1),
+            min_delay=settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0),
+            max_delay=settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 60),
+            target_latency=settings.getfloat('ADAPTIVE_THROTTLE_TARGET_LATENCY', 2),
+            max_error_rate=settings.getfloat('ADAPTIVE_THROTTLE_MAX_ERROR_RATE', 0.05),
+            max_timeout_rate=settings.getfloat('ADAPTIVE_THROTTLE_MAX_TIMEOUT_RATE', 0.1),
+            error_burst=settings.getint('ADAPTIVE_THROTTLE_ERROR_BURST', 5),
+            min_samples=settings.getint('ADAPTIVE_THROTTLE_MIN_SAMPLES', 10),
+            interval=settings.getfloat('ADAPTIVE_THROTTLE_INTERVAL', 10)
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=scrapy.signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=scrapy.signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        # o Scrapy usa `download_delay` como intervalo inicial dos slots
+        spider.download_delay = self.start_delay
+        self.evaluator = task.LoopingCall(self.evaluate)
+        self.evaluator.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.evaluator is not None and self.evaluator.running:
+            self.evaluator.stop()
+
+    def process_response(self, request, response, spider):
+        window = self._window(request)
+        if window is not None:
+            if response.status == 429 or response.status >= 500:
+                window.errors += 1
+                self._check_burst(request.meta['download_slot'], window)
+            else:
+                window.latencies.append(request.meta.get('download_latency', 0))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        window = self._window(request)
+        if window is None or isinstance(exception, scrapy.exceptions.IgnoreRequest):
+            return
+        if isinstance(exception, TIMEOUT_EXCEPTIONS):
+            window.timeouts += 1
+        else:
+            window.errors += 1
+        self._check_burst(request.meta['download_slot'], window)
+
+    def evaluate(self):
+        "Avalia a janela de cada slot e ajusta a concorrência e o intervalo."
+
+        for key, window in list(self.windows.items()):
+            slot = self._slot(key)
+            if slot is None:
+                del self.windows[key]
+                continue
+            self.windows[key] = _Window()
+            if not window.count:
+                continue
+
+            error_rate = window.errors / window.count
+            timeout_rate = window.timeouts / max(window.count, self.min_samples)
+            p90 = window.p90()
+            if error_rate > self.max_error_rate or timeout_rate > self.max_timeout_rate:
+                self._back_off(key, slot, 'erros %.0f%%, timeouts %.0f%%' %
+                               (100 * error_rate, 100 * timeout_rate))
+            elif p90 is not None and p90 > 2 * self.target_latency:
+                self._adjust(key, slot, slot.concurrency - 1, slot.delay, 'latency',
+                             'p90 %.2f s' % p90)
+            elif window.count >= self.min_samples and p90 is not None and p90 <= self.target_latency:
+                delay = slot.delay / 2 if slot.delay > 0.1 else 0
+                self._adjust(key, slot, slot.concurrency + 1, delay, 'increase', 'p90 %.2f s' % p90)
+
+    def _check_burst(self, key, window):
+        if window.errors + window.timeouts >= self.error_burst:
+            slot = self._slot(key)
+            if slot is not None:
+                self.windows[key] = _Window()
+                self._back_off(key, slot, 'rajada de %d erros' % (window.errors + window.timeouts))
+
+    def _back_off(self, key, slot, reason):
+        self._adjust(key, slot, slot.concurrency // 2, max(slot.delay * 2, 0.5), 'backoff', reason)
+
+    def _adjust(self, key, slot, concurrency, delay, decision, reason):
+        concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        delay = min(max(delay, self.min_delay), self.max_delay)
+        if concurrency == slot.concurrency and delay == slot.delay:
+            return
+        logger.info("Throttle %s: concorrência %d -> %d, intervalo %.2f -> %.2f s (%s)" %
+                    (key, slot.concurrency, concurrency, slot.delay, delay, reason))
+        slot.concurrency = concurrency
+        slot.delay = delay
+        self._set_stats(key, slot)
+        if self.stats is not None:
+            self.stats.inc_value('ldch/throttle/%s' % decision, spider=self.spider)
+
+    def _set_stats(self, key, slot):
+        if self.stats is not None:
+            self.stats.set_value('ldch/throttle/%s/concurrency' % key, slot.concurrency, spider=self.spider)
+            self.stats.set_value('ldch/throttle/%s/delay' % key, slot.delay, spider=self.spider)
+
+    def _window(self, request):
+        key = request.meta.get('download_slot')
+        window = self.windows.get(key)
+        if window is None and key is not None and self._slot(key) is not None:
+            window = self.windows[key] = _Window()
+            self._set_stats(key, self._slot(key))
+        return window
+
+    def _slot(self, key):
+        engine = self.crawler.engine
+        if engine is None:
+            return None
+        return engine.downloader.slots.get(key)
@@ -8,11 +8,23 @@ setup(
         'paramiko',
         'pymongo',
         'requests',
-        'Scrapy',
+        'Scrapy>=1.4,<2',
         'stem',
         'Twisted'
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'test': ['mongomock>=3.15', 'pytest']
+    },
     entry_points = {
-        'console_scripts': ['start_ldch = ldch.spiders.base:run_spiders']
+        'console_scripts': [
+            'start_ldch = ldch.spiders.base:run_spiders',
+            'ldch_fingerprints = ldch.spiders.base:migrate_fingerprints',
+            'ldch_reparse = ldch.reparse:main',
+            'ldch_export = ldch.export:main',
+            'ldch_summaries = ldch.aggregates:main',
+            'ldch_api = ldch.api:main',
+            'ldch_schema = ldch.schema:main'
+        ]
     }
 )
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""Configuração comum dos testes.
+
+Os testes usam o `mongomock` no lugar do MongoDB e os servidores falsos de
+`benchmarks` (`server.FixtureServer` e `proxies.FakeTor`) no lugar dos
+portais, da web.archive.org e do Tor:
+
+    $ pip install -e .[test]
+    $ python -m pytest tests
+"""
+import argparse
+import os
+import sys
+import threading
+
+import mongomock
+import pymongo
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from ldch import settings  # noqa: E402
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Cliente do `mongomock` devolvido por todo `pymongo.MongoClient` criado no teste.
+
+    Um único cliente, para que o código testado e o teste vejam os mesmos
+    dados mesmo quando o código abre as próprias conexões.
+    """
+
+    client = mongomock.MongoClient()
+    client.close = lambda: None
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+    return client
+
+
+@pytest.fixture
+def db(request, mongo):
+    "Banco do LDCH no `mongomock`; também em `self.db` nos testes em classes."
+
+    database = mongo[settings.MONGO_DATABASE]
+    if request.instance is not None:
+        request.instance.db = database
+    return database
+
+
+@pytest.fixture
+def fixture_server(request):
+    "Servidor local de respostas (`benchmarks/server.py`); também em `self.server`."
+
+    import server
+
+    parser = argparse.ArgumentParser()
+    server.add_arguments(parser)
+    instance = server.FixtureServer(('127.0.0.1', 0), parser.parse_args([]))
+    thread = threading.Thread(target=instance.serve_forever)
+    thread.daemon = True
+    thread.start()
+    instance.url = 'http://127.0.0.1:%d' % instance.server_address[1]
+    if request.instance is not None:
+        request.instance.server = instance
+    yield instance
+    instance.shutdown()
+    instance.server_close()
@@ -0,0 +1,28 @@
+"Auxiliares comuns dos testes."
+import time
+
+from twisted.internet import defer, reactor, task
+
+
+class Stats:
+    "Estatísticas do Scrapy em memória."
+
+    def __init__(self):
+        self.values = {}
+
+    def inc_value(self, key, count=1, spider=None):
+        self.values[key] = self.values.get(key, 0) + count
+
+    def set_value(self, key, value, spider=None):
+        self.values[key] = value
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout=10):
+    "Espera, sem bloquear o reactor, até que `condition()` seja verdadeira."
+
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Condição não atingida em %d s" % timeout)
+        yield task.deferLater(reactor, 0.01, lambda: None)
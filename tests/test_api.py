@@ -0,0 +1,92 @@
+import pytest
+
+from ldch.api import Api
+from ldch.schema import convert
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+
+def row(i, municipio='Município 1'):
+    return {
+        'Município': municipio,
+        'Entidade': 'Prefeitura',
+        'Competência': '2017-01',
+        'Nome': 'Servidor %d' % i,
+        'Matrícula': str(i),
+        'Cargo': 'Professor',
+        'Salário Base': 1000.5
+    }
+
+
+@pytest.fixture
+def api(db):
+    db['TcmRemuneracao'].insert_many([row(i, 'Município %d' % (i % 2)) for i in range(25)])
+    return Api('mongodb://localhost/ldch', cache_ttl=0)
+
+
+def pages(api, name, **filters):
+    "Percorre as páginas de `name` seguindo os cursores; retorna os itens de cada uma."
+
+    endpoint = api.endpoints[name]
+    args = {key.encode(): [str(value).encode()] for key, value in filters.items()}
+    result = []
+    while True:
+        query, after, limit = endpoint.parse(args)
+        items, next_cursor = endpoint.fetch(api.db, query, after, limit)
+        result.append(items)
+        if next_cursor is None:
+            return result
+        args[b'after'] = [next_cursor.encode()]
+
+
+def matriculas(result):
+    return [item['Matrícula'] for page in result for item in page]
+
+
+def test_pages_follow_cursor(api):
+    result = pages(api, 'tcm', limit=10)
+    assert [len(page) for page in result] == [10, 10, 5]
+    assert matriculas(result) == [str(i) for i in range(25)]
+    assert '_id' not in result[0][0]
+
+
+def test_last_full_page_has_no_cursor(api):
+    assert [len(page) for page in pages(api, 'tcm', limit=5)] == [5] * 5
+
+
+def test_filters(api):
+    result = pages(api, 'tcm', limit=4, **{'Município': 'Município 1'})
+    assert [len(page) for page in result] == [4, 4, 4]
+    assert matriculas(result) == [str(i) for i in range(1, 25, 2)]
+
+
+def test_cursor_is_stable_across_inserts(api, db):
+    endpoint = api.endpoints['tcm']
+    items, next_cursor = endpoint.fetch(api.db, {}, None, 10)
+    # linhas novas entram depois do cursor, sem repetir nem pular as anteriores
+    db['TcmRemuneracao'].insert_one(row(25))
+    query, after, limit = endpoint.parse({b'after': [next_cursor.encode()], b'limit': [b'100']})
+    items, next_cursor = endpoint.fetch(api.db, query, after, limit)
+    assert [item['Matrícula'] for item in items] == [str(i) for i in range(10, 26)]
+    assert next_cursor is None
+
+
+def test_compact_collection(api, db):
+    convert(db, TcmRemuneracaoSpider, True, True)
+    # os nomes dos filtros e dos campos não mudam com o formato da coleção
+    api = Api('mongodb://localhost/ldch', cache_ttl=0)
+
+    result = pages(api, 'tcm', limit=10, **{'Município': 'Município 0'})
+    assert matriculas(result) == [str(i) for i in range(0, 25, 2)]
+    assert result[0][0]['Salário Base'] == 1000.5
+    assert 'mu' not in result[0][0]
+
+
+@pytest.mark.parametrize('args', [
+    {b'after': [b'invalid']},
+    {b'limit': [b'0']},
+    {b'limit': [b'1001']},
+    {b'Nome': [b'Servidor 1']}
+])
+def test_invalid_arguments(api, args):
+    with pytest.raises(ValueError):
+        api.endpoints['tcm'].parse(args)
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+from twisted.internet import defer, threads
+from twisted.trial import unittest
+
+from helpers import wait_for
+from ldch.archive import WebArchiveQueue
+
+
+@pytest.mark.usefixtures('db', 'fixture_server')
+class WebArchiveQueueTest(unittest.TestCase):
+
+    def queue(self, host, **kwargs):
+        self.db['Meta'].insert_one({'_id': 1, 'url': 'http://example.com/', 'web_archive_pending': True})
+        return WebArchiveQueue(self.db, base_url='%s/%s' % (self.server.url, host),
+                               max_retries=0, backoff=0, **kwargs)
+
+    @defer.inlineCallbacks
+    def test_archives_page(self):
+        queue = self.queue('web.archive.org')
+        queue.submit('http://example.com/', 1)
+        yield wait_for(lambda: not len(queue))
+        yield queue.close()
+
+        page = self.db['Meta'].find_one({'_id': 1})
+        self.assertTrue(page['web_archive'].endswith('/http://example.com/'))
+        self.assertNotIn('web_archive_pending', page)
+        self.assertEqual(self.db['WebArchive'].find_one({'_id': 'http://example.com/'})['web_archive'],
+                         page['web_archive'])
+
+    @defer.inlineCallbacks
+    def test_close_waits_for_give_up(self):
+        "`close` só termina após gravar a desistência de um arquivamento que falhou."
+
+        # o servidor responde 404 fora de web.archive.org
+        queue = self.queue('offline')
+        started = threading.Event()
+        proceed = threading.Event()
+        update_page = queue._update_page
+
+        def _update_page(page_id, wa_url):
+            started.set()
+            proceed.wait(10)
+            update_page(page_id, wa_url)
+
+        queue._update_page = _update_page
+        queue.submit('http://example.com/', 1)
+        yield threads.deferToThread(started.wait, 10)
+
+        closed = queue.close()
+        self.assertFalse(closed.called)
+        proceed.set()
+        yield closed
+
+        page = self.db['Meta'].find_one({'_id': 1})
+        self.assertIsNone(page['web_archive'])
+        self.assertNotIn('web_archive_pending', page)
+        self.assertEqual(self.db['Errors'].count_documents({'type': 'web_archive_error'}), 1)
+
+    @defer.inlineCallbacks
+    def test_close_keeps_interrupted_pages_pending(self):
+        "Arquivamentos interrompidos por `close` continuam pendentes para a próxima execução."
+
+        queue = self.queue('offline', concurrency=1)
+        self.db['Meta'].insert_one({'_id': 2, 'url': 'http://example.com/2', 'web_archive_pending': True})
+        queue.submit('http://example.com/', 1)
+        queue.submit('http://example.com/2', 2)
+        yield queue.close()
+
+        self.assertFalse(queue.submit('http://example.com/3', 3))
+        self.assertEqual(self.db['Meta'].count_documents({'web_archive_pending': True}), 2)
+        self.assertEqual(self.db['Errors'].count_documents({}), 0)
@@ -0,0 +1,126 @@
+import socket
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from scrapy.settings import Settings
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from helpers import Stats, wait_for
+from ldch.proxies import ProxyPool
+from proxies import FakeTor
+
+
+@pytest.mark.usefixtures('fixture_server')
+class ProxyPoolTest(unittest.TestCase):
+
+    def start(self, *tors):
+        "Conjunto com um proxy por instância falsa do Tor, como `TOR_PROXIES`."
+
+        for tor in tors:
+            tor.start()
+            self.addCleanup(tor.stop)
+        pool = ProxyPool()
+        pool.configure(Settings({
+            'TOR_PROXIES': [tor.config() for tor in tors],
+            'TOR_MIN_SAMPLES': 3,
+            'TOR_CHANGE_CIRCUIT_INTERVAL_RANGE': [1000, 2000]
+        }))
+        pool.stats.append(Stats())
+        for proxy in pool.proxies:
+            self.addCleanup(proxy.controller.close)
+        return pool
+
+    def fetch(self, pool, proxy):
+        "Faz uma requisição ao servidor local por `proxy` e a registra no conjunto."
+
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': proxy.url}))
+        start = time.time()
+        try:
+            with opener.open(self.server.url + '/web.archive.org/__wb/sparkline') as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        pool.finished(proxy, time.time() - start, status >= 500)
+        return status
+
+    @defer.inlineCallbacks
+    def test_failing_proxy_is_evicted_until_new_circuit(self):
+        bad, good = FakeTor(error_rate=1), FakeTor()
+        pool = self.start(bad, good)
+        # o proxy bom começa com latência alta, para que o ruim seja escolhido primeiro
+        pool.proxies[1].latency = 10
+
+        held = pool.choose()
+        self.assertEqual(held.index, 0)
+        for _ in range(3):
+            proxy = pool.choose()
+            self.assertEqual(proxy.index, 0)
+            self.assertEqual(self.fetch(pool, proxy), 503)
+        self.assertTrue(held.draining)
+
+        # durante a troca, as requisições novas vão para o outro proxy
+        for _ in range(5):
+            proxy = pool.choose()
+            self.assertEqual(proxy.index, 1)
+            self.assertEqual(self.fetch(pool, proxy), 200)
+
+        # o NEWNYM espera a requisição em andamento no proxy ruim
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(bad.newnyms, 0)
+        self.fetch(pool, held)
+        yield wait_for(lambda: not held.draining)
+
+        self.assertEqual(bad.newnyms, 1)
+        self.assertEqual(good.newnyms, 0)
+        self.assertEqual((held.error_rate, held.samples, held.in_flight), (0, 0, 0))
+        self.assertEqual(pool.stats[0].values['ldch/proxy/0/rotations'], 1)
+        held.in_flight += 1
+        self.assertEqual(self.fetch(pool, held), 200)
+
+    @defer.inlineCallbacks
+    def test_single_proxy_is_used_while_draining(self):
+        tor = FakeTor()
+        pool = self.start(tor)
+        proxy = pool.choose()
+        pool.drain(proxy)
+
+        self.assertIs(pool.choose(), proxy)
+        self.assertEqual(proxy.in_flight, 2)
+        pool.release(proxy)
+        pool.release(proxy)
+        yield wait_for(lambda: not proxy.draining)
+        self.assertEqual(tor.newnyms, 1)
+
+    @defer.inlineCallbacks
+    def test_scheduled_rotation(self):
+        first, second = FakeTor(), FakeTor()
+        pool = self.start(first, second)
+        pool.proxies[0].next_rotation = 0
+        pool.proxies[1].next_rotation = time.time() + 1000
+        pool.check()
+        pool.checker.cancel()
+
+        yield wait_for(lambda: not pool.proxies[0].draining)
+        self.assertEqual((first.newnyms, second.newnyms), (1, 0))
+        self.assertGreater(pool.proxies[0].next_rotation, time.time() + 900)
+
+    @defer.inlineCallbacks
+    def test_failed_rotation_returns_proxy(self):
+        # porta de controle sem ninguém escutando
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        tor = FakeTor()
+        pool = self.start(tor)
+        proxy = pool.proxies[0]
+        proxy.controller.port = port
+        pool.drain(proxy)
+
+        yield wait_for(lambda: not proxy.draining)
+        self.assertEqual(pool.stats[0].values['ldch/proxy/0/rotation_failures'], 1)
+        self.assertIs(pool.choose(), proxy)
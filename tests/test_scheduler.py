@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+import scrapy
+from scrapy.dupefilters import RFPDupeFilter
+
+from ldch.scheduler import MongoScheduler
+
+
+def scheduler(node, max_attempts=3):
+    "Um crawler (`node`) da fila compartilhada, com o banco do `mongomock`."
+
+    instance = MongoScheduler(RFPDupeFilter(), 'mongodb://localhost/ldch', lease_timeout=600,
+                              poll_interval=0, max_attempts=max_attempts)
+    instance.node = node
+    instance.open(scrapy.Spider(name='test'))
+    return instance
+
+
+def expire_leases(db):
+    "Simula o fim das reservas vigentes, como as de um crawler que morreu."
+
+    past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    db['Frontier'].update_many({'state': 'leased'}, {'$set': {'lease_until': past}})
+
+
+@pytest.fixture
+def nodes(db):
+    return scheduler('a'), scheduler('b')
+
+
+def test_request_is_claimed_once(db, nodes):
+    a, b = nodes
+    assert a.enqueue_request(scrapy.Request('http://example.com/1'))
+    # já enfileirada pelo outro crawler
+    assert not b.enqueue_request(scrapy.Request('http://example.com/1'))
+
+    request = a.next_request()
+    assert request.url == 'http://example.com/1'
+    assert b.next_request() is None
+    assert b.has_pending_requests()
+
+    doc = db['Frontier'].find_one()
+    assert (doc['state'], doc['owner'], doc['attempts']) == ('leased', 'a', 1)
+
+
+def test_expired_lease_is_claimed_again(db, nodes):
+    a, b = nodes
+    a.enqueue_request(scrapy.Request('http://example.com/1'))
+    a.next_request()
+    expire_leases(db)
+
+    request = b.next_request()
+    assert request.url == 'http://example.com/1'
+    doc = db['Frontier'].find_one()
+    assert (doc['state'], doc['owner'], doc['attempts']) == ('leased', 'b', 2)
+
+    b.response_received(None, request, b.spider)
+    assert db['Frontier'].find_one()['state'] == 'done'
+    assert not a.has_pending_requests()
+
+
+def test_request_is_abandoned_after_max_attempts(db):
+    a, b = scheduler('a', max_attempts=2), scheduler('b', max_attempts=2)
+    a.enqueue_request(scrapy.Request('http://example.com/1'))
+    a.next_request()
+    expire_leases(db)
+    b.next_request()
+    expire_leases(db)
+
+    assert a.next_request() is None
+    assert not a.has_pending_requests()
+    assert not b.has_pending_requests()
+    assert db['Frontier'].find_one()['state'] == 'failed'
+    errors = list(db['Errors'].find({'type': 'frontier_exhausted'}))
+    assert len(errors) == 1
+    assert (errors[0]['url'], errors[0]['attempts']) == ('http://example.com/1', 2)
+
+
+def test_release_counts_failures(db, nodes):
+    a, b = nodes
+    a.enqueue_request(scrapy.Request('http://example.com/1'))
+    for attempt in range(3):
+        request = (a, b)[attempt % 2].next_request()
+        assert request is not None
+        (a, b)[attempt % 2].release(request)
+
+    doc = db['Frontier'].find_one()
+    assert (doc['state'], doc['attempts'], doc['failures']) == ('failed', 0, 3)
+    assert db['Errors'].count_documents({'type': 'frontier_exhausted', 'failures': 3}) == 1
+    assert a.next_request() is None
+
+
+def test_close_returns_claimed_requests(db, nodes):
+    a, b = nodes
+    a.claim_batch_size = 10
+    for i in range(3):
+        a.enqueue_request(scrapy.Request('http://example.com/%d' % i))
+    a.next_request()
+    a.close('shutdown')
+
+    assert db['Frontier'].count_documents({'state': 'pending', 'attempts': 0}) == 2
+    assert all(b.next_request() is not None for _ in range(2))
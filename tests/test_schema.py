@@ -0,0 +1,111 @@
+import datetime
+
+import pytest
+
+from ldch import schema
+from ldch.schema import Schema, convert, load_schema, mark_writing
+from ldch.spiders.base import TorTestSpider
+from ldch.spiders.tcm import TcmRemuneracaoSpider
+
+
+def row(i):
+    return {
+        'Município': 'Município %d' % (i % 3),
+        'Entidade': 'Prefeitura',
+        'Competência': '2017-01',
+        'Nome': 'Servidor %d' % i,
+        'Matrícula': str(i),
+        'Tipo Servidor': 'Efetivo',
+        'Cargo': 'Professor',
+        'Salário Base': 1000 + i + 0.25,
+        'Salário Vantagens': 12.5
+    }
+
+
+@pytest.fixture
+def rows(db):
+    "Coleção do TCM no formato original, com 25 linhas."
+
+    db['TcmRemuneracao'].insert_many([row(i) for i in range(25)])
+    return [row(i) for i in range(25)]
+
+
+def read(db):
+    "Linhas da coleção do TCM com os nomes dos campos, no formato registrado."
+
+    source = load_schema(db, TcmRemuneracaoSpider)
+    rows = (source.from_document(doc) for doc in db['TcmRemuneracao'].find({}, {'_id': 0}))
+    return sorted(rows, key=lambda row: int(row['Matrícula']))
+
+
+def test_convert_to_compact_cents(db, rows):
+    assert convert(db, TcmRemuneracaoSpider, True, True, batch_size=10) == 25
+
+    doc = db['TcmRemuneracao'].find_one({'ma': '3'}, {'_id': 0})
+    assert doc == {'mu': 'Município 0', 'en': 'Prefeitura', 'co': '2017-01', 'no': 'Servidor 3',
+                   'ma': '3', 'ts': 'Efetivo', 'ca': 'Professor', 'sb': 100325, 'sv': 1250}
+    state = db[schema.COLLECTION].find_one({'_id': 'TcmRemuneracao'})
+    assert (state['compact'], state['cents'], 'converting' in state) == (True, True, False)
+    assert read(db) == rows
+    assert 'TcmRemuneracao.converting' not in db.list_collection_names()
+    # índices recriados com as chaves curtas
+    keys = [list(dict(index['key'])) for index in db['TcmRemuneracao'].index_information().values()]
+    assert ['co'] in keys
+
+    # e de volta ao formato original
+    assert convert(db, TcmRemuneracaoSpider, False, False) == 25
+    assert db['TcmRemuneracao'].find_one({'Matrícula': '3'})['Salário Base'] == 1003.25
+    assert read(db) == rows
+
+
+def test_interrupted_conversion_is_redone(db, rows):
+    # conversão interrompida durante a cópia: a coleção temporária está incompleta
+    target = Schema(TcmRemuneracaoSpider, True, True)
+    db['TcmRemuneracao.converting'].insert_many([target.to_document(row(i)) for i in range(5)])
+    db[schema.COLLECTION].insert_one({'_id': 'TcmRemuneracao', 'converting': target.state()})
+
+    with pytest.raises(RuntimeError):
+        load_schema(db, TcmRemuneracaoSpider, compact=True, cents=True)
+    assert load_schema(db, TcmRemuneracaoSpider).state() == {'compact': False, 'cents': False}
+
+    assert convert(db, TcmRemuneracaoSpider, True, True) == 25
+    assert db['TcmRemuneracao'].count_documents({}) == 25
+    assert read(db) == rows
+
+
+def test_conversion_interrupted_after_rename_is_finished(db, rows):
+    # a coleção já foi substituída, mas `Schemas` não foi atualizado
+    target = Schema(TcmRemuneracaoSpider, True, True)
+    db['TcmRemuneracao'].drop()
+    db['TcmRemuneracao'].insert_many([target.to_document(row) for row in rows])
+    db[schema.COLLECTION].insert_one({'_id': 'TcmRemuneracao', 'converting': target.state()})
+
+    assert convert(db, TcmRemuneracaoSpider, True, True) == 25
+    assert load_schema(db, TcmRemuneracaoSpider).state() == target.state()
+    assert read(db) == rows
+
+
+def test_convert_refuses_while_crawler_writes(db, rows):
+    since = mark_writing(db, 'TcmRemuneracao')
+    with pytest.raises(RuntimeError):
+        convert(db, TcmRemuneracaoSpider, True, True)
+
+    # gravação antiga, de um crawler que morreu
+    old = since - datetime.timedelta(seconds=schema.WRITER_TIMEOUT + 1)
+    db[schema.COLLECTION].update_one({'_id': 'TcmRemuneracao'}, {'$set': {'writing': old}})
+    assert convert(db, TcmRemuneracaoSpider, True, True) == 25
+
+
+def test_empty_collection_uses_settings(db):
+    assert load_schema(db, TcmRemuneracaoSpider, compact=True, cents=True).state() == \
+        {'compact': True, 'cents': True}
+    # o formato registrado prevalece sobre as configurações
+    assert load_schema(db, TcmRemuneracaoSpider, compact=False, cents=False).state() == \
+        {'compact': True, 'cents': True}
+
+
+def test_spider_without_stored_keys_keeps_items(db):
+    source = load_schema(db, TorTestSpider, compact=True, cents=True)
+    assert not source.compact
+    item = {'h1': 'Congratulations.', 'strong': '127.0.0.1', '__page': 1}
+    assert source.to_document(item) == {'h1': 'Congratulations.', 'strong': '127.0.0.1'}
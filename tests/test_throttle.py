@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+
+import pytest
+import scrapy
+from scrapy.http import Response
+from twisted.internet import error
+
+from helpers import Stats
+from ldch.throttle import AdaptiveThrottleMiddleware
+
+
+@pytest.fixture
+def slot():
+    return SimpleNamespace(concurrency=8, delay=1.0)
+
+
+@pytest.fixture
+def throttle(slot):
+    downloader = SimpleNamespace(slots={'example.com': slot})
+    crawler = SimpleNamespace(stats=Stats(), engine=SimpleNamespace(downloader=downloader))
+    return AdaptiveThrottleMiddleware(crawler, target_latency=1, min_samples=10, error_burst=5)
+
+
+def request(latency=0.1):
+    return scrapy.Request('http://example.com/', meta={'download_slot': 'example.com',
+                                                        'download_latency': latency})
+
+
+def respond(throttle, count, status=200, latency=0.1):
+    for _ in range(count):
+        req = request(latency)
+        throttle.process_response(req, Response(req.url, status=status), None)
+
+
+def time_out(throttle, count):
+    for _ in range(count):
+        throttle.process_exception(request(), error.TimeoutError(), None)
+
+
+def test_backs_off_on_errors(throttle, slot):
+    respond(throttle, 18)
+    respond(throttle, 2, status=503)
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+    assert throttle.stats.values['ldch/throttle/backoff'] == 1
+    assert throttle.stats.values['ldch/throttle/example.com/concurrency'] == 4
+
+
+def test_error_burst_backs_off_immediately(throttle, slot):
+    respond(throttle, 5, status=429)
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+    # a janela recomeça após a redução
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+
+
+def test_single_timeout_in_small_window_does_not_back_off(throttle, slot):
+    respond(throttle, 2)
+    time_out(throttle, 1)
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (8, 1.0)
+
+    respond(throttle, 1)
+    time_out(throttle, 2)
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+
+
+def test_slow_responses_reduce_concurrency(throttle, slot):
+    respond(throttle, 10, latency=3)
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (7, 1.0)
+
+
+def test_recovers_after_backoff(throttle, slot):
+    respond(throttle, 5, status=503)
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+
+    # janelas pequenas não bastam para aumentar a concorrência
+    respond(throttle, 5)
+    throttle.evaluate()
+    assert (slot.concurrency, slot.delay) == (4, 2.0)
+
+    for concurrency, delay in ((5, 1.0), (6, 0.5), (7, 0.25), (8, 0.125), (9, 0.0625), (10, 0)):
+        respond(throttle, 10)
+        throttle.evaluate()
+        assert (slot.concurrency, slot.delay) == (concurrency, delay)
+    assert throttle.stats.values['ldch/throttle/increase'] == 6
+
+
+def test_limits(throttle, slot):
+    throttle.max_concurrency = 9
+    throttle.max_delay = 4
+    for _ in range(3):
+        respond(throttle, 10)
+        throttle.evaluate()
+    assert slot.concurrency == 9
+
+    for _ in range(5):
+        respond(throttle, 5, status=503)
+    assert (slot.concurrency, slot.delay) == (1, 4)
+
+
+def test_forgets_closed_slots(throttle, slot):
+    respond(throttle, 1)
+    del throttle.crawler.engine.downloader.slots['example.com']
+    throttle.evaluate()
+    assert throttle.windows == {}